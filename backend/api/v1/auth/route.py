@@ -1,19 +1,31 @@
 from fastapi import APIRouter, Depends, HTTPException
 from db.session import get_db
-from db.CRUD import read_user_by_email
+from db.dal import read_user_by_email, update_user_password
 from utils.jwt_utils import create_access_token
-from utils.hashing import verify_password
-from utils.pydantic_models import AuthRequest, Response
+from utils.hashing import hash_password_async, needs_rehash, verify_password_async
+from utils.pydantic_models import AuthRequest, Envelope, Token
+from utils.responses import respond
 
 router = APIRouter()
 
 
-@router.post("/", response_model=Response)
-def authenticate(auth_data: AuthRequest, db=Depends(get_db)):
-    user = read_user_by_email(db, auth_data.email)
+@router.post("/", response_model=Envelope[Token])
+async def authenticate(auth_data: AuthRequest, db=Depends(get_db)):
+    user = await read_user_by_email(db, auth_data.email)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    if not verify_password(auth_data.password, user.password):
+    if not await verify_password_async(auth_data.password, user.password):
         raise HTTPException(status_code=401, detail="Invalid password")
+
+    # Upgrade the hash if BCRYPT_ROUNDS changed since it was made. Skipped
+    # when the hashing pool is saturated, the next login will retry
+    if needs_rehash(user.password):
+        try:
+            new_hash = await hash_password_async(auth_data.password)
+        except HTTPException:
+            new_hash = None
+        if new_hash:
+            await update_user_password(db, user.id, new_hash)
+
     token = create_access_token(data={"sub": user.id})
-    return Response(status=200, data={"token": token})
+    return respond({"token": token})
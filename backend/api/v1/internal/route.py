@@ -0,0 +1,22 @@
+from fastapi import APIRouter, Depends
+from db.init_db import pool_status
+from utils.metrics import profiler
+from utils.api_key_utils import verifyRequestAPIKey
+from utils.pydantic_models import Envelope
+from utils.responses import respond
+
+router = APIRouter()
+
+
+# Get connection pool occupancy and checkout wait times
+@router.get("/pool", response_model=Envelope[dict])
+async def get_pool_status(admin_auth=Depends(verifyRequestAPIKey)):
+    return respond({"pool": pool_status()})
+
+
+# Get the sampled stacks of the latest slow requests, newest first
+@router.get("/profiles", response_model=Envelope[dict])
+async def get_slow_request_profiles(admin_auth=Depends(verifyRequestAPIKey)):
+    if profiler is None:
+        return respond({"enabled": False, "profiles": []})
+    return respond({"enabled": True, "profiles": list(reversed(profiler.profiles))})
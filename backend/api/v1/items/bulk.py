@@ -0,0 +1,170 @@
+import csv
+import io
+import json
+from typing import AsyncIterable, AsyncIterator, BinaryIO, Iterator, Optional
+from pydantic import ValidationError
+from utils.pydantic_models import ItemBody
+
+# Rows validated and inserted per round trip
+IMPORT_BATCH_SIZE = 1000
+
+# Rows with errors beyond this many are counted but not listed, so the
+# report of a bad file stays small
+MAX_REPORTED_ERRORS = 100
+
+# Export rows are written out in chunks of about this many bytes
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+# Columns of an exported CSV file, also accepted as headers on import
+CSV_COLUMNS = list(ItemBody.model_fields)
+# Columns the API fills in, exported but never imported
+COMPUTED_COLUMNS = {"itemId", "rating", "ratingCount", "averageRating"}
+
+# Formats accepted by import and export, by name
+MEDIA_TYPES = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+
+# Pick the format of an upload from its filename or content type
+def detect_format(filename: Optional[str], content_type: Optional[str]) -> Optional[str]:
+    for fmt, media_type in MEDIA_TYPES.items():
+        if (filename or "").lower().endswith(f".{fmt}") or content_type == media_type:
+            return fmt
+    return None
+
+
+def decoded_lines(file: BinaryIO) -> Iterator[str]:
+    """
+    Decodes an uploaded file line by line, so an invalid byte only loses
+    the rows from its line on.
+
+    Lines keep their line endings, as the csv module expects.
+    """
+    for number, raw in enumerate(file):
+        line = raw.decode("utf-8")
+        yield line.removeprefix("\ufeff") if number == 0 else line
+
+
+def read_rows(file: BinaryIO, fmt: str) -> Iterator[tuple[int, dict | str]]:
+    """
+    Parses an uploaded CSV or NDJSON file one row at a time.
+
+    Empty CSV cells are treated as missing values.
+
+    :param file: The uploaded file, read lazily.
+    :param fmt: "csv" or "ndjson".
+    :return: An iterator of `(line, row)` pairs, where `row` is a dictionary
+        or an error message if the line could not be parsed.
+    """
+    line = 0
+    try:
+        if fmt == "csv":
+            reader = csv.DictReader(decoded_lines(file))
+            while True:
+                try:
+                    row = next(reader)
+                except StopIteration:
+                    return
+                except csv.Error as e:
+                    yield reader.line_num, f"invalid CSV: {e}"
+                    continue
+                finally:
+                    line = reader.line_num
+                row = {key: value for key, value in row.items() if key and value}
+                yield line, row
+        else:
+            for line, raw in enumerate(decoded_lines(file), start=1):
+                if not raw.strip():
+                    continue
+                try:
+                    row = json.loads(raw)
+                except ValueError as e:
+                    yield line, f"invalid JSON: {e}"
+                    continue
+                if not isinstance(row, dict):
+                    yield line, "expected a JSON object"
+                    continue
+                yield line, row
+    except UnicodeDecodeError:
+        yield line + 1, "not valid UTF-8, this line and the rest of the file were not imported"
+
+
+def read_batches(
+    file: BinaryIO, fmt: str, batch_size: int = IMPORT_BATCH_SIZE
+) -> Iterator[tuple[list[int], list[dict], list[dict]]]:
+    """
+    Validates parsed rows and groups them into insert batches.
+
+    Blocking, so callers iterate it on the threadpool. Only one batch is
+    held in memory at a time.
+
+    :return: An iterator of `(lines, values, errors)`, where `values` are
+        the column values of the valid rows found on `lines` and `errors`
+        describe the rows that were rejected.
+    """
+    lines, values, errors = [], [], []
+    for line, row in read_rows(file, fmt):
+        if isinstance(row, str):
+            errors.append({"line": line, "errors": [row]})
+            continue
+        try:
+            item = ItemBody.model_validate(row)
+        except ValidationError as e:
+            errors.append({"line": line, "errors": validation_messages(e)})
+            continue
+        # Imported rows always become new items, with no reviews yet
+        lines.append(line)
+        values.append(item.model_dump(exclude=COMPUTED_COLUMNS))
+        if len(values) >= batch_size:
+            yield lines, values, errors
+            lines, values, errors = [], [], []
+    if values or errors:
+        yield lines, values, errors
+
+
+def validation_messages(error: ValidationError) -> list[str]:
+    return [
+        f"{'.'.join(str(loc) for loc in detail['loc'])}: {detail['msg']}"
+        for detail in error.errors()
+    ]
+
+
+class ImportReport:
+    """Counts imported and rejected rows, listing the first rejections."""
+
+    def __init__(self):
+        self.inserted = 0
+        self.failed = 0
+        self.errors: list[dict] = []
+
+    def reject(self, errors: list[dict]):
+        self.failed += len(errors)
+        room = MAX_REPORTED_ERRORS - len(self.errors)
+        self.errors.extend(errors[:room])
+
+    def as_dict(self) -> dict:
+        return {
+            "inserted": self.inserted,
+            "failed": self.failed,
+            "errors": self.errors,
+            "errors_truncated": self.failed > len(self.errors),
+        }
+
+
+async def csv_chunks(bodies: AsyncIterable[ItemBody]) -> AsyncIterator[str]:
+    """
+    Serializes items as CSV with a header row.
+
+    :param bodies: An async iterable of items, typically built lazily from
+        a streaming query.
+    :return: An async iterator of chunks of whole CSV rows.
+    """
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=CSV_COLUMNS)
+    writer.writeheader()
+    async for body in bodies:
+        writer.writerow(body.model_dump(mode="json"))
+        if buffer.tell() >= EXPORT_CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
@@ -0,0 +1,57 @@
+from typing import Iterable, Optional
+from pydantic_core import to_json
+from utils.cache import cache
+from utils.http_cache import make_etag, timestamp
+from utils.pydantic_models import ItemBody
+
+# Bumped on every catalog write. List payloads embed it in their keys, so a
+# single increment retires every cached page and category list at once
+CATALOG_VERSION_KEY = "items:version"
+# Layout of the cached entries, part of every key so that workers running
+# different releases never read each other's entries
+ENTRY_FORMAT = 3
+
+
+def item_key(itemId: int) -> str:
+    return f"item:{itemId}:f{ENTRY_FORMAT}"
+
+
+async def page_key(limit: int, after: Optional[int]) -> str:
+    version = await cache.version(CATALOG_VERSION_KEY)
+    return f"items:v{version}:f{ENTRY_FORMAT}:page:{limit}:{after}"
+
+
+async def category_key(category: str) -> str:
+    version = await cache.version(CATALOG_VERSION_KEY)
+    return f"items:v{version}:f{ENTRY_FORMAT}:category:{category}"
+
+
+# Entries are "<etag> <payload>", so a conditional request is answered
+# from the cache without reading the payload
+def split_entry(entry: str) -> tuple[str, str]:
+    etag, _, payload = entry.partition(" ")
+    return etag, payload
+
+
+# ETag of an item, from its row version
+def item_etag(item) -> str:
+    return make_etag(item.version, timestamp(item.updated_at))
+
+
+# Serialize one item for the cache
+def dump_item(item) -> str:
+    return f"{item_etag(item)} {ItemBody.model_validate(item).model_dump_json()}"
+
+
+# Serialize a list payload, e.g. {"items": [...], "next_cursor": ...}. Its
+# ETag hashes the payload, as no single row version covers a whole list
+def dump_items(items, **extra) -> str:
+    items_data = [ItemBody.model_validate(item) for item in items]
+    payload = to_json({"items": items_data, **extra}).decode("utf-8")
+    return f"{make_etag(payload)} {payload}"
+
+
+# Drop the cached payloads of the given items and retire every list
+async def invalidate_items(itemIds: Iterable[int]):
+    await cache.invalidate(*(item_key(itemId) for itemId in itemIds))
+    await cache.bump(CATALOG_VERSION_KEY)
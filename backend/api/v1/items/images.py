@@ -0,0 +1,62 @@
+import hashlib
+import mimetypes
+import os
+from email.utils import formatdate
+from typing import Optional
+import anyio
+from dotenv import load_dotenv
+from fastapi import Request
+from fastapi.responses import FileResponse, Response, StreamingResponse
+from utils.http_cache import not_modified
+from utils.storage import IMAGE_TYPES, LocalStorage, storage
+
+load_dotenv()
+
+# How long clients may reuse an image before revalidating it with its ETag.
+# The URL names an item, whose picture can change, so it is not immutable
+IMAGE_MAX_AGE = int(os.getenv("IMAGE_MAX_AGE", "300"))
+
+
+# Stored keys are content addresses, so the key itself identifies the bytes
+def image_etag(key: str) -> str:
+    return f'"{hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]}"'
+
+
+async def image_response(request: Request, key: str) -> Optional[Response]:
+    """
+    Serves a stored image with validators and caching headers.
+
+    Local files go out through FileResponse, which answers Range requests
+    and hands the file to the server with `http.response.pathsend` when the
+    server supports it, so the bytes never pass through Python. Other
+    backends stream the object.
+
+    :param request: The incoming request, for its conditional headers.
+    :param key: The storage key of the image.
+    :return: The response, or None if no file is stored under `key`.
+    """
+    extension = os.path.splitext(key)[1]
+    media_type = IMAGE_TYPES.get(extension) or mimetypes.guess_type(key)[0]
+    headers = {
+        "etag": image_etag(key),
+        "cache-control": f"public, max-age={IMAGE_MAX_AGE}",
+    }
+
+    if isinstance(storage, LocalStorage):
+        try:
+            path = storage.path(key)
+            stat_result = await anyio.Path(path).stat()
+        except (ValueError, FileNotFoundError, NotADirectoryError):
+            return None
+        if not_modified(request, headers["etag"], stat_result.st_mtime):
+            headers["last-modified"] = formatdate(stat_result.st_mtime, usegmt=True)
+            return Response(status_code=304, headers=headers)
+        return FileResponse(
+            path, media_type=media_type, headers=headers, stat_result=stat_result
+        )
+
+    if not await storage.exists(key):
+        return None
+    if not_modified(request, headers["etag"], None):
+        return Response(status_code=304, headers=headers)
+    return StreamingResponse(storage.read(key), media_type=media_type, headers=headers)
@@ -1,174 +1,488 @@
-import os
-import shutil
-from typing import Annotated
+import json
+from typing import Annotated, Optional
 from utils.jwt_utils import get_current_user
-from db.CRUD import (
+from utils.api_key_utils import verifyRequestAPIKey
+from db.dal import (
     create_item,
+    create_items,
+    create_review,
     delete_item_by_id,
     read_item_by_id,
-    read_items,
+    read_items_by_ids,
+    read_items_page,
+    read_reviews_page,
+    stream_items,
     update_item_by_id,
     read_item_by_userId,
     read_item_by_category,
+    search_items,
+    read_item_stats,
     add_item_to_user,
 )
-from db.session import get_db
-from utils.pydantic_models import ItemBody, Response
-from fastapi import APIRouter, Depends, File, Form, HTTPException, UploadFile
-from sqlalchemy.orm import Session
+from db.models import average_rating
+from db.session import get_db, open_session
+from utils.cache import cache
+from utils.images import IMAGE_SIZES, pipeline, variant_key
+from utils.storage import save_upload, storage
+from api.v1.items.cache import (
+    category_key,
+    dump_item,
+    dump_items,
+    invalidate_items,
+    item_key,
+    page_key,
+    split_entry,
+)
+from api.v1.items.images import image_response
+from api.v1.items.bulk import (
+    MEDIA_TYPES,
+    ImportReport,
+    csv_chunks,
+    detect_format,
+    read_batches,
+)
+from utils.pagination import (
+    DEFAULT_PAGE_SIZE,
+    MAX_PAGE_SIZE,
+    STREAM_BATCH_SIZE,
+    cursor_position,
+    ndjson_lines,
+    next_cursor,
+)
+from utils.batch import parse_ids, unique_ids
+from utils.pydantic_models import (
+    BatchGetBody,
+    CategoryRollup,
+    Envelope,
+    ImportResult,
+    ItemBatch,
+    ItemBody,
+    ItemData,
+    ItemList,
+    ItemRollup,
+    ItemsPage,
+    ItemSearchResult,
+    ItemStatsData,
+    NewReviewBody,
+    ReviewBody,
+    ReviewData,
+    ReviewsPage,
+)
+from utils.responses import respond, respond_json
+from utils.http_cache import cache_headers, make_etag, not_modified, not_modified_response
+from pydantic_core import to_json
+from fastapi import APIRouter, Depends, File, Form, HTTPException, Query, Request, UploadFile
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import iterate_in_threadpool
 
 router = APIRouter()
 
 
 # Create a new item
-@router.post("/", response_model=Response)
-def create_new_item(
+@router.post("/", response_model=Envelope[str])
+async def create_new_item(
     category: Annotated[str, Form(...)],
     item_name: Annotated[str, Form(...)],
     itemDesc: Annotated[str, Form(...)],
     stock: Annotated[int, Form(...)],
     itemPic: Annotated[UploadFile, File(...)],
-    db: Session = Depends(get_db),
+    db=Depends(get_db),
     user_auth=Depends(get_current_user),
 ):
     # Check for any missing required fields
     if not category or not item_name or not itemDesc or not stock or not itemPic:
         raise HTTPException(status_code=400, detail="Missing data in the request body")
 
-    # Save the uploaded file
-    upload_dir = "uploads/"
-    os.makedirs(upload_dir, exist_ok=True)
-    file_location = os.path.join(upload_dir, itemPic.filename)
-
-    with open(file_location, "wb") as buffer:
-        shutil.copyfileobj(itemPic.file, buffer)
+    # Store the uploaded file under its content hash
+    picKey = await save_upload(itemPic)
+    pipeline.submit(picKey)
 
-    new_item = create_item(
+    new_item = await create_item(
         db,
         item_name=item_name,
         category=category,
         itemDesc=itemDesc,
         stock=stock,
-        itemPic=file_location,  # file path is saved in database
+        itemPic=picKey,  # storage key is saved in database
     )
     if new_item:
-        return Response(status=200, data=f"item {new_item.itemId} created successfully")
+        await invalidate_items([new_item.itemId])
+        return respond(f"item {new_item.itemId} created successfully")
     else:
         raise HTTPException(status_code=400, detail="item not created")
 
 
-# Get all items
-@router.get("/", response_model=Response)
-def get_all_items(db: Session = Depends(get_db)):
-    items = read_items(db)
-    items_data = [ItemBody.model_validate(item) for item in items]
-    return Response(status=200, data={"items": items_data})
+# Get all items, one page at a time or as an NDJSON stream. With `ids`,
+# e.g. ?ids=3,1,2, get just those items instead, as `POST /batch-get` does
+@router.get("/", response_model=Envelope[ItemsPage | ItemBatch])
+async def get_all_items(
+    request: Request,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    stream: bool = False,
+    ids: Optional[str] = None,
+    db=Depends(get_db),
+):
+    if ids is not None:
+        try:
+            itemIds = parse_ids(ids)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        etag, payload = await items_batch(db, itemIds)
+        return respond_cached(request, "item_list", etag, payload)
+
+    if stream:
+        return StreamingResponse(stream_all_items(), media_type="application/x-ndjson")
+
+    try:
+        afterId = cursor_position(after, "itemId")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    async def load_page():
+        items = await read_items_page(db, limit=limit, after=afterId)
+        cursor = next_cursor(items, limit, "itemId")
+        return dump_items(items, next_cursor=cursor)
+
+    page = await cache.get_or_load(await page_key(limit, afterId), load_page)
+    etag, payload = split_entry(page)
+    return respond_cached(request, "item_list", etag, payload)
+
+
+# Get several items by ID, e.g. to render a cart in one request
+@router.post("/batch-get", response_model=Envelope[ItemBatch])
+async def batch_get_items(body: BatchGetBody, db=Depends(get_db)):
+    _, payload = await items_batch(db, unique_ids(body.ids))
+    return respond_json(payload)
+
+
+# Build the "<etag>", "<payload>" of a batch of items, in the order asked
+# for and with the IDs that have no item. Items are read through the
+# per-item cache and all misses are loaded with one IN query
+async def items_batch(db, itemIds: list[int]) -> tuple[str, str]:
+    keys = {item_key(itemId): itemId for itemId in itemIds}
+
+    async def load_items(missed: list[str]) -> dict[str, str]:
+        items = await read_items_by_ids(db, [keys[key] for key in missed])
+        return {item_key(item.itemId): dump_item(item) for item in items}
+
+    entries = await cache.get_many_or_load(list(keys), load_items)
+    found = [split_entry(entry)[1] for entry in entries if entry is not None]
+    missing = [itemId for itemId, entry in zip(itemIds, entries) if entry is None]
+    payload = f'{{"items":[{",".join(found)}],"missing":{to_json(missing).decode("utf-8")}}}'
+    return make_etag(payload), payload
+
+
+# Stream every item with its own session, since the response body is
+# produced after the request's `get_db` session may already be closed
+async def stream_all_items():
+    async with open_session() as session:
+        items = stream_items(session, batch_size=STREAM_BATCH_SIZE)
+        bodies = (ItemBody.model_validate(item) async for item in items)
+        async for line in ndjson_lines(bodies):
+            yield line
+
+
+# Import items from a CSV or NDJSON upload. Rows are parsed and validated
+# on the threadpool and inserted in batches, so memory stays bounded by the
+# batch size however large the file is. Invalid rows are reported by line
+# and skipped, every valid row is imported
+@router.post("/bulk", response_model=Envelope[ImportResult])
+async def import_items(
+    file: Annotated[UploadFile, File(...)],
+    format: Optional[str] = Query(None, pattern="^(csv|ndjson)$"),
+    db=Depends(get_db),
+    admin_auth=Depends(verifyRequestAPIKey),
+):
+    fmt = format or detect_format(file.filename, file.content_type)
+    if fmt is None:
+        raise HTTPException(
+            status_code=400, detail="Unknown file format, pass format=csv or format=ndjson"
+        )
+
+    report = ImportReport()
+    async for lines, values, errors in iterate_in_threadpool(read_batches(file.file, fmt)):
+        report.reject(errors)
+        if not values:
+            continue
+        inserted = await create_items(db, values)
+        if inserted is None:
+            report.reject([{"line": line, "errors": ["rejected by the database"]} for line in lines])
+        else:
+            report.inserted += inserted
+
+    if report.inserted:
+        await invalidate_items([])
+    return respond(report.as_dict())
+
+
+# Export every item as a CSV or NDJSON download, streamed from the database.
+# Declared before `/{itemId}` so "export" is not taken for an item ID
+@router.get("/export")
+async def export_items(format: str = Query("csv", pattern="^(csv|ndjson)$")):
+    chunks = stream_all_items() if format == "ndjson" else export_csv()
+    return StreamingResponse(
+        chunks,
+        media_type=MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="items.{format}"'},
+    )
+
+
+# Stream every item as CSV with its own session, like `stream_all_items`
+async def export_csv():
+    async with open_session() as session:
+        items = stream_items(session, batch_size=STREAM_BATCH_SIZE)
+        bodies = (ItemBody.model_validate(item) async for item in items)
+        async for chunk in csv_chunks(bodies):
+            yield chunk
+
+
+# Search items by text with category/rating/stock filters and facet counts.
+# Declared before `/{itemId}` so "search" is not taken for an item ID
+@router.get("/search", response_model=Envelope[ItemSearchResult])
+async def search_items_route(
+    q: Optional[str] = Query(None, max_length=200),
+    category: Optional[str] = None,
+    min_rating: Optional[int] = None,
+    in_stock: Optional[bool] = None,
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+    db=Depends(get_db),
+):
+    result = await search_items(
+        db,
+        q=q,
+        category=category,
+        min_rating=min_rating,
+        in_stock=in_stock,
+        limit=limit,
+        offset=offset,
+    )
+    items_data = [ItemBody.model_validate(item) for item in result["items"]]
+    facets = {
+        name: {facet_key(value): count for value, count in counts.items()}
+        for name, counts in result["facets"].items()
+    }
+    return respond({"items": items_data, "facets": facets, "total": result["total"]})
+
+
+# Per-category counts, stock and average rating plus the most ordered
+# items, read from the rollups so the cost does not grow with the catalog.
+# Declared before `/{itemId}` so "stats" is not taken for an item ID
+@router.get("/stats", response_model=Envelope[ItemStatsData])
+async def get_item_stats(top: int = Query(10, ge=1, le=100), db=Depends(get_db)):
+    stats = await read_item_stats(db, top)
+    categories = [
+        CategoryRollup(
+            category=row.category,
+            itemCount=row.itemCount,
+            stockTotal=row.stockTotal,
+            averageRating=average_rating(row.ratingSum, row.ratingCount),
+        )
+        for row in stats["categories"]
+    ]
+    top_items = [ItemRollup.model_validate(row) for row in stats["topItems"]]
+    return respond({"categories": categories, "topItems": top_items})
+
+
+# JSON object keys must be strings, so facet values are rendered as in JSON
+def facet_key(value) -> str:
+    if value is None:
+        return "null"
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value)
+
+
+# Serve a cached payload with its validators, or 304 when the client's copy
+# is current. Either way the payload is never parsed or serialized
+def respond_cached(request: Request, policy: str, etag: str, payload: str):
+    headers = cache_headers(policy, etag)
+    if not_modified(request, etag, None):
+        return not_modified_response(headers)
+    return respond_json(payload, headers=headers)
+
+
+# Read an item's cached "<etag> <payload>" entry, loading it on a miss
+async def cached_item(db, itemId: int) -> Optional[str]:
+    async def load_item():
+        item = await read_item_by_id(db, itemId)
+        return dump_item(item) if item else None
+
+    return await cache.get_or_load(item_key(itemId), load_item)
 
 
 # Get an item by ID
-@router.get("/{itemId}", response_model=Response)
-def get_item_by_id(itemId: int, db: Session = Depends(get_db)):
-    item = read_item_by_id(db, itemId)
+@router.get("/{itemId}", response_model=Envelope[ItemData])
+async def get_item_by_id(itemId: int, request: Request, db=Depends(get_db)):
+    item = await cached_item(db, itemId)
     if item:
-        return Response(status=200, data={"item": ItemBody.model_validate(item)})
+        etag, payload = split_entry(item)
+        return respond_cached(request, "item", etag, f'{{"item":{payload}}}')
     else:
         raise HTTPException(status_code=404, detail="Item not found")
 
 
+# Get an item's picture, resized to one of IMAGE_SIZES or at full size.
+# A variant that is not rendered yet is queued, and the original is
+# served meanwhile
+@router.get("/{itemId}/image")
+async def get_item_image(
+    itemId: int,
+    request: Request,
+    size: str = Query("original", pattern=f"^({'|'.join(['original', *IMAGE_SIZES])})$"),
+    db=Depends(get_db),
+):
+    item = await cached_item(db, itemId)
+    if not item:
+        raise HTTPException(status_code=404, detail="Item not found")
+
+    key = json.loads(split_entry(item)[1])["itemPic"]
+    if size != "original":
+        variant = variant_key(key, size)
+        if await storage.exists(variant):
+            key = variant
+        else:
+            pipeline.submit(key)
+
+    response = await image_response(request, key)
+    if response is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    return response
+
+
+# Get an item's reviews, newest first, one page at a time
+@router.get("/{itemId}/reviews", response_model=Envelope[ReviewsPage])
+async def get_item_reviews(
+    itemId: int,
+    limit: int = Query(20, ge=1, le=100),
+    after: Optional[str] = None,
+    db=Depends(get_db),
+):
+    try:
+        afterId = cursor_position(after, "reviewId")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    reviews = await read_reviews_page(db, itemId, limit=limit, after=afterId)
+    # An empty first page is the only case that needs telling apart from a
+    # missing item, and the item is usually cached
+    if not reviews and afterId is None and not await cached_item(db, itemId):
+        raise HTTPException(status_code=404, detail="Item not found")
+    cursor = next_cursor(reviews, limit, "reviewId")
+    reviews_data = [ReviewBody.model_validate(review) for review in reviews]
+    return respond({"reviews": reviews_data, "next_cursor": cursor})
+
+
+# Review an item as the signed in user
+@router.post("/{itemId}/reviews", response_model=Envelope[ReviewData], status_code=201)
+async def post_item_review(
+    itemId: int,
+    review: NewReviewBody,
+    db=Depends(get_db),
+    user_auth=Depends(get_current_user),
+):
+    new_review = await create_review(
+        db, itemId, userId=int(user_auth["sub"]), rating=review.rating, text=review.text
+    )
+    if not new_review:
+        raise HTTPException(status_code=404, detail="Item not found")
+    # Cached item payloads carry the average rating the review just changed
+    await invalidate_items([itemId])
+    return respond(
+        {"review": ReviewBody.model_validate(new_review)}, status=201, status_code=201
+    )
+
+
 # Get items by userId
-@router.get("/user/{userId}", response_model=Response)
-def get_item_by_user(userId: int, db: Session = Depends(get_db)):
-    items = read_item_by_userId(db, userId)
+@router.get("/user/{userId}", response_model=Envelope[ItemList])
+async def get_item_by_user(userId: int, db=Depends(get_db)):
+    items = await read_item_by_userId(db, userId)
     items_data = [ItemBody.model_validate(item) for item in items]
-    return Response(status=200, data={"items": items_data})
+    return respond({"items": items_data})
 
 
 # Get items by category
-@router.get("/category/{category}", response_model=Response)
-def get_items_by_category(category: str, db: Session = Depends(get_db)):
-    items = read_item_by_category(db, category)
-    items_data = [ItemBody.model_validate(item) for item in items]
-    return Response(status=200, data={"items": items_data})
+@router.get("/category/{category}", response_model=Envelope[ItemList])
+async def get_items_by_category(category: str, request: Request, db=Depends(get_db)):
+    async def load_category():
+        return dump_items(await read_item_by_category(db, category))
+
+    items = await cache.get_or_load(await category_key(category), load_category)
+    etag, payload = split_entry(items)
+    return respond_cached(request, "item_list", etag, payload)
 
 
 # Update an item by ID
-@router.put("/{itemId}", response_model=Response)
-def update_item(
+@router.put("/{itemId}", response_model=Envelope[str])
+async def update_item(
     itemId: int,
     category: Annotated[str, Form(...)],
     item_name: Annotated[str, Form(...)],
     itemDesc: Annotated[str, Form(...)],
     stock: Annotated[int, Form(...)],
     itemPic: Annotated[UploadFile, File(...)],
-    db: Session = Depends(get_db),
+    db=Depends(get_db),
     user_auth=Depends(get_current_user),
 ):
     # Check if the item exists
-    itemExists = True if read_item_by_id(db, itemId) else False
+    itemExists = True if await read_item_by_id(db, itemId) else False
     if not itemExists:
         raise HTTPException(status_code=404, detail="Item not found")
 
-    # Save the uploaded file
-    upload_dir = "uploads/"
-    os.makedirs(upload_dir, exist_ok=True)
-    file_location = os.path.join(upload_dir, itemPic.filename)
+    # Store the uploaded file under its content hash
+    picKey = await save_upload(itemPic)
+    pipeline.submit(picKey)
 
-    with open(file_location, "wb") as buffer:
-        shutil.copyfileobj(itemPic.file, buffer)
-
-    updated_item = update_item_by_id(
+    updated_item = await update_item_by_id(
         db,
         itemId=itemId,
         item_name=item_name,
         category=category,
         itemDesc=itemDesc,
         stock=stock,
-        itemPic=file_location,  # file path is updated in database
+        itemPic=picKey,  # storage key is updated in database
     )
     if updated_item:
-        return Response(
-            status=200, data=f"item {updated_item.itemId} updated successfully"
-        )
+        await invalidate_items([itemId])
+        return respond(f"item {updated_item.itemId} updated successfully")
     else:
         raise HTTPException(status_code=400, detail="item not updated")
 
 
 # Delete an item by ID
-@router.delete("/{itemId}", response_model=Response)
-def delete_item(
-    itemId: int, db: Session = Depends(get_db), user_auth=Depends(get_current_user)
+@router.delete("/{itemId}", response_model=Envelope[str])
+async def delete_item(
+    itemId: int, db=Depends(get_db), user_auth=Depends(get_current_user)
 ):
     # Check if the item exists
-    itemExists = True if read_item_by_id(db, itemId) else False
+    itemExists = True if await read_item_by_id(db, itemId) else False
     if not itemExists:
         raise HTTPException(status_code=404, detail="Item not found")
 
-    deleted_item = delete_item_by_id(db, itemId)
+    deleted_item = await delete_item_by_id(db, itemId)
     if deleted_item:
-        return Response(
-            status=200, data=f"item {deleted_item.itemId} deleted successfully"
-        )
+        await invalidate_items([itemId])
+        return respond(f"item {deleted_item.itemId} deleted successfully")
     else:
         raise HTTPException(status_code=400, detail="item not deleted")
 
 
 # Add an item to a user
-@router.post("/add-item/{userId}/{itemId}", response_model=Response)
-def add_item_to_user_route(
+@router.post("/add-item/{userId}/{itemId}", response_model=Envelope[str])
+async def add_item_to_user_route(
     userId: int,
     itemId: int,
-    db: Session = Depends(get_db),
+    db=Depends(get_db),
     user_auth=Depends(get_current_user),
 ):
-    itemExists = True if read_item_by_id(db, itemId) else False
+    itemExists = True if await read_item_by_id(db, itemId) else False
     if not itemExists:
         raise HTTPException(status_code=404, detail="Item not found")
 
-    user = add_item_to_user(db, userId, itemId)
+    user = await add_item_to_user(db, userId, itemId)
     if user:
-        return Response(
-            status=200, data=f"item {itemId} added to user {userId} successfully"
-        )
+        return respond(f"item {itemId} added to user {userId} successfully")
     else:
         raise HTTPException(
             status_code=400, detail="item not added to user or user does not exist"
@@ -0,0 +1,59 @@
+import asyncio
+import logging
+import os
+from typing import Optional
+from dotenv import load_dotenv
+from db import dal
+from db.session import open_session
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Seconds between full recomputes of the rollups, 0 to never run them. The
+# write paths keep the rollups current, so this only corrects drift, e.g.
+# from rows changed outside the API
+STATS_REFRESH_SECONDS = float(os.getenv("STATS_REFRESH_SECONDS", "3600"))
+
+
+class StatsRefresher:
+    """
+    Background task that rebuilds the item rollups every `interval` seconds.
+
+    Every worker runs its own. A rebuild overwrites the rows in place, so
+    two running at once just do the same work twice. Orders whose outbox
+    events are still pending are left out of the rebuild, as the outbox
+    worker adds them once it processes the events. On Postgres a rebuild
+    that races the outbox worker on a row fails and waits for its next run.
+    """
+
+    def __init__(self, interval: float = STATS_REFRESH_SECONDS):
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.refresh()
+            except Exception:
+                logger.exception("Refreshing the item rollups failed")
+
+    async def refresh(self):
+        async with open_session() as session:
+            await dal.refresh_stats(session)
+
+
+# Shared refresher, started and stopped with the app
+refresher = StatsRefresher()
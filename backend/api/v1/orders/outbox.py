@@ -0,0 +1,184 @@
+"""
+Worker that carries out the order events of the outbox, see db/outbox.py.
+
+By default it runs as a task in each app process, woken as soon as a
+route has committed an event and polling otherwise, so events written by
+other processes are picked up too. With OUTBOX_WORKER=off the app leaves
+the events to a separate process:
+
+    python -m api.v1.orders.outbox
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import defaultdict
+from datetime import timedelta
+from typing import Awaitable, Callable, Optional
+from dotenv import load_dotenv
+from db import dal
+from db.models import utcnow
+from db.session import open_session
+from utils.metrics import metrics
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# "inprocess" runs the worker inside the app, "off" leaves it to a separate
+# process
+OUTBOX_WORKER = os.getenv("OUTBOX_WORKER", "inprocess")
+# Events claimed per round trip
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "100"))
+# Seconds between polls when no route has signalled new events
+OUTBOX_POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", "1"))
+# Seconds a worker has to finish a batch before other workers may retry it
+OUTBOX_LEASE_SECONDS = float(os.getenv("OUTBOX_LEASE_SECONDS", "60"))
+# Attempts after which a failing event is left alone, with its last error
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "10"))
+# Delay before the first retry, doubled on every further attempt up to the
+# maximum
+OUTBOX_RETRY_SECONDS = float(os.getenv("OUTBOX_RETRY_SECONDS", "1"))
+OUTBOX_RETRY_MAX_SECONDS = float(os.getenv("OUTBOX_RETRY_MAX_SECONDS", "300"))
+# Hours processed events are kept for before they are deleted
+OUTBOX_RETENTION_HOURS = float(os.getenv("OUTBOX_RETENTION_HOURS", "168"))
+# Seconds between deletions of old processed events
+OUTBOX_PURGE_SECONDS = 3600
+
+# Subscribers of each kind of event, see `subscribe`
+subscribers: defaultdict[str, list[Callable[..., Awaitable]]] = defaultdict(list)
+
+
+def subscribe(kind: str):
+    """
+    Registers a coroutine function to be called with every event of a kind.
+
+    Subscribers run before the event's database effects commit, and an
+    event that fails anywhere is retried whole, so a subscriber can see an
+    event more than once. Side effects outside the database should be
+    keyed by the event's `idempotencyKey`.
+
+    :param kind: An event kind from db/outbox.py.
+    """
+    def register(fn):
+        subscribers[kind].append(fn)
+        return fn
+
+    return register
+
+
+# Backoff before the next attempt at an event that failed `attempts` times
+def retry_delay(attempts: int) -> timedelta:
+    return timedelta(seconds=min(OUTBOX_RETRY_MAX_SECONDS, OUTBOX_RETRY_SECONDS * 2 ** (attempts - 1)))
+
+
+class OutboxWorker:
+    """
+    Drains the outbox in batches, off the request path.
+
+    Each event is claimed under a lease, handed to its subscribers, then
+    applied and marked processed in one transaction, so its database
+    effects happen exactly once even when two workers race for it. An
+    event that fails is retried with exponential backoff.
+    """
+
+    def __init__(self, batch_size: int = OUTBOX_BATCH_SIZE, poll: float = OUTBOX_POLL_SECONDS):
+        self.batch_size = batch_size
+        self.poll = poll
+        self._task: Optional[asyncio.Task] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._purged_at = 0.0
+
+    def start(self):
+        if OUTBOX_WORKER == "off":
+            return
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        self._wake = None
+
+    # Wake the worker up, called by routes once they committed an event
+    def notify(self):
+        if self._wake is not None:
+            self._wake.set()
+
+    async def run(self):
+        while True:
+            try:
+                claimed = await self.run_batch()
+                if time.monotonic() - self._purged_at >= OUTBOX_PURGE_SECONDS:
+                    await self.purge()
+            except Exception:
+                logger.exception("Draining the outbox failed")
+                claimed = 0
+            # A full batch suggests more are waiting
+            if claimed < self.batch_size:
+                await self.wait()
+
+    async def wait(self):
+        if self._wake is None:
+            await asyncio.sleep(self.poll)
+            return
+        try:
+            await asyncio.wait_for(self._wake.wait(), self.poll)
+        except asyncio.TimeoutError:
+            pass
+        self._wake.clear()
+
+    async def drain(self) -> int:
+        """
+        Processes batches until none is left to claim, e.g. in tests.
+
+        :return: The number of events claimed.
+        """
+        total = 0
+        while claimed := await self.run_batch():
+            total += claimed
+        return total
+
+    async def run_batch(self) -> int:
+        lease = timedelta(seconds=OUTBOX_LEASE_SECONDS)
+        async with open_session() as session:
+            events = await dal.claim_outbox_events(session, self.batch_size, lease, OUTBOX_MAX_ATTEMPTS)
+            for event in events:
+                await self.process(session, event)
+        return len(events)
+
+    async def process(self, session, event):
+        try:
+            for subscriber in subscribers[event.kind]:
+                await subscriber(event)
+            done = await dal.process_outbox_event(session, event)
+        except Exception as e:
+            if event.attempts >= OUTBOX_MAX_ATTEMPTS:
+                metrics.outbox.inc((event.kind, "failed"))
+                logger.exception("Giving up on outbox event %s", event.idempotencyKey)
+            else:
+                metrics.outbox.inc((event.kind, "retried"))
+                logger.warning("Outbox event %s failed, retrying", event.idempotencyKey, exc_info=True)
+            await dal.retry_outbox_event(session, event, repr(e), retry_delay(event.attempts))
+            return
+        metrics.outbox.inc((event.kind, "processed" if done else "lost"))
+
+    async def purge(self):
+        before = utcnow() - timedelta(hours=OUTBOX_RETENTION_HOURS)
+        async with open_session() as session:
+            purged = await dal.purge_outbox_events(session, before)
+        self._purged_at = time.monotonic()
+        if purged:
+            logger.info("Deleted %d processed outbox events", purged)
+
+
+# Shared worker, started and stopped with the app
+worker = OutboxWorker()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(worker.run())
@@ -1,81 +1,271 @@
-import json
+from datetime import date
+from typing import Optional
 from utils.jwt_utils import get_current_user
-from db.CRUD import (
+from db.dal import (
     create_order,
     delete_order_by_id,
     read_order_by_id,
-    read_orders,
+    read_orders_by_ids,
+    read_order_version,
+    read_orders_page,
+    stream_orders,
     add_item_to_order,
-    read_order_by_userId,
+    read_orders_by_itemId,
 )
-from db.session import get_db
-from utils.pydantic_models import OrderBody, Response
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
+from db.models import OrderStatus, average_rating
+from db.order_lines import OrderConflict
+from db.order_listing import ORDER_SORT_PATTERN, ORDER_SORTS
+from db.session import get_db, open_session
+from api.v1.items.cache import invalidate_items
+from api.v1.orders.outbox import worker as outbox_worker
+from utils.pagination import (
+    DEFAULT_PAGE_SIZE,
+    MAX_PAGE_SIZE,
+    STREAM_BATCH_SIZE,
+    cursor_keyset,
+    ndjson_lines,
+    next_cursor,
+)
+from utils.batch import in_request_order, parse_ids, unique_ids
+from utils.pydantic_models import (
+    BatchGetBody,
+    Envelope,
+    OrderBatch,
+    OrderBody,
+    OrderData,
+    OrderLineBody,
+    OrderList,
+    OrdersPage,
+)
+from utils.responses import respond
+from utils.http_cache import cache_headers, make_etag, not_modified, not_modified_response, timestamp
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
 
 router = APIRouter()
 
 # Create a new order
-@router.post("/", response_model=Response)
-def create_new_order(order: OrderBody, db: Session = Depends(get_db), user_auth=Depends(get_current_user)):
+@router.post("/", response_model=Envelope[str])
+async def create_new_order(order: OrderBody, db=Depends(get_db), user_auth=Depends(get_current_user)):
     # Check for any missing required fields
     if not order.items:
         raise HTTPException(status_code=400, detail="Missing data in the request body")
     
-    new_order = create_order(
+    new_order = await create_order(
         session=db,
         userId=order.userId,
-        # Convert each `ItemBody` object to a `dict` object
+        # Convert each `OrderLineBody` object to a `dict` object
         items=[item.model_dump() for item in order.items],
     )
     if new_order:
-        return Response(status=200, data=f"order {new_order.orderId} created successfully")
+        outbox_worker.notify()
+        # Cached item payloads carry the stock the order just reserved
+        await invalidate_items({item.itemId for item in order.items})
+        return respond(f"order {new_order.orderId} created successfully")
     else:
         raise HTTPException(status_code=400, detail="order not created")
 
-# Read all orders
-@router.get("/", response_model=Response)
-def get_all_orders(db: Session = Depends(get_db), user_auth=Depends(get_current_user)):
-    orders = read_orders(session=db)
-    for order in orders:
-        order.items = json.loads(order.items)
-    orders_data = [OrderBody.model_validate(order) for order in orders]
-    return Response(status=200, data={"orders": orders_data})
-
-# Read order by id
-@router.get("/{orderId}", response_model=Response)
-def get_order_by_id(orderId: int, db: Session = Depends(get_db), user_auth=Depends(get_current_user)):
-    order = read_order_by_id(session=db, orderId=orderId)
-    if order:
-        order.items = json.loads(order.items)
-        return Response(status=200, data={"orders": OrderBody.model_validate(order)})
-    else:
-        raise HTTPException(status_code=404, detail="order not found")
+# Read all orders, one page at a time or as an NDJSON stream of the whole
+# table. Pages can be filtered by status, user and delivery date range, and
+# sorted by any of ORDER_SORTS, all in SQL. With `ids`, e.g. ?ids=3,1,2,
+# read just those orders instead, as `POST /batch-get` does
+@router.get("/", response_model=Envelope[OrdersPage | OrderBatch])
+async def get_all_orders(
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    sort: str = Query("orderId", pattern=ORDER_SORT_PATTERN),
+    status: Optional[OrderStatus] = None,
+    userId: Optional[int] = None,
+    deliveryFrom: Optional[date] = None,
+    deliveryTo: Optional[date] = None,
+    stream: bool = False,
+    ids: Optional[str] = None,
+    db=Depends(get_db),
+    user_auth=Depends(get_current_user),
+):
+    if ids is not None:
+        try:
+            orderIds = parse_ids(ids)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        return respond(await orders_batch(db, orderIds))
+
+    if stream:
+        return StreamingResponse(stream_all_orders(), media_type="application/x-ndjson")
+
+    return await orders_page(
+        db,
+        limit,
+        after,
+        sort,
+        status=status,
+        userId=userId,
+        deliveryFrom=deliveryFrom,
+        deliveryTo=deliveryTo,
+    )
+
+
+# Respond with one page of orders. The cursor holds the sort columns of the
+# page's last order, so it only fits pages in the same sort
+async def orders_page(db, limit: int, after: Optional[str], sort: str, **filters):
+    columns = ORDER_SORTS[sort.lstrip("-")]
+    try:
+        position = cursor_keyset(after, columns)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    orders, lines = await read_orders_page(
+        session=db, limit=limit, after=position, sort=sort, **filters
+    )
+    cursor = next_cursor(orders, limit, *columns)
+    orders_data = [
+        {
+            "orderId": order.orderId,
+            "userId": order.userId,
+            "items": [line_data(line) for line in lines.get(order.orderId, [])],
+        }
+        for order in orders
+    ]
+    return respond({"orders": orders_data, "next_cursor": cursor})
+
+
+# Read several orders by ID, e.g. to render an order history in one request
+@router.post("/batch-get", response_model=Envelope[OrderBatch])
+async def batch_get_orders(body: BatchGetBody, db=Depends(get_db), user_auth=Depends(get_current_user)):
+    return respond(await orders_batch(db, unique_ids(body.ids)))
+
 
-# Read order by userId
-@router.get("/user/{userId}", response_model=Response)
-def get_order_by_userId(userId: int, db: Session = Depends(get_db), user_auth=Depends(get_current_user)):
-    order = read_order_by_userId(session=db, userId=userId)
+# Build the payload of a batch of orders, in the order asked for and with
+# the IDs that have no order. One IN query reads the orders, one their lines
+async def orders_batch(db, orderIds: list[int]) -> dict:
+    orders = await read_orders_by_ids(session=db, orderIds=orderIds)
+    found, missing = in_request_order(orderIds, orders, key=lambda order: order.orderId)
+    return {"orders": [order_body(order) for order in found], "missing": missing}
+
+
+# Stream every order with its own session, since the response body is
+# produced after the request's `get_db` session may already be closed
+async def stream_all_orders():
+    async with open_session() as session:
+        orders = stream_orders(session, batch_size=STREAM_BATCH_SIZE)
+        bodies = (order_body(order) async for order in orders)
+        async for line in ndjson_lines(bodies):
+            yield line
+
+
+# Build an `OrderBody` from an order row and its loaded order lines. Lines
+# whose item no longer exists are left out, as the listings' join does
+def order_body(order) -> OrderBody:
+    return OrderBody(
+        orderId=order.orderId,
+        userId=order.userId,
+        items=[line_body(line) for line in order.order_items if line.item is not None],
+    )
+
+
+# Build an `OrderLineBody` from an order line and its loaded item. The
+# quantity is set on the validated model, copying it would cost as much as
+# validating the item again
+def line_body(line) -> OrderLineBody:
+    body = OrderLineBody.model_validate(line.item)
+    body.qty = line.qty
+    return body
+
+# Payload of an order line read as a row by the listings, with the fields
+# of `OrderLineBody` in its order. Rows are trusted as read, so they skip
+# the validation an `OrderLineBody` would cost per line
+def line_data(line) -> dict:
+    return {
+        "itemId": line.itemId,
+        "item_name": line.item_name,
+        "rating": line.rating,
+        "category": line.category,
+        "itemDesc": line.itemDesc,
+        "stock": line.stock,
+        "itemPic": line.itemPic,
+        "ratingCount": line.ratingCount,
+        "averageRating": average_rating(line.ratingSum, line.ratingCount),
+        "qty": line.qty,
+    }
+
+# ETag and Last-Modified of an order. Its lines embed item details, so the
+# versions of those items count as much as the order's own
+def order_validators(version: int, updated_at, items: list[tuple]) -> tuple[str, float]:
+    etag = make_etag(version, timestamp(updated_at), *(
+        f"{itemId}:{itemVersion}:{timestamp(itemUpdated)}"
+        for itemId, itemVersion, itemUpdated in items
+    ))
+    mtime = max([timestamp(updated_at), *(timestamp(itemUpdated) for _, _, itemUpdated in items)])
+    return etag, mtime
+
+
+# Read order by id. A conditional request first checks the versions alone
+# and answers 304 without loading the order's lines
+@router.get("/{orderId}", response_model=Envelope[OrderData])
+async def get_order_by_id(orderId: int, request: Request, db=Depends(get_db), user_auth=Depends(get_current_user)):
+    if "if-none-match" in request.headers or "if-modified-since" in request.headers:
+        version = await read_order_version(session=db, orderId=orderId)
+        if version is None:
+            raise HTTPException(status_code=404, detail="order not found")
+        etag, mtime = order_validators(*version)
+        if not_modified(request, etag, mtime):
+            return not_modified_response(cache_headers("order", etag, mtime))
+
+    order = await read_order_by_id(session=db, orderId=orderId)
     if order:
-        order.items = json.loads(order.items)
-        return Response(status=200, data={"orders": OrderBody.model_validate(order)})
+        lines = sorted(
+            (line.item.itemId, line.item.version, line.item.updated_at)
+            for line in order.order_items
+        )
+        etag, mtime = order_validators(order.version, order.updated_at, lines)
+        return respond({"orders": order_body(order)}, headers=cache_headers("order", etag, mtime))
     else:
         raise HTTPException(status_code=404, detail="order not found")
+
+# Read a user's order history one page at a time, newest first by default.
+# A user without orders has an empty history
+@router.get("/user/{userId}", response_model=Envelope[OrdersPage])
+async def get_orders_by_userId(
+    userId: int,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    sort: str = Query("-orderId", pattern=ORDER_SORT_PATTERN),
+    status: Optional[OrderStatus] = None,
+    db=Depends(get_db),
+    user_auth=Depends(get_current_user),
+):
+    return await orders_page(db, limit, after, sort, status=status, userId=userId)
+
+# Read all orders that contain an item
+@router.get("/item/{itemId}", response_model=Envelope[OrderList])
+async def get_orders_by_itemId(itemId: int, db=Depends(get_db), user_auth=Depends(get_current_user)):
+    orders = await read_orders_by_itemId(session=db, itemId=itemId)
+    orders_data = [order_body(order) for order in orders]
+    return respond({"orders": orders_data})
     
-# Add an item to an order
-@router.post("/{orderId}/items/{itemId}", response_model=Response)
-def add_to_order(orderId: int, itemId: int, db: Session = Depends(get_db), user_auth=Depends(get_current_user)):
-    order = add_item_to_order(session=db, orderId=orderId, itemId=itemId)
+# Add an item to an order, or one more of it if the order already has it
+@router.post("/{orderId}/items/{itemId}", response_model=Envelope[str])
+async def add_to_order(orderId: int, itemId: int, db=Depends(get_db), user_auth=Depends(get_current_user)):
+    try:
+        order = await add_item_to_order(session=db, orderId=orderId, itemId=itemId)
+    except OrderConflict as e:
+        raise HTTPException(status_code=409, detail=str(e))
     if order:
-        return Response(status=200, data=f"item {itemId} added to order {orderId}")
+        outbox_worker.notify()
+        # Cached item payloads carry the stock the line just reserved
+        await invalidate_items({itemId})
+        return respond(f"item {itemId} added to order {orderId}")
     else:
         raise HTTPException(status_code=404, detail="order not found")
     
 # Delete an order by id
-@router.delete("/{orderId}", response_model=Response)
-def delete_order(orderId: int, db: Session = Depends(get_db), user_auth=Depends(get_current_user)):
-    order = delete_order_by_id(session=db, orderId=orderId)
+@router.delete("/{orderId}", response_model=Envelope[str])
+async def delete_order(orderId: int, db=Depends(get_db), user_auth=Depends(get_current_user)):
+    order = await delete_order_by_id(session=db, orderId=orderId)
     if order:
-        return Response(status=200, data=f"order {orderId} deleted successfully")
+        outbox_worker.notify()
+        # Cached item payloads carry the stock the order gave back
+        await invalidate_items({line.itemId for line in order.order_items})
+        return respond(f"order {orderId} deleted successfully")
     else:
         raise HTTPException(status_code=404, detail="order not found")
\ No newline at end of file
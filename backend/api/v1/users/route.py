@@ -1,18 +1,32 @@
+from typing import Optional
 from utils.jwt_utils import get_current_user, create_access_token
 from utils.api_key_utils import verifyRequestAPIKey
-from db.CRUD import (
+from db.dal import (
     create_user,
-    read_users,
+    read_users_page,
+    stream_users,
     read_user_by_id,
+    read_user_version,
     read_user_by_email,
     update_user_by_id,
     delete_user_by_id,
 )
-from db.session import get_db
-from utils.hashing import hash_password
-from utils.pydantic_models import UserBody, Response
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
+from db.models import EmailTaken
+from db.session import get_db, open_session
+from utils.hashing import hash_password_async
+from utils.pagination import (
+    DEFAULT_PAGE_SIZE,
+    MAX_PAGE_SIZE,
+    STREAM_BATCH_SIZE,
+    cursor_position,
+    ndjson_lines,
+    next_cursor,
+)
+from utils.pydantic_models import Envelope, SignupResult, UserBody, UserData, UsersPage
+from utils.responses import respond
+from utils.http_cache import cache_headers, make_etag, not_modified, not_modified_response, timestamp
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
 
 
 # Create a router
@@ -20,8 +34,8 @@ router = APIRouter()
 
 
 # Create a new user
-@router.post("/", response_model=Response)
-def create_new_user(user: UserBody, db: Session = Depends(get_db)):
+@router.post("/", response_model=Envelope[SignupResult])
+async def create_new_user(user: UserBody, db=Depends(get_db)):
     # Check for any missing required fields
     if (
         not user.name
@@ -32,17 +46,18 @@ def create_new_user(user: UserBody, db: Session = Depends(get_db)):
     ):
         raise HTTPException(status_code=400, detail="Missing data in the request body")
 
-    # Check if the user already exists
-    userExists = True if read_user_by_email(db, user.email) else False
+    # Check if the user already exists. The unique index on email still
+    # decides between concurrent signups that both pass this check
+    userExists = True if await read_user_by_email(db, user.email) else False
     if userExists:
         raise HTTPException(
             status_code=400,
             detail="User already exists, please choose a different email address",
         )
 
-    # Hash the password
-    hashed_password = hash_password(user.password)
-    new_user = create_user(
+    # Hash the password on the hashing process pool
+    hashed_password = await hash_password_async(user.password)
+    new_user = await create_user(
         db,
         name=user.name,
         email=user.email,
@@ -52,51 +67,91 @@ def create_new_user(user: UserBody, db: Session = Depends(get_db)):
     )
     if new_user:
         token = create_access_token(data={"sub": new_user.id})
-        return Response(status=200, data={"message": f"User {new_user.name} created successfully", "token": token})
+        return respond({"message": f"User {new_user.name} created successfully", "token": token})
     else:
-        raise HTTPException(status_code=400, detail="user not created")
+        raise HTTPException(
+            status_code=400,
+            detail="User already exists, please choose a different email address",
+        )
+
 
+# Get all users, one page at a time or as an NDJSON stream
+@router.get("/", response_model=Envelope[UsersPage])
+async def get_all_users(
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    stream: bool = False,
+    db=Depends(get_db),
+    admin_auth=Depends(verifyRequestAPIKey),
+):
+    if stream:
+        return StreamingResponse(stream_all_users(), media_type="application/x-ndjson")
 
-# Get all users
-@router.get("/", response_model=Response)
-def get_all_users(db: Session = Depends(get_db), admin_auth = Depends(verifyRequestAPIKey)):
-    users = read_users(db)
+    try:
+        afterId = cursor_position(after, "id")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    users = await read_users_page(db, limit=limit, after=afterId)
+    cursor = next_cursor(users, limit, "id")
     users_data = [UserBody.model_validate(user) for user in users]
-    return Response(status=200, data={"users": users_data})
+    return respond({"users": users_data, "next_cursor": cursor})
+
 
+# Stream every user with its own session, since the response body is
+# produced after the request's `get_db` session may already be closed
+async def stream_all_users():
+    async with open_session() as session:
+        users = stream_users(session, batch_size=STREAM_BATCH_SIZE)
+        bodies = (UserBody.model_validate(user) async for user in users)
+        async for line in ndjson_lines(bodies):
+            yield line
 
-# Get a user by ID
-@router.get("/{id}", response_model=Response)
-def get_user_by_id(id: int, db: Session = Depends(get_db), admin_auth = Depends(verifyRequestAPIKey)):
-    user = read_user_by_id(db, id)
+
+# Get a user by ID. A conditional request is answered from the user's
+# version alone when nothing changed
+@router.get("/{id}", response_model=Envelope[UserData])
+async def get_user_by_id(id: int, request: Request, db=Depends(get_db), admin_auth = Depends(verifyRequestAPIKey)):
+    if "if-none-match" in request.headers or "if-modified-since" in request.headers:
+        version = await read_user_version(db, id)
+        if version is None:
+            raise HTTPException(status_code=404, detail="user not found")
+        etag, mtime = make_etag(version[0], timestamp(version[1])), timestamp(version[1])
+        if not_modified(request, etag, mtime):
+            return not_modified_response(cache_headers("user", etag, mtime))
+
+    user = await read_user_by_id(db, id)
     if user:
-        return Response(
-            status=200,
-            data={"user": UserBody.model_validate(user)},
-        )
+        mtime = timestamp(user.updated_at)
+        headers = cache_headers("user", make_etag(user.version, mtime), mtime)
+        return respond({"user": UserBody.model_validate(user)}, headers=headers)
     else:
         raise HTTPException(status_code=404, detail="user not found")
 
 
 # Update a user by ID
-@router.put("/{id}", response_model=Response)
-def update_user(id: int, user: UserBody, db: Session = Depends(get_db), user_auth=Depends(get_current_user)):
-    updated_user = update_user_by_id(
-        db, id, name=user.name, email=user.email, phoneNumber=user.phoneNumber, address=user.address
-    )
+@router.put("/{id}", response_model=Envelope[str])
+async def update_user(id: int, user: UserBody, db=Depends(get_db), user_auth=Depends(get_current_user)):
+    try:
+        updated_user = await update_user_by_id(
+            db, id, name=user.name, email=user.email, phoneNumber=user.phoneNumber, address=user.address
+        )
+    except EmailTaken:
+        raise HTTPException(
+            status_code=409,
+            detail="Email already in use, please choose a different email address",
+        )
     if updated_user:
-        return Response(status=201, data=f"user {user.name} updated successfully")
+        return respond(f"user {user.name} updated successfully", status=201)
     else:
         raise HTTPException(status_code=404, detail="user not found")
 
 
 # Delete a user by ID
-@router.delete("/{id}", response_model=Response)
-def delete_user(id: int, db: Session = Depends(get_db), admin_auth = Depends(verifyRequestAPIKey)):
-    deleted_user = delete_user_by_id(db, id)
+@router.delete("/{id}", response_model=Envelope[str])
+async def delete_user(id: int, db=Depends(get_db), admin_auth = Depends(verifyRequestAPIKey)):
+    deleted_user = await delete_user_by_id(db, id)
     if deleted_user:
-        return Response(
-            status=200, data=f"user {deleted_user.name} deleted successfully"
-        )
+        return respond(f"user {deleted_user.name} deleted successfully")
     else:
         raise HTTPException(status_code=404, detail="user not found")
\ No newline at end of file
@@ -0,0 +1,594 @@
+"""
+Drives every route in api/v1 and reports latency percentiles and throughput.
+
+Seed a scratch database with `benchmarks.seed` first. The benchmark writes
+to it (orders, users, items are created and deleted), so reseed it before
+runs that must be compared exactly. Run it from the backend directory.
+
+In process, through an ASGI client with no network or server in between,
+which isolates the app's own cost:
+
+    python -m benchmarks.load --url URL --out results.json
+
+Against a running server from several load generating processes, which
+measures the whole stack:
+
+    RATE_LIMIT_BACKEND=off uvicorn main:app --workers 4
+    python -m benchmarks.load --url URL --target http://127.0.0.1:8000 --processes 4
+
+`--url` points at the database the server uses, it is only read to learn
+the seeded sizes. Rate limiting is turned off in process, and should be
+for the server too, as the benchmark sends everything as a few clients. Pass `--compare` an earlier results file to print the
+change of every scenario next to the new numbers.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import platform
+import random
+import re
+import subprocess
+import time
+import struct
+import uuid
+import zlib
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Optional
+from benchmarks.seed import BENCH_PASSWORD, CATEGORIES, NOUNS, user_email
+
+# Requests per scenario, per process, and requests sent before timing starts
+DEFAULT_REQUESTS = 500
+DEFAULT_WARMUP = 20
+DEFAULT_CONCURRENCY = 8
+# Items in each bulk import request
+BULK_ROWS = 100
+
+API = "/api/v1"
+
+
+def solid_png(width: int, height: int) -> bytes:
+    """Encodes a grey RGB image as PNG, so uploads need no image library."""
+
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data))
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    rows = b"".join(b"\x00" + b"\x80\x80\x80" * width for _ in range(height))
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", header)
+        + chunk(b"IDAT", zlib.compress(rows))
+        + chunk(b"IEND", b"")
+    )
+
+
+# Stands in for an uploaded picture, large enough to be resized
+PICTURE = solid_png(800, 600)
+
+
+class BenchContext:
+    """What the scenarios need to build requests, sent to every process."""
+
+    def __init__(self, users: int, items: int, orders: int, api_headers: dict):
+        self.users = users
+        self.items = items
+        self.orders = orders
+        self.api_headers = api_headers
+        self.headers: dict = {}
+        self.image_item: Optional[int] = None
+
+    def user(self, rng: random.Random) -> int:
+        return rng.randint(1, self.users)
+
+    def item(self, rng: random.Random) -> int:
+        return rng.randint(1, self.items)
+
+    def order(self, rng: random.Random) -> int:
+        return rng.randint(1, self.orders)
+
+
+class Scenario:
+    """
+    One route under load.
+
+    `build` returns the arguments of the request to time. It may send
+    untimed requests first, e.g. to create the row a delete removes.
+    `requests` caps the scenario below the run's request count, for routes
+    that read the whole table.
+    """
+
+    def __init__(self, name: str, build: Callable[..., Awaitable[tuple]], requests: Optional[int] = None):
+        self.name = name
+        self.build = build
+        self.requests = requests
+
+
+def order_line(itemId: int, qty: int = 1) -> dict:
+    # The API reads only itemId and qty, the other fields satisfy the schema
+    return {
+        "itemId": itemId,
+        "qty": qty,
+        "item_name": "bench",
+        "category": "bench",
+        "itemDesc": "bench",
+        "stock": 1,
+        "itemPic": "none",
+    }
+
+
+def item_form(rng: random.Random) -> dict:
+    return {
+        "data": {
+            "category": rng.choice(CATEGORIES),
+            "item_name": f"Bench {rng.choice(NOUNS)}",
+            "itemDesc": "Created by the load benchmark",
+            "stock": "100",
+        },
+        "files": {"itemPic": ("picture.png", PICTURE, "image/png")},
+    }
+
+
+def new_user() -> dict:
+    return {
+        "name": "Bench signup",
+        "email": f"{uuid.uuid4().hex}@bench.example.com",
+        "phoneNumber": "5550000000",
+        "address": "Bench street",
+        "password": BENCH_PASSWORD,
+    }
+
+
+# Read the number out of "order 12 created successfully"
+def created_id(response) -> int:
+    response.raise_for_status()
+    return int(re.search(r"\d+", response.json()["data"]).group())
+
+
+# Read the user id from the token returned on signup
+def token_subject(token: str) -> int:
+    payload = token.split(".")[1]
+    payload += "=" * (-len(payload) % 4)
+    return int(json.loads(base64.urlsafe_b64decode(payload))["sub"])
+
+
+async def login(client, ctx, rng):
+    body = {"email": user_email(ctx.user(rng)), "password": BENCH_PASSWORD}
+    return "POST", f"{API}/auth/", {"json": body}
+
+
+async def create_user(client, ctx, rng):
+    return "POST", f"{API}/users/", {"json": new_user()}
+
+
+async def list_users(client, ctx, rng):
+    return "GET", f"{API}/users/?limit=100", {"headers": ctx.api_headers}
+
+
+async def read_user(client, ctx, rng):
+    return "GET", f"{API}/users/{ctx.user(rng)}", {"headers": ctx.api_headers}
+
+
+async def update_user(client, ctx, rng):
+    id = ctx.user(rng)
+    body = {
+        "name": f"Bench user {id}",
+        "email": user_email(id),
+        "phoneNumber": "5550000000",
+        "address": f"{id} Bench street",
+    }
+    return "PUT", f"{API}/users/{id}", {"json": body, "headers": ctx.headers}
+
+
+async def delete_user(client, ctx, rng):
+    response = await client.post(f"{API}/users/", json=new_user())
+    response.raise_for_status()
+    id = token_subject(response.json()["data"]["token"])
+    return "DELETE", f"{API}/users/{id}", {"headers": ctx.api_headers}
+
+
+async def create_item(client, ctx, rng):
+    return "POST", f"{API}/items/", {**item_form(rng), "headers": ctx.headers}
+
+
+async def list_items(client, ctx, rng):
+    return "GET", f"{API}/items/?limit=100", {}
+
+
+async def stream_items(client, ctx, rng):
+    return "GET", f"{API}/items/?stream=true", {}
+
+
+async def bulk_import(client, ctx, rng):
+    rows = "".join(
+        json.dumps(
+            {
+                "item_name": f"Bulk {rng.choice(NOUNS)}",
+                "category": rng.choice(CATEGORIES),
+                "itemDesc": "Imported by the load benchmark",
+                "stock": 100,
+                "itemPic": "none",
+            }
+        )
+        + "\n"
+        for _ in range(BULK_ROWS)
+    )
+    files = {"file": ("items.ndjson", rows.encode(), "application/x-ndjson")}
+    return "POST", f"{API}/items/bulk", {"files": files, "headers": ctx.api_headers}
+
+
+async def export_items(client, ctx, rng):
+    return "GET", f"{API}/items/export?format=ndjson", {}
+
+
+async def search_items(client, ctx, rng):
+    return "GET", f"{API}/items/search?q={rng.choice(NOUNS)}", {}
+
+
+async def read_item(client, ctx, rng):
+    return "GET", f"{API}/items/{ctx.item(rng)}", {}
+
+
+async def item_stats(client, ctx, rng):
+    return "GET", f"{API}/items/stats?top=20", {}
+
+
+async def read_reviews(client, ctx, rng):
+    return "GET", f"{API}/items/{ctx.item(rng)}/reviews", {}
+
+
+async def post_review(client, ctx, rng):
+    body = {"rating": rng.randint(1, 5), "text": "Posted by the load benchmark"}
+    return "POST", f"{API}/items/{ctx.item(rng)}/reviews", {"json": body, "headers": ctx.headers}
+
+
+# A 50-item cart, as a client would render it
+async def batch_get_items(client, ctx, rng):
+    return "POST", f"{API}/items/batch-get", {"json": {"ids": [ctx.item(rng) for _ in range(50)]}}
+
+
+async def item_image(client, ctx, rng):
+    return "GET", f"{API}/items/{ctx.image_item}/image", {}
+
+
+async def items_by_user(client, ctx, rng):
+    return "GET", f"{API}/items/user/{ctx.user(rng)}", {}
+
+
+async def items_by_category(client, ctx, rng):
+    return "GET", f"{API}/items/category/{rng.choice(CATEGORIES)}", {}
+
+
+async def update_item(client, ctx, rng):
+    return "PUT", f"{API}/items/{ctx.item(rng)}", {**item_form(rng), "headers": ctx.headers}
+
+
+async def delete_item(client, ctx, rng):
+    response = await client.post(f"{API}/items/", **item_form(rng), headers=ctx.headers)
+    return "DELETE", f"{API}/items/{created_id(response)}", {"headers": ctx.headers}
+
+
+async def add_item_to_user(client, ctx, rng):
+    return "POST", f"{API}/items/add-item/{ctx.user(rng)}/{ctx.item(rng)}", {"headers": ctx.headers}
+
+
+def order_body(ctx, rng) -> dict:
+    lines = [order_line(itemId, rng.randint(1, 3)) for itemId in {ctx.item(rng) for _ in range(3)}]
+    return {"userId": ctx.user(rng), "items": lines}
+
+
+async def create_order(client, ctx, rng):
+    return "POST", f"{API}/orders/", {"json": order_body(ctx, rng), "headers": ctx.headers}
+
+
+async def list_orders(client, ctx, rng):
+    return "GET", f"{API}/orders/?limit=100", {"headers": ctx.headers}
+
+
+async def stream_orders(client, ctx, rng):
+    return "GET", f"{API}/orders/?stream=true", {"headers": ctx.headers}
+
+
+async def read_order(client, ctx, rng):
+    return "GET", f"{API}/orders/{ctx.order(rng)}", {"headers": ctx.headers}
+
+
+async def batch_get_orders(client, ctx, rng):
+    ids = ",".join(str(ctx.order(rng)) for _ in range(20))
+    return "GET", f"{API}/orders/?ids={ids}", {"headers": ctx.headers}
+
+
+# A dashboard's view: one status, the next week's deliveries, latest first
+async def filter_orders(client, ctx, rng):
+    today = datetime.now(timezone.utc).date()
+    query = f"status=confirmed&deliveryFrom={today}&deliveryTo={today + timedelta(days=7)}&sort=-deliveryDate"
+    return "GET", f"{API}/orders/?limit=100&{query}", {"headers": ctx.headers}
+
+
+async def orders_by_user(client, ctx, rng):
+    return "GET", f"{API}/orders/user/{ctx.user(rng)}", {"headers": ctx.headers}
+
+
+async def orders_by_item(client, ctx, rng):
+    return "GET", f"{API}/orders/item/{ctx.item(rng)}", {"headers": ctx.headers}
+
+
+async def add_item_to_order(client, ctx, rng):
+    return "POST", f"{API}/orders/{ctx.order(rng)}/items/{ctx.item(rng)}", {"headers": ctx.headers}
+
+
+async def delete_order(client, ctx, rng):
+    response = await client.post(f"{API}/orders/", json=order_body(ctx, rng), headers=ctx.headers)
+    return "DELETE", f"{API}/orders/{created_id(response)}", {"headers": ctx.headers}
+
+
+async def pool_status(client, ctx, rng):
+    return "GET", f"{API}/internal/pool", {"headers": ctx.api_headers}
+
+
+async def slow_profiles(client, ctx, rng):
+    return "GET", f"{API}/internal/profiles", {"headers": ctx.api_headers}
+
+
+# Every route in api/v1, in the order they run
+SCENARIOS = [
+    Scenario("login", login),
+    Scenario("create user", create_user),
+    Scenario("list users", list_users),
+    Scenario("read user", read_user),
+    Scenario("update user", update_user),
+    Scenario("delete user", delete_user),
+    Scenario("create item", create_item),
+    Scenario("list items", list_items),
+    Scenario("stream items", stream_items, requests=5),
+    Scenario("bulk import", bulk_import, requests=50),
+    Scenario("export items", export_items, requests=5),
+    Scenario("search items", search_items),
+    Scenario("read item", read_item),
+    Scenario("batch get items", batch_get_items),
+    Scenario("item stats", item_stats),
+    Scenario("read reviews", read_reviews),
+    Scenario("post review", post_review),
+    Scenario("item image", item_image),
+    Scenario("items by user", items_by_user),
+    Scenario("items by category", items_by_category),
+    Scenario("update item", update_item),
+    Scenario("delete item", delete_item),
+    Scenario("add item to user", add_item_to_user),
+    Scenario("create order", create_order),
+    Scenario("list orders", list_orders),
+    Scenario("stream orders", stream_orders, requests=5),
+    Scenario("read order", read_order),
+    Scenario("batch get orders", batch_get_orders),
+    Scenario("filter orders", filter_orders),
+    Scenario("orders by user", orders_by_user),
+    Scenario("orders by item", orders_by_item),
+    Scenario("add item to order", add_item_to_order),
+    Scenario("delete order", delete_order),
+    Scenario("pool status", pool_status),
+    Scenario("slow profiles", slow_profiles),
+]
+SCENARIOS_BY_NAME = {scenario.name: scenario for scenario in SCENARIOS}
+
+
+def seeded_context(url: str) -> BenchContext:
+    """
+    Reads the seeded sizes from the database.
+
+    Scenarios pick ids below the seeded maximum, so rows created during a
+    run are never targeted and reads stay comparable.
+    """
+    from sqlalchemy import create_engine, text
+    from utils.api_key_utils import API_KEY, API_KEY_NAME
+
+    engine = create_engine(url)
+    with engine.connect() as connection:
+        users, items, orders = (
+            connection.execute(text(f'SELECT coalesce(max("{column}"), 0) FROM {table}')).scalar()
+            for table, column in [("users", "id"), ("items", "itemId"), ("orders", "orderId")]
+        )
+    engine.dispose()
+    if not (users and items and orders):
+        raise SystemExit("The database is not seeded, run benchmarks.seed first")
+    return BenchContext(users, items, orders, {API_KEY_NAME: API_KEY})
+
+
+async def prepare(client, ctx: BenchContext):
+    """Logs in as a seeded user and uploads the picture `item image` serves."""
+    response = await client.post(
+        f"{API}/auth/", json={"email": user_email(1), "password": BENCH_PASSWORD}
+    )
+    response.raise_for_status()
+    ctx.headers = {"Authorization": f"Bearer {response.json()['data']['token']}"}
+    response = await client.post(f"{API}/items/", **item_form(random.Random(0)), headers=ctx.headers)
+    ctx.image_item = created_id(response)
+
+
+async def drive(client, scenario: Scenario, ctx: BenchContext, requests: int, concurrency: int, seed) -> dict:
+    """
+    Sends `requests` requests of a scenario from `concurrency` workers.
+
+    :return: The latency of every request in seconds, the responses per
+        status code and the wall clock start and end of the run.
+    """
+    latencies = []
+    statuses = Counter()
+    remaining = requests
+
+    async def worker(rng: random.Random):
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            method, url, kwargs = await scenario.build(client, ctx, rng)
+            start = time.perf_counter()
+            response = await client.request(method, url, **kwargs)
+            latencies.append(time.perf_counter() - start)
+            statuses[response.status_code] += 1
+
+    started = time.time()
+    await asyncio.gather(*(worker(random.Random(f"{seed}:{index}")) for index in range(concurrency)))
+    return {"latencies": latencies, "statuses": statuses, "start": started, "end": time.time()}
+
+
+async def run_in_process(scenarios: list, ctx: BenchContext, args) -> dict:
+    import httpx
+    import main
+
+    runs = {}
+    async with main.lifespan(main.app):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            await prepare(client, ctx)
+            for scenario in scenarios:
+                await drive(client, scenario, ctx, args.warmup, 1, f"warmup{args.seed}")
+                requests = min(args.requests, scenario.requests or args.requests)
+                runs[scenario.name] = [await drive(client, scenario, ctx, requests, args.concurrency, args.seed)]
+    return runs
+
+
+def drive_over_http(target: str, name: str, ctx: BenchContext, requests: int, concurrency: int, seed: int) -> dict:
+    """Runs one scenario in a load generating process."""
+    import httpx
+
+    async def run():
+        limits = httpx.Limits(max_connections=concurrency)
+        async with httpx.AsyncClient(base_url=target, limits=limits, timeout=None) as client:
+            return await drive(client, SCENARIOS_BY_NAME[name], ctx, requests, concurrency, seed)
+
+    return asyncio.run(run())
+
+
+def run_over_http(scenarios: list, ctx: BenchContext, args) -> dict:
+    import httpx
+
+    async def setup():
+        async with httpx.AsyncClient(base_url=args.target, timeout=None) as client:
+            await prepare(client, ctx)
+            for scenario in scenarios:
+                await drive(client, scenario, ctx, args.warmup, 1, f"warmup{args.seed}")
+
+    asyncio.run(setup())
+    runs = {}
+    with ProcessPoolExecutor(max_workers=args.processes) as pool:
+        for scenario in scenarios:
+            requests = min(args.requests, scenario.requests or args.requests)
+            futures = [
+                pool.submit(drive_over_http, args.target, scenario.name, ctx, requests, args.concurrency, args.seed + index)
+                for index in range(args.processes)
+            ]
+            runs[scenario.name] = [future.result() for future in futures]
+    return runs
+
+
+def percentile(values: list, fraction: float) -> float:
+    # Nearest rank on sorted values
+    return values[max(0, min(len(values) - 1, round(fraction * len(values)) - 1))]
+
+
+def summarize(runs: list) -> dict:
+    """
+    Merges the runs of one scenario across processes.
+
+    Throughput counts every request over the time from the first process
+    starting to the last one finishing.
+    """
+    latencies = sorted(latency for run in runs for latency in run["latencies"])
+    statuses = sum((run["statuses"] for run in runs), Counter())
+    elapsed = max(run["end"] for run in runs) - min(run["start"] for run in runs)
+    return {
+        "requests": len(latencies),
+        "errors": sum(count for status, count in statuses.items() if status >= 400),
+        "statuses": {str(status): count for status, count in sorted(statuses.items())},
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3),
+        "rps": round(len(latencies) / elapsed, 1) if elapsed else None,
+    }
+
+
+def git_revision() -> str:
+    try:
+        revision = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain"], capture_output=True, text=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return revision + ("-dirty" if dirty.strip() else "")
+
+
+def print_results(results: dict, baseline: Optional[dict] = None):
+    header = f"{'scenario':<20} {'requests':>8} {'errors':>6} {'p50 ms':>9} {'p99 ms':>9} {'req/s':>9}"
+    print(header + ("  change of p50 / p99 / req/s" if baseline else ""))
+    for name, result in results["scenarios"].items():
+        line = (
+            f"{name:<20} {result['requests']:>8} {result['errors']:>6} "
+            f"{result['p50_ms']:>9.2f} {result['p99_ms']:>9.2f} {result['rps'] or 0:>9.1f}"
+        )
+        before = (baseline or {}).get("scenarios", {}).get(name)
+        if before:
+            changes = [
+                f"{(result[key] - before[key]) / before[key]:+.0%}" if before[key] else "n/a"
+                for key in ("p50_ms", "p99_ms", "rps")
+            ]
+            line += "  " + " / ".join(changes)
+        print(line)
+
+
+def run(args) -> dict:
+    scenarios = [SCENARIOS_BY_NAME[name] for name in args.only] if args.only else SCENARIOS
+    ctx = seeded_context(args.url)
+    if args.target:
+        runs = run_over_http(scenarios, ctx, args)
+    else:
+        runs = asyncio.run(run_in_process(scenarios, ctx, args))
+
+    return {
+        "meta": {
+            "revision": git_revision(),
+            "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "database": args.url.split(":", 1)[0],
+            "db_mode": os.getenv("DB_MODE", "async"),
+            "mode": "http" if args.target else "in-process",
+            "processes": args.processes if args.target else 1,
+            "concurrency": args.concurrency,
+            "seeded": {"users": ctx.users, "items": ctx.items, "orders": ctx.orders},
+        },
+        "scenarios": {name: summarize(scenario_runs) for name, scenario_runs in runs.items()},
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test every API route")
+    parser.add_argument("--url", required=True, help="database URL, seeded with benchmarks.seed")
+    parser.add_argument("--target", help="base URL of a running server, in-process when omitted")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1, help="load generating processes with --target")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="requests in flight per process")
+    parser.add_argument("--requests", type=int, default=DEFAULT_REQUESTS, help="timed requests per scenario and process")
+    parser.add_argument("--warmup", type=int, default=DEFAULT_WARMUP, help="untimed requests per scenario first")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--only", type=lambda value: value.split(","), help="comma-separated scenario names")
+    parser.add_argument("--out", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="results JSON of an earlier run to compare against")
+    args = parser.parse_args()
+    for name in args.only or []:
+        if name not in SCENARIOS_BY_NAME:
+            parser.error(f"unknown scenario {name!r}, choose from: {', '.join(SCENARIOS_BY_NAME)}")
+
+    # The app reads its settings when imported, so the URL is set first
+    os.environ["DATABASE_URL"] = args.url
+    os.environ.setdefault("RATE_LIMIT_BACKEND", "off")
+    results = run(args)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+    print_results(results, baseline)
+    if args.out:
+        with open(args.out, "w") as file:
+            json.dump(results, file, indent=2)
@@ -0,0 +1,154 @@
+"""
+Benchmarks the hot lookups as the tables grow.
+
+Login and signup read a user by email, and the orders routes read orders
+by userId. With the indexes from migration 0004 both are B-tree lookups,
+so their latency should stay roughly flat as the tables grow by orders of
+magnitude. The same lookups are then timed with the indexes dropped, where
+every lookup scans the table and the latency grows with its size.
+
+Run it from the backend directory against a scratch database, since the
+users and orders tables are dropped and recreated:
+
+    python -m benchmarks.lookups [--url URL] [--sizes 1000 10000 100000]
+
+Without `--url` a temporary SQLite file is used.
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+from sqlalchemy import create_engine, insert, select, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from db.CRUD import read_user_by_email
+from db.models import Base, Order, User
+
+# Orders created for every user
+ORDERS_PER_USER = 3
+
+# Rows inserted per executemany round trip while seeding
+SEED_BATCH = 5000
+
+# Indexes serving the benchmarked lookups
+LOOKUP_INDEXES = [index for table in (User.__table__, Order.__table__) for index in table.indexes]
+
+
+def email_of(n: int) -> str:
+    return f"user{n}@bench.local"
+
+
+def seed(engine: Engine, start: int, stop: int):
+    """
+    Inserts users numbered `start` to `stop - 1` and their orders.
+
+    :param engine: The engine to seed.
+    :param start: Number of the first user to insert.
+    :param stop: Number of users in the table afterwards.
+    """
+    for low in range(start, stop, SEED_BATCH):
+        high = min(low + SEED_BATCH, stop)
+        with engine.begin() as conn:
+            conn.execute(
+                insert(User),
+                [
+                    {"id": n + 1, "name": f"user {n}", "email": email_of(n), "password": "x"}
+                    for n in range(low, high)
+                ],
+            )
+            conn.execute(
+                insert(Order),
+                [{"userId": n + 1} for n in range(low, high) for _ in range(ORDERS_PER_USER)],
+            )
+
+
+def time_lookups(engine: Engine, size: int, lookups: int) -> dict:
+    """
+    Times random email and per-user order lookups.
+
+    :return: The mean latency of each lookup in microseconds.
+    """
+    sample = random.sample(range(size), min(lookups, size))
+    timings = {}
+    with Session(engine) as session:
+        start = time.perf_counter()
+        for n in sample:
+            read_user_by_email(session, email_of(n))
+        timings["email_us"] = (time.perf_counter() - start) / len(sample) * 1e6
+
+        # Only the orders themselves, loading their lines is a separate
+        # primary key lookup that does not depend on this index
+        session.expunge_all()
+        start = time.perf_counter()
+        for n in sample:
+            session.scalars(select(Order).where(Order.userId == n + 1)).all()
+        timings["orders_us"] = (time.perf_counter() - start) / len(sample) * 1e6
+    return timings
+
+
+def query_plans(engine: Engine) -> list[str]:
+    explain = "EXPLAIN QUERY PLAN" if engine.dialect.name == "sqlite" else "EXPLAIN"
+    statements = [
+        """SELECT * FROM users WHERE email = 'user0@bench.local'""",
+        """SELECT * FROM orders WHERE "userId" = 1""",
+    ]
+    plans = []
+    with engine.connect() as conn:
+        for statement in statements:
+            rows = conn.execute(text(f"{explain} {statement}")).all()
+            plans.append(" | ".join(str(row[-1]) for row in rows))
+    return plans
+
+
+def set_indexes(engine: Engine, present: bool):
+    with engine.begin() as conn:
+        for index in LOOKUP_INDEXES:
+            if present:
+                index.create(conn, checkfirst=True)
+            else:
+                index.drop(conn, checkfirst=True)
+        # Refresh planner statistics after the data or indexes changed
+        conn.execute(text("ANALYZE"))
+
+
+def run(engine: Engine, sizes: list[int], lookups: int):
+    tables = [User.__table__, Order.__table__]
+    Base.metadata.drop_all(engine, tables=tables)
+    Base.metadata.create_all(engine, tables=tables)
+
+    print(f"{'users':>9} {'indexed email':>14} {'indexed orders':>15} {'scan email':>11} {'scan orders':>12}  (us per lookup)")
+    seeded = 0
+    for size in sorted(sizes):
+        seed(engine, seeded, size)
+        seeded = size
+
+        set_indexes(engine, present=True)
+        indexed = time_lookups(engine, size, lookups)
+        plans = query_plans(engine)
+        set_indexes(engine, present=False)
+        scanned = time_lookups(engine, size, lookups)
+        set_indexes(engine, present=True)
+
+        print(
+            f"{size:>9} {indexed['email_us']:>14.1f} {indexed['orders_us']:>15.1f}"
+            f" {scanned['email_us']:>11.1f} {scanned['orders_us']:>12.1f}"
+        )
+        for plan in plans:
+            print(f"{'':>9}   plan: {plan}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time indexed lookups as tables grow")
+    parser.add_argument("--url", help="scratch database URL, defaults to a temporary SQLite file")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--lookups", type=int, default=500, help="lookups timed per size")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        url = args.url or f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+        engine = create_engine(url)
+        try:
+            run(engine, args.sizes, args.lookups)
+        finally:
+            engine.dispose()
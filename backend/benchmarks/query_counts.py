@@ -0,0 +1,150 @@
+"""
+Counts the SQL statements each endpoint issues and checks them against a
+budget, so an N+1 query or a dropped loader option shows up as a failure.
+
+Every request runs with an empty cache, so the counts are those of a
+cache miss. Run it from the backend directory against a scratch database,
+which is migrated and seeded through the API:
+
+    python -m benchmarks.query_counts --url URL
+
+It exits with status 1 when an endpoint goes over its budget. When an
+endpoint comes in under its budget, lower the budget to lock the gain in.
+tests/test_query_counts.py runs it in both DB_MODEs as part of the suite.
+"""
+import argparse
+import io
+import json
+import os
+import sys
+from contextlib import contextmanager
+from sqlalchemy import event
+
+# Orders seeded for the user, so a per-row lazy load would be visible
+SEEDED_ORDERS = 5
+
+# Endpoint, method, path and the most statements it may issue
+QUERY_BUDGETS = [
+    ("read item", "GET", "/api/v1/items/1", 1),
+    ("items page", "GET", "/api/v1/items/?limit=100", 1),
+    ("batch get items", "POST", "/api/v1/items/batch-get", 1),
+    ("items by user", "GET", "/api/v1/items/user/1", 1),
+    ("items by category", "GET", "/api/v1/items/category/tools", 1),
+    ("search items", "GET", "/api/v1/items/search?q=knife", 4),
+    ("item stats", "GET", "/api/v1/items/stats", 2),
+    ("post review", "POST", "/api/v1/items/1/reviews", 4),
+    ("read reviews", "GET", "/api/v1/items/1/reviews", 1),
+    ("add item to user", "POST", "/api/v1/items/add-item/1/3", 4),
+    ("create order", "POST", "/api/v1/orders/", 6),
+    ("orders page", "GET", "/api/v1/orders/?limit=100", 2),
+    ("read order", "GET", "/api/v1/orders/1", 2),
+    ("batch get orders", "GET", "/api/v1/orders/?ids=2,1,99", 2),
+    ("filter orders", "GET", "/api/v1/orders/?status=confirmed&sort=-deliveryDate", 2),
+    ("orders by user", "GET", "/api/v1/orders/user/1", 2),
+    ("orders by item", "GET", "/api/v1/orders/item/1", 2),
+    ("read user", "GET", "/api/v1/users/1", 1),
+    ("login", "POST", "/api/v1/auth/", 1),
+]
+
+USER = {
+    "name": "bench",
+    "email": "bench@example.com",
+    "phoneNumber": "0",
+    "address": "bench",
+    "password": "bench-password",
+}
+ITEMS = [
+    {"item_name": name, "category": "tools", "itemDesc": desc, "stock": 1000, "itemPic": "none"}
+    for name, desc in [
+        ("Chef knife", "Forged steel knife"),
+        ("Hammer", "Claw hammer"),
+        ("Wrench", "Adjustable wrench"),
+    ]
+]
+ORDER = {"userId": 1, "items": [{**ITEMS[0], "itemId": 1}, {**ITEMS[1], "itemId": 2}]}
+
+
+class StatementCounter:
+    """Counts statements sent to the database by the app's engines."""
+
+    def __init__(self, engines):
+        self.count = 0
+        for engine in engines:
+            event.listen(engine, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+    @contextmanager
+    def counting(self):
+        start = self.count
+        result = {}
+        yield result
+        result["count"] = self.count - start
+
+
+def seed(client, headers, api_headers):
+    client.post("/api/v1/users/", json=USER).raise_for_status()
+    ndjson = "".join(json.dumps(item) + "\n" for item in ITEMS)
+    client.post(
+        "/api/v1/items/bulk",
+        headers=api_headers,
+        files={"file": ("items.ndjson", io.BytesIO(ndjson.encode()))},
+    ).raise_for_status()
+    client.post("/api/v1/items/add-item/1/1", headers=headers).raise_for_status()
+    client.post("/api/v1/items/add-item/1/2", headers=headers).raise_for_status()
+    for _ in range(SEEDED_ORDERS):
+        client.post("/api/v1/orders/", headers=headers, json=ORDER).raise_for_status()
+
+
+def run() -> bool:
+    from fastapi.testclient import TestClient
+    import main
+    from db.init_db import async_engine, engine
+    from utils.api_key_utils import API_KEY, API_KEY_NAME
+    from utils.cache import MemoryCache, cache
+    from utils.jwt_utils import create_access_token
+
+    headers = {"Authorization": f"Bearer {create_access_token({'sub': 1})}"}
+    api_headers = {API_KEY_NAME: API_KEY}
+    bodies = {
+        "create order": {"json": ORDER},
+        "login": {"json": USER},
+        "batch get items": {"json": {"ids": [3, 1, 2, 99]}},
+        "post review": {"json": {"rating": 4, "text": "Sharp"}},
+    }
+
+    with TestClient(main.app) as client:
+        seed(client, headers, api_headers)
+        engines = [engine] + ([async_engine.sync_engine] if async_engine else [])
+        counter = StatementCounter(engines)
+
+        ok = True
+        print(f"{'endpoint':<20} {'statements':>10} {'budget':>7}")
+        for name, method, path, budget in QUERY_BUDGETS:
+            cache.backend = MemoryCache()
+            with counter.counting() as result:
+                response = client.request(
+                    method, path, headers={**headers, **api_headers}, **bodies.get(name, {})
+                )
+            if response.status_code >= 400:
+                print(f"{name:<20} failed with {response.status_code}: {response.text}")
+                ok = False
+                continue
+            count = result["count"]
+            status = "OVER BUDGET" if count > budget else "under budget" if count < budget else ""
+            print(f"{name:<20} {count:>10} {budget:>7}  {status}")
+            ok = ok and count <= budget
+        return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check SQL statements per endpoint against budgets")
+    parser.add_argument("--url", required=True, help="scratch database URL, migrated and seeded")
+    args = parser.parse_args()
+
+    # The app reads its settings when imported, so the URL is set first. The
+    # outbox worker stays off, its polling would count against the endpoints
+    os.environ["DATABASE_URL"] = args.url
+    os.environ["OUTBOX_WORKER"] = "off"
+    sys.exit(0 if run() else 1)
@@ -0,0 +1,199 @@
+"""
+Seeds a scratch database to a given size for the load benchmarks.
+
+Rows are inserted in batches straight into the tables, so a million items
+take minutes rather than the hours the API would need. The same seed always
+produces the same rows, so results stay comparable between commits. Run it
+from the backend directory against an empty database, which is migrated
+first:
+
+    python -m benchmarks.seed --url URL --users 10000 --items 1000000 --orders 100000 --reviews 100000
+
+Every seeded user logs in with BENCH_PASSWORD.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import date, datetime, timedelta, timezone
+
+# Password of every seeded user, hashed once and shared
+BENCH_PASSWORD = "bench-password"
+# Rows sent to the database per INSERT
+SEED_BATCH_SIZE = 10_000
+
+CATEGORIES = [
+    "books", "clothing", "electronics", "garden", "grocery", "health",
+    "home", "jewelry", "kitchen", "music", "office", "outdoors", "pets",
+    "shoes", "sports", "tools", "toys", "travel", "video games", "watches",
+]
+ADJECTIVES = [
+    "compact", "durable", "ergonomic", "foldable", "heavy", "lightweight",
+    "organic", "portable", "rechargeable", "rustic", "sleek", "stainless",
+    "vintage", "waterproof", "wireless", "wooden",
+]
+NOUNS = [
+    "backpack", "blender", "chair", "desk", "drill", "headphones", "jacket",
+    "kettle", "knife", "lamp", "mug", "notebook", "speaker", "tent", "watch",
+    "wrench",
+]
+
+
+def item_row(itemId: int, rng: random.Random) -> dict:
+    adjective, noun = rng.choice(ADJECTIVES), rng.choice(NOUNS)
+    return {
+        "itemId": itemId,
+        "item_name": f"{adjective.title()} {noun} {itemId}",
+        "category": rng.choice(CATEGORIES),
+        "itemDesc": f"A {adjective} {noun}, {' '.join(rng.sample(ADJECTIVES, 3))}.",
+        "stock": 1_000_000,
+        "itemPic": "none",
+    }
+
+
+def user_row(id: int, password: str) -> dict:
+    return {
+        "id": id,
+        "name": f"Bench user {id}",
+        "email": user_email(id),
+        "phoneNumber": f"555{id:07d}",
+        "address": f"{id} Bench street",
+        "password": password,
+    }
+
+
+def user_email(id: int) -> str:
+    return f"user{id}@bench.example.com"
+
+
+def batched(rows, size: int = SEED_BATCH_SIZE):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def insert_rows(connection, table, rows, label: str):
+    start = time.perf_counter()
+    total = 0
+    for batch in batched(rows):
+        connection.execute(table.insert(), batch)
+        total += len(batch)
+    print(f"{label:<12} {total:>10} rows in {time.perf_counter() - start:.1f}s")
+
+
+def seed(users: int, items: int, orders: int, seed: int = 0, reviews: int = 0):
+    """
+    Migrates the database and fills it with generated rows.
+
+    :param users: Users to create, with ids 1 to `users`.
+    :param items: Items to create, with ids 1 to `items`.
+    :param orders: Orders to create, each of one to four lines.
+    :param seed: Seed of the generator, the same seed gives the same rows.
+    :param reviews: Reviews to create, by random users of random items.
+    """
+    from sqlalchemy import func, select, update
+    from db.init_db import create_schema, engine
+    from db.models import Item, Order, OrderItem, OrderStatus, Review, User, star_rating
+    from db.stats import rebuild_statements
+    from utils.hashing import hash_password
+
+    create_schema()
+    with engine.connect() as connection:
+        if connection.execute(select(func.count()).select_from(User)).scalar():
+            raise SystemExit("The database already has users, seed an empty one")
+
+    rng = random.Random(seed)
+    password = hash_password(BENCH_PASSWORD)
+    today = date.today()
+    now = datetime.now(timezone.utc)
+
+    def order_lines():
+        for orderId in range(1, orders + 1):
+            for itemId in rng.sample(range(1, items + 1), rng.randint(1, min(4, items))):
+                yield {"orderId": orderId, "itemId": itemId, "qty": rng.randint(1, 3)}
+
+    with engine.begin() as connection:
+        insert_rows(connection, User.__table__, (user_row(id, password) for id in range(1, users + 1)), "users")
+        insert_rows(connection, Item.__table__, (item_row(id, rng) for id in range(1, items + 1)), "items")
+        insert_rows(
+            connection,
+            Order.__table__,
+            (
+                {
+                    "orderId": orderId,
+                    "userId": rng.randint(1, users),
+                    "status": OrderStatus.confirmed,
+                    "deliveryDate": today + timedelta(days=rng.randint(1, 14)),
+                }
+                for orderId in range(1, orders + 1)
+            ),
+            "orders",
+        )
+        insert_rows(connection, OrderItem.__table__, order_lines(), "order lines")
+        insert_rows(
+            connection,
+            Review.__table__,
+            (
+                {
+                    "itemId": rng.randint(1, items),
+                    "userId": rng.randint(1, users),
+                    "rating": rng.randint(1, 5),
+                    "text": f"{rng.choice(ADJECTIVES).title()}, would buy again.",
+                    "created_at": now,
+                }
+                for _ in range(reviews)
+            ),
+            "reviews",
+        )
+        # Items carry the sum and count of their review ratings, and their stars
+        reviewed = select(Review).where(Review.itemId == Item.itemId)
+        connection.execute(
+            update(Item)
+            .where(Item.itemId.in_(select(Review.itemId)))
+            .values(
+                ratingSum=reviewed.with_only_columns(func.coalesce(func.sum(Review.rating), 0)).scalar_subquery(),
+                ratingCount=reviewed.with_only_columns(func.count(Review.rating)).scalar_subquery(),
+            )
+        )
+        connection.execute(
+            update(Item)
+            .where(Item.ratingCount > 0)
+            .values(rating=star_rating(Item.ratingSum, Item.ratingCount))
+        )
+
+        # The rows went in around the write paths, so the rollups are built once
+        start = time.perf_counter()
+        for stmt in rebuild_statements(connection.dialect.name):
+            connection.execute(stmt)
+        print(f"{'rollups':<12} {'':>10} built in {time.perf_counter() - start:.1f}s")
+
+        # Explicit ids leave Postgres sequences behind, so new rows would collide
+        if connection.dialect.name == "postgresql":
+            for table, column in [("users", "id"), ("items", "itemId"), ("orders", "orderId")]:
+                connection.exec_driver_sql(
+                    f"SELECT setval(pg_get_serial_sequence('{table}', '{column}'), "
+                    f"(SELECT coalesce(max(\"{column}\"), 1) FROM {table}))"
+                )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Seed a scratch database for the load benchmarks")
+    parser.add_argument("--url", required=True, help="scratch database URL, must be empty")
+    parser.add_argument("--users", type=int, default=1_000)
+    parser.add_argument("--items", type=int, default=10_000)
+    parser.add_argument("--orders", type=int, default=100_000)
+    parser.add_argument("--reviews", type=int, default=100_000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    if min(args.users, args.items) < 1:
+        parser.error("--users and --items must be at least 1")
+
+    # The app reads its settings when imported, so the URL is set first
+    os.environ["DATABASE_URL"] = args.url
+    sys.exit(seed(args.users, args.items, args.orders, args.seed, args.reviews))
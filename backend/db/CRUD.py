@@ -1,7 +1,48 @@
-import json
-from sqlalchemy.orm import Session
-from db.models import User, Item, Order, user_item_association
-from typing import Optional
+import time
+from collections import Counter, defaultdict
+from sqlalchemy import Row, case, exists, insert, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, selectinload
+from db.models import User, Item, Order, OrderItem, OrderStatus, Review, EmailTaken, star_rating, user_item_association
+from db.order_listing import order_lines_statement, orders_page_statement
+from db.order_lines import (
+    ORDER_UPDATE_ATTEMPTS,
+    OrderConflict,
+    append_line,
+    claim_order,
+    release_stock,
+    reserve_stock,
+    retry_delay,
+)
+from db.outbox import (
+    ORDER_CREATED,
+    ORDER_DELETED,
+    ORDER_ITEM_ADDED,
+    claim_statement,
+    event_items,
+    event_stats,
+    existing_items_statement,
+    finish_statement,
+    outbox_event,
+    pending_stock,
+    purge_statement,
+    retry_statement,
+    unprocessed_statement,
+    unprocessed_stats,
+)
+from db.search import search_statements, search_total
+from db.stats import StatsDelta, category_stats_statement, rebuild_statements, top_items_statement
+from datetime import date, datetime, timedelta
+from typing import Iterator, Optional
+
+# Load an order's lines and their items with one indexed join per batch of orders
+order_lines = selectinload(Order.order_items).joinedload(OrderItem.item)
+
+
+# Apply the rollup changes of a transaction, before it commits
+def apply_stats(session: Session, delta: StatsDelta):
+    for stmt in delta.statements(session.get_bind().dialect.name):
+        session.execute(stmt)
 
 
 # Create a new user
@@ -12,7 +53,7 @@ def create_user(
     phoneNumber: str,
     address: str,
     password: str,
-) -> User:
+) -> Optional[User]:
     new_user = User(
         name=name,
         email=email,
@@ -21,7 +62,12 @@ def create_user(
         password=password,
     )
     session.add(new_user)
-    session.commit()
+    try:
+        session.commit()
+    except IntegrityError:
+        # Another request registered the same email first
+        session.rollback()
+        return None
     session.refresh(new_user)
     return new_user
 
@@ -34,97 +80,275 @@ def create_item(
     itemDesc: str,
     stock: int,
     itemPic: str,
-    reviews: Optional[str] = None,
-    rating: Optional[float] = None,
 ) -> Item:
     new_item = Item(
         item_name=item_name,
-        rating=rating,
         category=category,
         itemDesc=itemDesc,
         stock=stock,
         itemPic=itemPic,
-        reviews=reviews,
     )
     session.add(new_item)
+    delta = StatsDelta()
+    delta.item_added(category, stock)
+    apply_stats(session, delta)
     session.commit()
     session.refresh(new_item)
     return new_item
 
 
-# Create a new order
-def create_order(session: Session, userId: int, items: list) -> Order:
+# Insert many items with batched executemany round trips, no per-row refresh
+def create_items(session: Session, items: list[dict]) -> Optional[int]:
+    delta = StatsDelta()
     for item in items:
-        # Check if every item exists in the items table
-        if not session.query(Item).filter(Item.itemId == item["itemId"]).first():
-            return None
-    # Convert the items list to a JSON string
-    items_to_json = json.dumps(items)
-    new_order = Order(items=items_to_json, userId=userId)
+        delta.item_added(item["category"], item["stock"])
+    try:
+        session.execute(insert(Item), items)
+        apply_stats(session, delta)
+        session.commit()
+    except IntegrityError:
+        session.rollback()
+        return None
+    return len(items)
+
+
+# Create a new order, reserving stock for every item in the same transaction
+def create_order(session: Session, userId: int, items: list) -> Optional[Order]:
+    # Repeated lines for the same item add up to one line with their total qty
+    quantities = Counter()
+    for item in items:
+        quantities[item["itemId"]] += item.get("qty", 1)
+    if not quantities:
+        return None
+
+    # Check every item exists with a single IN query. The rows are locked in
+    # itemId order so concurrent orders cannot deadlock on the update below
+    categories = dict(
+        session.query(Item.itemId, Item.category)
+        .filter(Item.itemId.in_(quantities))
+        .order_by(Item.itemId)
+        .with_for_update()
+        .all()
+    )
+    if len(categories) != len(quantities):
+        session.rollback()
+        return None
+
+    # Reserve stock for all items with one conditional bulk UPDATE
+    qty = case(quantities, value=Item.itemId)
+    reserved = session.execute(
+        update(Item)
+        .where(Item.itemId.in_(quantities), Item.stock >= qty)
+        .values(stock=Item.stock - qty)
+        .execution_options(synchronize_session=False)
+    )
+    if reserved.rowcount != len(quantities):
+        # At least one item does not have enough stock left
+        session.rollback()
+        return None
+
+    new_order = Order(
+        userId=userId,
+        order_items=[
+            OrderItem(itemId=itemId, qty=qty) for itemId, qty in quantities.items()
+        ],
+    )
     session.add(new_order)
+    # The rollups are left to the outbox worker, see db/outbox.py
+    session.flush()
+    lines = [
+        {"itemId": itemId, "qty": qty, "category": categories[itemId]}
+        for itemId, qty in quantities.items()
+    ]
+    session.add(outbox_event(ORDER_CREATED, new_order.orderId, {"lines": lines}))
     session.commit()
     session.refresh(new_order)
     return new_order
 
 
-# Add an item to a user
+# Add an item to a user. Membership is tested with EXISTS on the
+# association's primary key instead of loading the user's whole collection
 def add_item_to_user(session: Session, id: int, itemId: int) -> Optional[User]:
     user = session.query(User).filter(User.id == id).first()
-    item = session.query(Item).filter(Item.itemId == itemId).first()
-    if (user and item) and (item not in user.items):
-        user.items.append(item)
+    if not user:
+        return None
+    itemExists, linked = session.query(
+        exists().where(Item.itemId == itemId),
+        exists().where(
+            user_item_association.c.user_id == id,
+            user_item_association.c.item_id == itemId,
+        ),
+    ).one()
+    if not itemExists or linked:
+        return None
+
+    try:
+        session.execute(insert(user_item_association).values(user_id=id, item_id=itemId))
         session.commit()
-        session.refresh(user)
-        return user
-    else:
+    except IntegrityError:
+        # A concurrent request linked the item first
+        session.rollback()
         return None
+    return user
 
 
-# Add an item to an order
+# Add one of an item to an order. The order's version is claimed with a
+# compare-and-set, retried a few times when concurrent writers win, the unit
+# is reserved from the item's stock and the line is upserted in one
+# statement, so no concurrent add is lost and the item is never oversold
 def add_item_to_order(session: Session, orderId: int, itemId: int) -> Optional[Order]:
-    order = session.query(Order).filter(Order.orderId == orderId).first()
-    chosenItem = session.query(Item).filter(Item.itemId == itemId).first()
-    items_as_dict = json.loads(order.items)
-    # Check if the order and item exist
-    if not (order and chosenItem):
+    if not session.query(exists().where(Item.itemId == itemId)).scalar():
         return None
 
-    for item in items_as_dict:
-        if item["itemId"] == itemId:
-            # Item already exists in the order
+    dialect = session.get_bind().dialect.name
+    for attempt in range(ORDER_UPDATE_ATTEMPTS):
+        if attempt:
+            time.sleep(retry_delay(attempt))
+        order = session.query(Order).filter(Order.orderId == orderId).first()
+        if not order:
             return None
-
-    items_as_dict.append(
-        {
-            "itemId": chosenItem.itemId,
-            "item_name": chosenItem.item_name,
-            "rating": chosenItem.rating,
-            "category": chosenItem.category,
-            "itemDesc": chosenItem.itemDesc,
-            "stock": chosenItem.stock,
-            "itemPic": chosenItem.itemPic,
-            "reviews": chosenItem.reviews,
-        }
+        if order.status != OrderStatus.confirmed:
+            status = order.status.value
+            session.rollback()
+            raise OrderConflict(f"order is {status}")
+
+        if session.execute(claim_order(order)).rowcount == 1:
+            # Reserve the unit like `create_order` does, before the line holds it
+            category = session.execute(reserve_stock(itemId)).scalar()
+            if category is None:
+                session.rollback()
+                if not session.query(exists().where(Item.itemId == itemId)).scalar():
+                    # The item was deleted since it was checked
+                    return None
+                raise OrderConflict("item is out of stock")
+            qty = session.execute(append_line(dialect, orderId, itemId)).scalar_one()
+            # A quantity of 1 is a new line, so one more order holds the item
+            session.add(outbox_event(
+                ORDER_ITEM_ADDED,
+                orderId,
+                {"itemId": itemId, "qty": 1, "category": category, "newLine": qty == 1},
+            ))
+            session.commit()
+            return order
+        # Another writer changed the order first, read it again
+        session.rollback()
+    raise OrderConflict("order is being changed by another request, try again")
+
+
+# Add a review to an item. The item's rating sum, count and stars are
+# raised with one atomic UPDATE in the same transaction, which also tells
+# whether the item exists and serializes concurrent reviews of it. Its
+# category's rollup moves with them
+def create_review(
+    session: Session, itemId: int, userId: int, rating: int, text: str
+) -> Optional[Review]:
+    category = session.scalar(
+        update(Item)
+        .where(Item.itemId == itemId)
+        .values(
+            ratingSum=Item.ratingSum + rating,
+            ratingCount=Item.ratingCount + 1,
+            rating=star_rating(Item.ratingSum + rating, Item.ratingCount + 1),
+        )
+        .returning(Item.category)
+        .execution_options(synchronize_session=False)
     )
-    order.items = json.dumps(items_as_dict)
+    if category is None:
+        session.rollback()
+        return None
+    review = Review(itemId=itemId, userId=userId, rating=rating, text=text)
+    session.add(review)
+    delta = StatsDelta()
+    delta.rated(category, rating)
+    apply_stats(session, delta)
     session.commit()
-    session.refresh(order)
-    return order
+    session.refresh(review)
+    return review
+
+
+# Read a page of users ordered by ID, starting after the `after` ID
+def read_users_page(
+    session: Session, limit: int, after: Optional[int] = None
+) -> list[User]:
+    query = session.query(User).order_by(User.id)
+    if after is not None:
+        query = query.filter(User.id > after)
+    # Fetch one extra row so the caller can tell whether there is a next page
+    return query.limit(limit + 1).all()
+
+
+# Read a page of items ordered by itemId, starting after the `after` itemId
+def read_items_page(
+    session: Session, limit: int, after: Optional[int] = None
+) -> list[Item]:
+    query = session.query(Item).order_by(Item.itemId)
+    if after is not None:
+        query = query.filter(Item.itemId > after)
+    # Fetch one extra row so the caller can tell whether there is a next page
+    return query.limit(limit + 1).all()
+
+
+# Read a page of an item's reviews, newest first, starting after the
+# `after` reviewId
+def read_reviews_page(
+    session: Session, itemId: int, limit: int, after: Optional[int] = None
+) -> list[Review]:
+    query = (
+        session.query(Review)
+        .filter(Review.itemId == itemId)
+        .order_by(Review.reviewId.desc())
+    )
+    if after is not None:
+        query = query.filter(Review.reviewId < after)
+    # Fetch one extra row so the caller can tell whether there is a next page
+    return query.limit(limit + 1).all()
 
 
-# Read all users
-def read_users(session: Session) -> list[User]:
-    return session.query(User).all()
+# Read a page of orders matching the filters, in `sort` order and starting
+# after the `after` keyset position, with the lines of each order by its ID.
+# Both are plain rows, building ORM objects would cost most of a large page.
+# See `orders_page_statement`
+def read_orders_page(
+    session: Session,
+    limit: int,
+    after: Optional[tuple] = None,
+    sort: str = "orderId",
+    status: Optional[OrderStatus] = None,
+    userId: Optional[int] = None,
+    deliveryFrom: Optional[date] = None,
+    deliveryTo: Optional[date] = None,
+) -> tuple[list[Row], dict[int, list[Row]]]:
+    query = orders_page_statement(
+        limit, after, sort, status, userId, deliveryFrom, deliveryTo
+    )
+    # One extra row is fetched so the caller can tell whether there is a next page
+    orders = list(session.execute(query).all())
+    lines = defaultdict(list)
+    if orders:
+        query = order_lines_statement([order.orderId for order in orders])
+        for line in session.execute(query):
+            lines[line.orderId].append(line)
+    return orders, lines
+
 
+# Stream all users, loading `batch_size` rows per round trip
+def stream_users(session: Session, batch_size: int) -> Iterator[User]:
+    return session.query(User).order_by(User.id).yield_per(batch_size)
 
-# Read all items
-def read_items(session: Session) -> list[Item]:
-    return session.query(Item).all()
 
+# Stream all items, loading `batch_size` rows per round trip
+def stream_items(session: Session, batch_size: int) -> Iterator[Item]:
+    return session.query(Item).order_by(Item.itemId).yield_per(batch_size)
 
-# Read all orders
-def read_orders(session: Session) -> list[Order]:
-    return session.query(Order).all()
+
+# Stream all orders, loading `batch_size` rows per round trip
+def stream_orders(session: Session, batch_size: int) -> Iterator[Order]:
+    return (
+        session.query(Order)
+        .options(order_lines)
+        .order_by(Order.orderId)
+        .yield_per(batch_size)
+    )
 
 
 # Read a user by ID
@@ -132,6 +356,11 @@ def read_user_by_id(session: Session, id: int) -> Optional[User]:
     return session.query(User).filter(User.id == id).first()
 
 
+# Read a user's version and update time without loading the user
+def read_user_version(session: Session, id: int) -> Optional[tuple[int, datetime]]:
+    return session.query(User.version, User.updated_at).filter(User.id == id).first()
+
+
 # Read a user by email
 def read_user_by_email(session: Session, email: str) -> Optional[User]:
     return session.query(User).filter(User.email == email).first()
@@ -142,21 +371,20 @@ def read_item_by_id(session: Session, itemId: int) -> Optional[Item]:
     return session.query(Item).filter(Item.itemId == itemId).first()
 
 
-# Read all items by userId
-def read_item_by_userId(session: Session, userId: int) -> list[Item]:
-    user = session.query(User).filter(User.id == userId).first()
+# Read the items with the given IDs with a single IN query, in no
+# particular order. IDs without an item are left out
+def read_items_by_ids(session: Session, itemIds: list[int]) -> list[Item]:
+    return session.query(Item).filter(Item.itemId.in_(itemIds)).all()
 
-    if user:
-        # Join the User and Item models using the user_item_association table
-        items = (
-            session.query(Item)
-            .join(user_item_association, Item.itemId == user_item_association.c.item_id)
-            .filter(user_item_association.c.user_id == userId)
-            .all()
-        )
-        return items
-    else:
-        return []
+
+# Read all items by userId with a single join, an unknown user has no items
+def read_item_by_userId(session: Session, userId: int) -> list[Item]:
+    return (
+        session.query(Item)
+        .join(user_item_association, Item.itemId == user_item_association.c.item_id)
+        .filter(user_item_association.c.user_id == userId)
+        .all()
+    )
 
 
 # Read items by category
@@ -164,14 +392,101 @@ def read_item_by_category(session: Session, category: str) -> list[Item]:
     return session.query(Item).filter(Item.category == category).all()
 
 
+# Full-text search over items with filters, ranked results and facet counts
+def search_items(
+    session: Session,
+    q: Optional[str] = None,
+    category: Optional[str] = None,
+    min_rating: Optional[int] = None,
+    in_stock: Optional[bool] = None,
+    limit: int = 20,
+    offset: int = 0,
+) -> dict:
+    dialect = session.get_bind().dialect.name
+    results, facet_queries = search_statements(
+        dialect, q, category, min_rating, in_stock, limit, offset
+    )
+    items = [row[0] for row in session.execute(results)]
+    facets = {
+        name: {value: count for value, count in session.execute(stmt)}
+        for name, stmt in facet_queries.items()
+    }
+    return {"items": items, "facets": facets, "total": search_total(facets, category)}
+
+
+# Read the category rollups and the `top` most ordered items, two small
+# queries however large the catalog
+def read_item_stats(session: Session, top: int = 10) -> dict:
+    return {
+        "categories": session.scalars(category_stats_statement()).all(),
+        "topItems": session.execute(top_items_statement(top)).all(),
+    }
+
+
+# Recompute the rollups from the base tables, correcting any drift, less
+# the orders whose outbox events are still to be processed. Both are read in
+# one snapshot: SQLite holds its write lock from the first statement, and
+# Postgres runs the rebuild at REPEATABLE READ, so a rebuild racing the
+# outbox worker on a row fails rather than losing its update
+def refresh_stats(session: Session) -> None:
+    dialect = session.get_bind().dialect.name
+    if dialect == "postgresql":
+        session.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+    for stmt in rebuild_statements(dialect):
+        session.execute(stmt)
+    events = session.execute(unprocessed_statement()).all()
+    existing = set(session.scalars(existing_items_statement(event_items(events))))
+    apply_stats(session, unprocessed_stats(events, existing))
+    session.commit()
+
+
 # Read an order by ID
 def read_order_by_id(session: Session, orderId: int) -> Optional[Order]:
-    return session.query(Order).filter(Order.orderId == orderId).first()
+    return (
+        session.query(Order)
+        .options(order_lines)
+        .filter(Order.orderId == orderId)
+        .first()
+    )
 
 
-# Read an order by userId
-def read_order_by_userId(session: Session, userId: int) -> Optional[Order]:
-    return session.query(Order).filter(Order.userId == userId).first()
+# Read the orders with the given IDs and their lines, with one IN query
+# for the orders and one for all their lines
+def read_orders_by_ids(session: Session, orderIds: list[int]) -> list[Order]:
+    return (
+        session.query(Order)
+        .options(order_lines)
+        .filter(Order.orderId.in_(orderIds))
+        .all()
+    )
+
+
+# Read what an order's ETag is built from without loading the order: its
+# version and update time, and those of the items its lines embed
+def read_order_version(session: Session, orderId: int) -> Optional[tuple]:
+    rows = (
+        session.query(Order.version, Order.updated_at, Item.itemId, Item.version, Item.updated_at)
+        .outerjoin(OrderItem, OrderItem.orderId == Order.orderId)
+        .outerjoin(Item, Item.itemId == OrderItem.itemId)
+        .filter(Order.orderId == orderId)
+        .order_by(Item.itemId)
+        .all()
+    )
+    if not rows:
+        return None
+    return rows[0][0], rows[0][1], [tuple(row[2:]) for row in rows if row[2] is not None]
+
+
+# Read all orders that contain an item, using the order_items itemId index
+def read_orders_by_itemId(session: Session, itemId: int) -> list[Order]:
+    return (
+        session.query(Order)
+        .options(order_lines)
+        .join(OrderItem, OrderItem.orderId == Order.orderId)
+        .filter(OrderItem.itemId == itemId)
+        .order_by(Order.orderId)
+        .all()
+    )
 
 
 # Update a user by ID
@@ -193,29 +508,45 @@ def update_user_by_id(
             user.phoneNumber = phoneNumber
         if address:
             user.address = address
-        session.commit()
+        try:
+            session.commit()
+        except IntegrityError:
+            # The unique index on email holds another user's address
+            session.rollback()
+            raise EmailTaken(email)
         session.refresh(user)
     return user
 
 
+# Replace a user's password hash
+def update_user_password(session: Session, id: int, password: str) -> bool:
+    updated = session.execute(
+        update(User)
+        .where(User.id == id)
+        .values(password=password)
+        .execution_options(synchronize_session=False)
+    )
+    session.commit()
+    return updated.rowcount == 1
+
+
 # Update an item by ID
 def update_item_by_id(
     session: Session,
     item_name: str,
     itemId: int,
-    rating: Optional[float] = None,
     category: Optional[str] = None,
     itemDesc: Optional[str] = None,
     stock: Optional[int] = None,
     itemPic: Optional[str] = None,
-    reviews: Optional[str] = None,
 ) -> Optional[Item]:
-    item = session.query(Item).filter(Item.itemId == itemId).first()
+    # Locked, so the rollups move from the values this update replaces
+    item = session.query(Item).filter(Item.itemId == itemId).with_for_update().first()
     if item:
+        delta = StatsDelta()
+        delta.item_removed(item.category, item.stock, item.ratingSum, item.ratingCount)
         if item_name:
             item.item_name = item_name
-        if rating:
-            item.rating = rating
         if category:
             item.category = category
         if itemDesc:
@@ -224,8 +555,8 @@ def update_item_by_id(
             item.stock = stock
         if itemPic:
             item.itemPic = itemPic
-        if reviews:
-            item.reviews = reviews
+        delta.item_added(item.category, item.stock, item.ratingSum, item.ratingCount)
+        apply_stats(session, delta)
         session.commit()
         session.refresh(item)
     return item
@@ -233,7 +564,14 @@ def update_item_by_id(
 
 # Delete a user by ID
 def delete_user_by_id(session: Session, id: int) -> Optional[User]:
-    user = session.query(User).filter(User.id == id).first()
+    # The ORM clears the user's item links and orders on delete, so they are
+    # loaded up front instead of lazily
+    user = (
+        session.query(User)
+        .options(selectinload(User.items), selectinload(User.orders))
+        .filter(User.id == id)
+        .first()
+    )
     if user:
         session.delete(user)
         session.commit()
@@ -242,17 +580,86 @@ def delete_user_by_id(session: Session, id: int) -> Optional[User]:
 
 # Delete an item by ID
 def delete_item_by_id(session: Session, itemId: int) -> Optional[Item]:
-    item = session.query(Item).filter(Item.itemId == itemId).first()
+    # Locked, so an outbox worker applying the item's events either commits
+    # first or finds the item gone
+    item = (
+        session.query(Item)
+        .options(selectinload(Item.users))
+        .filter(Item.itemId == itemId)
+        .with_for_update()
+        .first()
+    )
     if item:
+        # The rollups do not count the stock changes of the item's
+        # unprocessed order events yet, which the worker now skips
+        events = session.execute(unprocessed_statement()).all()
+        stock = item.stock - pending_stock(events, itemId)
         session.delete(item)
-        session.commit()
+        delta = StatsDelta()
+        delta.item_removed(item.category, stock, item.ratingSum, item.ratingCount)
+        try:
+            apply_stats(session, delta)
+            session.commit()
+        except IntegrityError:
+            # The item is still referenced by existing orders
+            session.rollback()
+            return None
     return item
 
 
-# Delete an order by ID
+# Delete an order by ID and give its stock back
 def delete_order_by_id(session: Session, orderId: int) -> Optional[Order]:
-    order = session.query(Order).filter(Order.orderId == orderId).first()
+    order = (
+        session.query(Order)
+        .options(selectinload(Order.order_items))
+        .filter(Order.orderId == orderId)
+        .first()
+    )
     if order:
+        # The stock the order reserved goes back in the same transaction
+        quantities = {line.itemId: line.qty for line in order.order_items}
+        categories = dict(session.execute(release_stock(quantities)).all()) if quantities else {}
         session.delete(order)
+        lines = [
+            {"itemId": itemId, "qty": qty, "category": categories[itemId]}
+            for itemId, qty in quantities.items()
+        ]
+        session.add(outbox_event(ORDER_DELETED, orderId, {"lines": lines}))
         session.commit()
     return order
+
+
+# Lease a batch of pending outbox events to the caller, see `claim_statement`
+def claim_outbox_events(
+    session: Session, limit: int, lease: timedelta, max_attempts: int
+) -> list:
+    events = session.execute(claim_statement(limit, lease, max_attempts)).all()
+    session.commit()
+    return sorted(events, key=lambda event: event.eventId)
+
+
+# Apply an outbox event's effects on the database and mark it processed, all
+# in one transaction. False if another worker took the event over meanwhile
+def process_outbox_event(session: Session, event) -> bool:
+    # Share-locked, so the items cannot be deleted before this commits
+    existing = set(session.scalars(existing_items_statement(event_items([event]), lock=True)))
+    apply_stats(session, event_stats(event.kind, event.payload, existing))
+    if session.execute(finish_statement(event)).rowcount != 1:
+        session.rollback()
+        return False
+    session.commit()
+    return True
+
+
+# Give up on an attempt at an outbox event, to be retried after `delay`
+def retry_outbox_event(session: Session, event, error: str, delay: timedelta) -> None:
+    session.rollback()
+    session.execute(retry_statement(event, error, delay))
+    session.commit()
+
+
+# Delete the outbox events processed before `before`
+def purge_outbox_events(session: Session, before: datetime) -> int:
+    purged = session.execute(purge_statement(before))
+    session.commit()
+    return purged.rowcount
@@ -0,0 +1,692 @@
+import asyncio
+from collections import Counter, defaultdict
+from sqlalchemy import Row, case, exists, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+from db.models import User, Item, Order, OrderItem, OrderStatus, Review, EmailTaken, star_rating, user_item_association
+from db.order_listing import order_lines_statement, orders_page_statement
+from db.order_lines import (
+    ORDER_UPDATE_ATTEMPTS,
+    OrderConflict,
+    append_line,
+    claim_order,
+    release_stock,
+    reserve_stock,
+    retry_delay,
+)
+from db.outbox import (
+    ORDER_CREATED,
+    ORDER_DELETED,
+    ORDER_ITEM_ADDED,
+    claim_statement,
+    event_items,
+    event_stats,
+    existing_items_statement,
+    finish_statement,
+    outbox_event,
+    pending_stock,
+    purge_statement,
+    retry_statement,
+    unprocessed_statement,
+    unprocessed_stats,
+)
+from db.search import search_statements, search_total
+from db.stats import StatsDelta, category_stats_statement, rebuild_statements, top_items_statement
+from datetime import date, datetime, timedelta
+from typing import AsyncIterator, Optional
+
+# Async counterparts of db/CRUD.py. Every function issues the same SQL as its
+# sync twin; relationships an async caller touches must be eager loaded,
+# because lazy loads are not possible on an AsyncSession
+
+# Load an order's lines and their items with one indexed join per batch of orders
+order_lines = selectinload(Order.order_items).joinedload(OrderItem.item)
+
+
+# Apply the rollup changes of a transaction, before it commits
+async def apply_stats(session: AsyncSession, delta: StatsDelta):
+    for stmt in delta.statements(session.get_bind().dialect.name):
+        await session.execute(stmt)
+
+
+# Create a new user
+async def create_user(
+    session: AsyncSession,
+    name: str,
+    email: str,
+    phoneNumber: str,
+    address: str,
+    password: str,
+) -> Optional[User]:
+    new_user = User(
+        name=name,
+        email=email,
+        phoneNumber=phoneNumber,
+        address=address,
+        password=password,
+    )
+    session.add(new_user)
+    try:
+        await session.commit()
+    except IntegrityError:
+        # Another request registered the same email first
+        await session.rollback()
+        return None
+    await session.refresh(new_user)
+    return new_user
+
+
+# Create a new item
+async def create_item(
+    session: AsyncSession,
+    item_name: str,
+    category: str,
+    itemDesc: str,
+    stock: int,
+    itemPic: str,
+) -> Item:
+    new_item = Item(
+        item_name=item_name,
+        category=category,
+        itemDesc=itemDesc,
+        stock=stock,
+        itemPic=itemPic,
+    )
+    session.add(new_item)
+    delta = StatsDelta()
+    delta.item_added(category, stock)
+    await apply_stats(session, delta)
+    await session.commit()
+    await session.refresh(new_item)
+    return new_item
+
+
+# Insert many items with batched executemany round trips, no per-row refresh
+async def create_items(session: AsyncSession, items: list[dict]) -> Optional[int]:
+    delta = StatsDelta()
+    for item in items:
+        delta.item_added(item["category"], item["stock"])
+    try:
+        await session.execute(insert(Item), items)
+        await apply_stats(session, delta)
+        await session.commit()
+    except IntegrityError:
+        await session.rollback()
+        return None
+    return len(items)
+
+
+# Create a new order, reserving stock for every item in the same transaction
+async def create_order(
+    session: AsyncSession, userId: int, items: list
+) -> Optional[Order]:
+    # Repeated lines for the same item add up to one line with their total qty
+    quantities = Counter()
+    for item in items:
+        quantities[item["itemId"]] += item.get("qty", 1)
+    if not quantities:
+        return None
+
+    # Check every item exists with a single IN query. The rows are locked in
+    # itemId order so concurrent orders cannot deadlock on the update below
+    categories = dict(
+        (
+            await session.execute(
+                select(Item.itemId, Item.category)
+                .where(Item.itemId.in_(quantities))
+                .order_by(Item.itemId)
+                .with_for_update()
+            )
+        ).all()
+    )
+    if len(categories) != len(quantities):
+        await session.rollback()
+        return None
+
+    # Reserve stock for all items with one conditional bulk UPDATE
+    qty = case(quantities, value=Item.itemId)
+    reserved = await session.execute(
+        update(Item)
+        .where(Item.itemId.in_(quantities), Item.stock >= qty)
+        .values(stock=Item.stock - qty)
+        .execution_options(synchronize_session=False)
+    )
+    if reserved.rowcount != len(quantities):
+        # At least one item does not have enough stock left
+        await session.rollback()
+        return None
+
+    new_order = Order(
+        userId=userId,
+        order_items=[
+            OrderItem(itemId=itemId, qty=qty) for itemId, qty in quantities.items()
+        ],
+    )
+    session.add(new_order)
+    # The rollups are left to the outbox worker, see db/outbox.py
+    await session.flush()
+    lines = [
+        {"itemId": itemId, "qty": qty, "category": categories[itemId]}
+        for itemId, qty in quantities.items()
+    ]
+    session.add(outbox_event(ORDER_CREATED, new_order.orderId, {"lines": lines}))
+    await session.commit()
+    await session.refresh(new_order)
+    return new_order
+
+
+# Add an item to a user. Membership is tested with EXISTS on the
+# association's primary key instead of loading the user's whole collection
+async def add_item_to_user(
+    session: AsyncSession, id: int, itemId: int
+) -> Optional[User]:
+    user = await session.scalar(select(User).where(User.id == id))
+    if not user:
+        return None
+    itemExists, linked = (
+        await session.execute(
+            select(
+                exists().where(Item.itemId == itemId),
+                exists().where(
+                    user_item_association.c.user_id == id,
+                    user_item_association.c.item_id == itemId,
+                ),
+            )
+        )
+    ).one()
+    if not itemExists or linked:
+        return None
+
+    try:
+        await session.execute(
+            insert(user_item_association).values(user_id=id, item_id=itemId)
+        )
+        await session.commit()
+    except IntegrityError:
+        # A concurrent request linked the item first
+        await session.rollback()
+        return None
+    return user
+
+
+# Add one of an item to an order. The order's version is claimed with a
+# compare-and-set, retried a few times when concurrent writers win, the unit
+# is reserved from the item's stock and the line is upserted in one
+# statement, so no concurrent add is lost and the item is never oversold
+async def add_item_to_order(
+    session: AsyncSession, orderId: int, itemId: int
+) -> Optional[Order]:
+    if not await session.scalar(select(exists().where(Item.itemId == itemId))):
+        return None
+
+    dialect = session.get_bind().dialect.name
+    for attempt in range(ORDER_UPDATE_ATTEMPTS):
+        if attempt:
+            await asyncio.sleep(retry_delay(attempt))
+        order = await session.scalar(select(Order).where(Order.orderId == orderId))
+        if not order:
+            return None
+        if order.status != OrderStatus.confirmed:
+            status = order.status.value
+            await session.rollback()
+            raise OrderConflict(f"order is {status}")
+
+        if (await session.execute(claim_order(order))).rowcount == 1:
+            # Reserve the unit like `create_order` does, before the line holds it
+            category = (await session.execute(reserve_stock(itemId))).scalar()
+            if category is None:
+                await session.rollback()
+                if not await session.scalar(select(exists().where(Item.itemId == itemId))):
+                    # The item was deleted since it was checked
+                    return None
+                raise OrderConflict("item is out of stock")
+            qty = (await session.execute(append_line(dialect, orderId, itemId))).scalar_one()
+            # A quantity of 1 is a new line, so one more order holds the item
+            session.add(outbox_event(
+                ORDER_ITEM_ADDED,
+                orderId,
+                {"itemId": itemId, "qty": 1, "category": category, "newLine": qty == 1},
+            ))
+            await session.commit()
+            return order
+        # Another writer changed the order first, read it again
+        await session.rollback()
+    raise OrderConflict("order is being changed by another request, try again")
+
+
+# Add a review to an item. The item's rating sum, count and stars are
+# raised with one atomic UPDATE in the same transaction, which also tells
+# whether the item exists and serializes concurrent reviews of it. Its
+# category's rollup moves with them
+async def create_review(
+    session: AsyncSession, itemId: int, userId: int, rating: int, text: str
+) -> Optional[Review]:
+    category = await session.scalar(
+        update(Item)
+        .where(Item.itemId == itemId)
+        .values(
+            ratingSum=Item.ratingSum + rating,
+            ratingCount=Item.ratingCount + 1,
+            rating=star_rating(Item.ratingSum + rating, Item.ratingCount + 1),
+        )
+        .returning(Item.category)
+        .execution_options(synchronize_session=False)
+    )
+    if category is None:
+        await session.rollback()
+        return None
+    review = Review(itemId=itemId, userId=userId, rating=rating, text=text)
+    session.add(review)
+    delta = StatsDelta()
+    delta.rated(category, rating)
+    await apply_stats(session, delta)
+    await session.commit()
+    await session.refresh(review)
+    return review
+
+
+# Read a page of users ordered by ID, starting after the `after` ID
+async def read_users_page(
+    session: AsyncSession, limit: int, after: Optional[int] = None
+) -> list[User]:
+    query = select(User).order_by(User.id)
+    if after is not None:
+        query = query.where(User.id > after)
+    # Fetch one extra row so the caller can tell whether there is a next page
+    return list(await session.scalars(query.limit(limit + 1)))
+
+
+# Read a page of items ordered by itemId, starting after the `after` itemId
+async def read_items_page(
+    session: AsyncSession, limit: int, after: Optional[int] = None
+) -> list[Item]:
+    query = select(Item).order_by(Item.itemId)
+    if after is not None:
+        query = query.where(Item.itemId > after)
+    # Fetch one extra row so the caller can tell whether there is a next page
+    return list(await session.scalars(query.limit(limit + 1)))
+
+
+# Read a page of an item's reviews, newest first, starting after the
+# `after` reviewId
+async def read_reviews_page(
+    session: AsyncSession, itemId: int, limit: int, after: Optional[int] = None
+) -> list[Review]:
+    query = (
+        select(Review)
+        .where(Review.itemId == itemId)
+        .order_by(Review.reviewId.desc())
+    )
+    if after is not None:
+        query = query.where(Review.reviewId < after)
+    # Fetch one extra row so the caller can tell whether there is a next page
+    return list(await session.scalars(query.limit(limit + 1)))
+
+
+# Read a page of orders matching the filters, in `sort` order and starting
+# after the `after` keyset position, with the lines of each order by its ID.
+# Both are plain rows, building ORM objects would cost most of a large page.
+# See `orders_page_statement`
+async def read_orders_page(
+    session: AsyncSession,
+    limit: int,
+    after: Optional[tuple] = None,
+    sort: str = "orderId",
+    status: Optional[OrderStatus] = None,
+    userId: Optional[int] = None,
+    deliveryFrom: Optional[date] = None,
+    deliveryTo: Optional[date] = None,
+) -> tuple[list[Row], dict[int, list[Row]]]:
+    query = orders_page_statement(
+        limit, after, sort, status, userId, deliveryFrom, deliveryTo
+    )
+    # One extra row is fetched so the caller can tell whether there is a next page
+    orders = list((await session.execute(query)).all())
+    lines = defaultdict(list)
+    if orders:
+        query = order_lines_statement([order.orderId for order in orders])
+        for line in await session.execute(query):
+            lines[line.orderId].append(line)
+    return orders, lines
+
+
+# Stream all users, loading `batch_size` rows per round trip
+async def stream_users(
+    session: AsyncSession, batch_size: int
+) -> AsyncIterator[User]:
+    query = select(User).order_by(User.id).execution_options(yield_per=batch_size)
+    async for user in await session.stream_scalars(query):
+        yield user
+
+
+# Stream all items, loading `batch_size` rows per round trip
+async def stream_items(
+    session: AsyncSession, batch_size: int
+) -> AsyncIterator[Item]:
+    query = select(Item).order_by(Item.itemId).execution_options(yield_per=batch_size)
+    async for item in await session.stream_scalars(query):
+        yield item
+
+
+# Stream all orders, loading `batch_size` rows per round trip
+async def stream_orders(
+    session: AsyncSession, batch_size: int
+) -> AsyncIterator[Order]:
+    query = (
+        select(Order)
+        .options(order_lines)
+        .order_by(Order.orderId)
+        .execution_options(yield_per=batch_size)
+    )
+    async for order in await session.stream_scalars(query):
+        yield order
+
+
+# Read a user by ID
+async def read_user_by_id(session: AsyncSession, id: int) -> Optional[User]:
+    return await session.scalar(select(User).where(User.id == id))
+
+
+# Read a user's version and update time without loading the user
+async def read_user_version(session: AsyncSession, id: int) -> Optional[tuple[int, datetime]]:
+    result = await session.execute(
+        select(User.version, User.updated_at).where(User.id == id)
+    )
+    return result.first()
+
+
+# Read a user by email
+async def read_user_by_email(session: AsyncSession, email: str) -> Optional[User]:
+    return await session.scalar(select(User).where(User.email == email).limit(1))
+
+
+# Read an item by ID
+async def read_item_by_id(session: AsyncSession, itemId: int) -> Optional[Item]:
+    return await session.scalar(select(Item).where(Item.itemId == itemId))
+
+
+# Read the items with the given IDs with a single IN query, in no
+# particular order. IDs without an item are left out
+async def read_items_by_ids(session: AsyncSession, itemIds: list[int]) -> list[Item]:
+    items = await session.scalars(select(Item).where(Item.itemId.in_(itemIds)))
+    return items.all()
+
+
+# Read all items by userId with a single join, an unknown user has no items
+async def read_item_by_userId(session: AsyncSession, userId: int) -> list[Item]:
+    items = await session.scalars(
+        select(Item)
+        .join(user_item_association, Item.itemId == user_item_association.c.item_id)
+        .where(user_item_association.c.user_id == userId)
+    )
+    return items.all()
+
+
+# Read items by category
+async def read_item_by_category(session: AsyncSession, category: str) -> list[Item]:
+    return (await session.scalars(select(Item).where(Item.category == category))).all()
+
+
+# Full-text search over items with filters, ranked results and facet counts
+async def search_items(
+    session: AsyncSession,
+    q: Optional[str] = None,
+    category: Optional[str] = None,
+    min_rating: Optional[int] = None,
+    in_stock: Optional[bool] = None,
+    limit: int = 20,
+    offset: int = 0,
+) -> dict:
+    dialect = session.get_bind().dialect.name
+    results, facet_queries = search_statements(
+        dialect, q, category, min_rating, in_stock, limit, offset
+    )
+    items = [row[0] for row in await session.execute(results)]
+    facets = {}
+    for name, stmt in facet_queries.items():
+        facets[name] = {value: count for value, count in await session.execute(stmt)}
+    return {"items": items, "facets": facets, "total": search_total(facets, category)}
+
+
+# Read the category rollups and the `top` most ordered items, two small
+# queries however large the catalog
+async def read_item_stats(session: AsyncSession, top: int = 10) -> dict:
+    return {
+        "categories": (await session.scalars(category_stats_statement())).all(),
+        "topItems": (await session.execute(top_items_statement(top))).all(),
+    }
+
+
+# Recompute the rollups from the base tables, correcting any drift, less
+# the orders whose outbox events are still to be processed. Both are read in
+# one snapshot: SQLite holds its write lock from the first statement, and
+# Postgres runs the rebuild at REPEATABLE READ, so a rebuild racing the
+# outbox worker on a row fails rather than losing its update
+async def refresh_stats(session: AsyncSession) -> None:
+    dialect = session.get_bind().dialect.name
+    if dialect == "postgresql":
+        await session.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+    for stmt in rebuild_statements(dialect):
+        await session.execute(stmt)
+    events = (await session.execute(unprocessed_statement())).all()
+    existing = set(await session.scalars(existing_items_statement(event_items(events))))
+    await apply_stats(session, unprocessed_stats(events, existing))
+    await session.commit()
+
+
+# Read an order by ID
+async def read_order_by_id(session: AsyncSession, orderId: int) -> Optional[Order]:
+    return await session.scalar(
+        select(Order).options(order_lines).where(Order.orderId == orderId)
+    )
+
+
+# Read the orders with the given IDs and their lines, with one IN query
+# for the orders and one for all their lines
+async def read_orders_by_ids(session: AsyncSession, orderIds: list[int]) -> list[Order]:
+    orders = await session.scalars(
+        select(Order).options(order_lines).where(Order.orderId.in_(orderIds))
+    )
+    return orders.all()
+
+
+# Read what an order's ETag is built from without loading the order: its
+# version and update time, and those of the items its lines embed
+async def read_order_version(session: AsyncSession, orderId: int) -> Optional[tuple]:
+    result = await session.execute(
+        select(Order.version, Order.updated_at, Item.itemId, Item.version, Item.updated_at)
+        .outerjoin(OrderItem, OrderItem.orderId == Order.orderId)
+        .outerjoin(Item, Item.itemId == OrderItem.itemId)
+        .where(Order.orderId == orderId)
+        .order_by(Item.itemId)
+    )
+    rows = result.all()
+    if not rows:
+        return None
+    return rows[0][0], rows[0][1], [tuple(row[2:]) for row in rows if row[2] is not None]
+
+
+# Read all orders that contain an item, using the order_items itemId index
+async def read_orders_by_itemId(session: AsyncSession, itemId: int) -> list[Order]:
+    orders = await session.scalars(
+        select(Order)
+        .options(order_lines)
+        .join(OrderItem, OrderItem.orderId == Order.orderId)
+        .where(OrderItem.itemId == itemId)
+        .order_by(Order.orderId)
+    )
+    return orders.all()
+
+
+# Update a user by ID
+async def update_user_by_id(
+    session: AsyncSession,
+    id: int,
+    name: Optional[str] = None,
+    email: Optional[str] = None,
+    phoneNumber: Optional[str] = None,
+    address: Optional[str] = None,
+) -> Optional[User]:
+    user = await session.scalar(select(User).where(User.id == id))
+    if user:
+        if name:
+            user.name = name
+        if email:
+            user.email = email
+        if phoneNumber:
+            user.phoneNumber = phoneNumber
+        if address:
+            user.address = address
+        try:
+            await session.commit()
+        except IntegrityError:
+            # The unique index on email holds another user's address
+            await session.rollback()
+            raise EmailTaken(email)
+        await session.refresh(user)
+    return user
+
+
+# Replace a user's password hash
+async def update_user_password(session: AsyncSession, id: int, password: str) -> bool:
+    updated = await session.execute(
+        update(User)
+        .where(User.id == id)
+        .values(password=password)
+        .execution_options(synchronize_session=False)
+    )
+    await session.commit()
+    return updated.rowcount == 1
+
+
+# Update an item by ID
+async def update_item_by_id(
+    session: AsyncSession,
+    item_name: str,
+    itemId: int,
+    category: Optional[str] = None,
+    itemDesc: Optional[str] = None,
+    stock: Optional[int] = None,
+    itemPic: Optional[str] = None,
+) -> Optional[Item]:
+    # Locked, so the rollups move from the values this update replaces
+    item = await session.scalar(select(Item).where(Item.itemId == itemId).with_for_update())
+    if item:
+        delta = StatsDelta()
+        delta.item_removed(item.category, item.stock, item.ratingSum, item.ratingCount)
+        if item_name:
+            item.item_name = item_name
+        if category:
+            item.category = category
+        if itemDesc:
+            item.itemDesc = itemDesc
+        if stock:
+            item.stock = stock
+        if itemPic:
+            item.itemPic = itemPic
+        delta.item_added(item.category, item.stock, item.ratingSum, item.ratingCount)
+        await apply_stats(session, delta)
+        await session.commit()
+        await session.refresh(item)
+    return item
+
+
+# Delete a user by ID
+async def delete_user_by_id(session: AsyncSession, id: int) -> Optional[User]:
+    # The ORM clears the user's item links and orders on delete, so they are
+    # loaded up front instead of lazily
+    user = await session.scalar(
+        select(User)
+        .options(selectinload(User.items), selectinload(User.orders))
+        .where(User.id == id)
+    )
+    if user:
+        await session.delete(user)
+        await session.commit()
+    return user
+
+
+# Delete an item by ID
+async def delete_item_by_id(session: AsyncSession, itemId: int) -> Optional[Item]:
+    # Locked, so an outbox worker applying the item's events either commits
+    # first or finds the item gone
+    item = await session.scalar(
+        select(Item)
+        .options(selectinload(Item.users))
+        .where(Item.itemId == itemId)
+        .with_for_update()
+    )
+    if item:
+        # The rollups do not count the stock changes of the item's
+        # unprocessed order events yet, which the worker now skips
+        events = (await session.execute(unprocessed_statement())).all()
+        stock = item.stock - pending_stock(events, itemId)
+        await session.delete(item)
+        delta = StatsDelta()
+        delta.item_removed(item.category, stock, item.ratingSum, item.ratingCount)
+        try:
+            await apply_stats(session, delta)
+            await session.commit()
+        except IntegrityError:
+            # The item is still referenced by existing orders
+            await session.rollback()
+            return None
+    return item
+
+
+# Delete an order by ID and give its stock back
+async def delete_order_by_id(session: AsyncSession, orderId: int) -> Optional[Order]:
+    order = await session.scalar(
+        select(Order)
+        .options(selectinload(Order.order_items))
+        .where(Order.orderId == orderId)
+    )
+    if order:
+        # The stock the order reserved goes back in the same transaction
+        quantities = {line.itemId: line.qty for line in order.order_items}
+        categories = dict((await session.execute(release_stock(quantities))).all()) if quantities else {}
+        await session.delete(order)
+        lines = [
+            {"itemId": itemId, "qty": qty, "category": categories[itemId]}
+            for itemId, qty in quantities.items()
+        ]
+        session.add(outbox_event(ORDER_DELETED, orderId, {"lines": lines}))
+        await session.commit()
+    return order
+
+
+# Lease a batch of pending outbox events to the caller, see `claim_statement`
+async def claim_outbox_events(
+    session: AsyncSession, limit: int, lease: timedelta, max_attempts: int
+) -> list:
+    events = (await session.execute(claim_statement(limit, lease, max_attempts))).all()
+    await session.commit()
+    return sorted(events, key=lambda event: event.eventId)
+
+
+# Apply an outbox event's effects on the database and mark it processed, all
+# in one transaction. False if another worker took the event over meanwhile
+async def process_outbox_event(session: AsyncSession, event) -> bool:
+    # Share-locked, so the items cannot be deleted before this commits
+    existing = set(await session.scalars(existing_items_statement(event_items([event]), lock=True)))
+    await apply_stats(session, event_stats(event.kind, event.payload, existing))
+    if (await session.execute(finish_statement(event))).rowcount != 1:
+        await session.rollback()
+        return False
+    await session.commit()
+    return True
+
+
+# Give up on an attempt at an outbox event, to be retried after `delay`
+async def retry_outbox_event(session: AsyncSession, event, error: str, delay: timedelta) -> None:
+    await session.rollback()
+    await session.execute(retry_statement(event, error, delay))
+    await session.commit()
+
+
+# Delete the outbox events processed before `before`
+async def purge_outbox_events(session: AsyncSession, before: datetime) -> int:
+    purged = await session.execute(purge_statement(before))
+    await session.commit()
+    return purged.rowcount
@@ -0,0 +1,93 @@
+"""
+Awaitable CRUD functions used by the routers.
+
+With DB_MODE=async (the default) these are the native AsyncSession
+implementations from `db.async_CRUD`. With DB_MODE=sync they are the
+blocking `db.CRUD` functions run on Starlette's threadpool, so both paths
+can be benchmarked against each other behind the same routes.
+"""
+from functools import wraps
+from typing import AsyncIterator, Awaitable, Callable, Iterator, ParamSpec, TypeVar
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+from db import CRUD, async_CRUD
+from db.init_db import DB_MODE
+
+P = ParamSpec("P")
+T = TypeVar("T")
+
+
+# Wrap a blocking CRUD function into a coroutine run on the threadpool
+def in_threadpool(fn):
+    @wraps(fn)
+    async def wrapper(*args, **kwargs):
+        return await run_in_threadpool(fn, *args, **kwargs)
+
+    return wrapper
+
+
+# Wrap a blocking CRUD iterator into an async iterator that fetches on the
+# threadpool, including the first round trip made when iteration starts
+def iterate_in_pool(fn):
+    @wraps(fn)
+    async def wrapper(*args, **kwargs):
+        rows = await run_in_threadpool(lambda: iter(fn(*args, **kwargs)))
+        async for row in iterate_in_threadpool(rows):
+            yield row
+
+    return wrapper
+
+
+# Pick the implementation of a CRUD function that returns a single result.
+# Typed after the async one, which is what the routes await either way
+def call(
+    sync_fn: Callable[..., T], async_fn: Callable[P, Awaitable[T]]
+) -> Callable[P, Awaitable[T]]:
+    return async_fn if DB_MODE == "async" else in_threadpool(sync_fn)
+
+
+# Pick the implementation of a CRUD function that returns an iterator of rows
+def stream(
+    sync_fn: Callable[..., Iterator[T]], async_fn: Callable[P, AsyncIterator[T]]
+) -> Callable[P, AsyncIterator[T]]:
+    return async_fn if DB_MODE == "async" else iterate_in_pool(sync_fn)
+
+
+create_user = call(CRUD.create_user, async_CRUD.create_user)
+create_item = call(CRUD.create_item, async_CRUD.create_item)
+create_items = call(CRUD.create_items, async_CRUD.create_items)
+create_order = call(CRUD.create_order, async_CRUD.create_order)
+add_item_to_user = call(CRUD.add_item_to_user, async_CRUD.add_item_to_user)
+add_item_to_order = call(CRUD.add_item_to_order, async_CRUD.add_item_to_order)
+create_review = call(CRUD.create_review, async_CRUD.create_review)
+read_users_page = call(CRUD.read_users_page, async_CRUD.read_users_page)
+read_items_page = call(CRUD.read_items_page, async_CRUD.read_items_page)
+read_orders_page = call(CRUD.read_orders_page, async_CRUD.read_orders_page)
+read_reviews_page = call(CRUD.read_reviews_page, async_CRUD.read_reviews_page)
+read_user_by_id = call(CRUD.read_user_by_id, async_CRUD.read_user_by_id)
+read_user_version = call(CRUD.read_user_version, async_CRUD.read_user_version)
+read_user_by_email = call(CRUD.read_user_by_email, async_CRUD.read_user_by_email)
+read_item_by_id = call(CRUD.read_item_by_id, async_CRUD.read_item_by_id)
+read_items_by_ids = call(CRUD.read_items_by_ids, async_CRUD.read_items_by_ids)
+read_item_by_userId = call(CRUD.read_item_by_userId, async_CRUD.read_item_by_userId)
+read_item_by_category = call(CRUD.read_item_by_category, async_CRUD.read_item_by_category)
+search_items = call(CRUD.search_items, async_CRUD.search_items)
+read_item_stats = call(CRUD.read_item_stats, async_CRUD.read_item_stats)
+read_order_by_id = call(CRUD.read_order_by_id, async_CRUD.read_order_by_id)
+read_orders_by_ids = call(CRUD.read_orders_by_ids, async_CRUD.read_orders_by_ids)
+read_order_version = call(CRUD.read_order_version, async_CRUD.read_order_version)
+read_orders_by_itemId = call(CRUD.read_orders_by_itemId, async_CRUD.read_orders_by_itemId)
+update_user_by_id = call(CRUD.update_user_by_id, async_CRUD.update_user_by_id)
+update_user_password = call(CRUD.update_user_password, async_CRUD.update_user_password)
+update_item_by_id = call(CRUD.update_item_by_id, async_CRUD.update_item_by_id)
+delete_user_by_id = call(CRUD.delete_user_by_id, async_CRUD.delete_user_by_id)
+delete_item_by_id = call(CRUD.delete_item_by_id, async_CRUD.delete_item_by_id)
+delete_order_by_id = call(CRUD.delete_order_by_id, async_CRUD.delete_order_by_id)
+refresh_stats = call(CRUD.refresh_stats, async_CRUD.refresh_stats)
+claim_outbox_events = call(CRUD.claim_outbox_events, async_CRUD.claim_outbox_events)
+process_outbox_event = call(CRUD.process_outbox_event, async_CRUD.process_outbox_event)
+retry_outbox_event = call(CRUD.retry_outbox_event, async_CRUD.retry_outbox_event)
+purge_outbox_events = call(CRUD.purge_outbox_events, async_CRUD.purge_outbox_events)
+
+stream_users = stream(CRUD.stream_users, async_CRUD.stream_users)
+stream_items = stream(CRUD.stream_items, async_CRUD.stream_items)
+stream_orders = stream(CRUD.stream_orders, async_CRUD.stream_orders)
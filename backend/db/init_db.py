@@ -1,14 +1,142 @@
-from sqlalchemy import create_engine
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
 from dotenv import load_dotenv
-from db.models import Base
+from db.pool import TimedAsyncQueuePool, TimedQueuePool
+from utils.metrics import instrument_engine
 import os
 
 # Load environment variables
 load_dotenv()
 
+
+# Read a true/false setting from the environment
+def env_flag(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+# Directory holding alembic.ini and the migrations
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
 # Connection URL for the database
 DATABASE_URL = os.getenv("DATABASE_URL")
 
-engine = create_engine(DATABASE_URL)
-Base.metadata.create_all(engine)
+# "async" serves requests from an AsyncSession on the event loop, "sync"
+# keeps the blocking Session on Starlette's threadpool for benchmarking
+DB_MODE = os.getenv("DB_MODE", "async")
+if DB_MODE not in ("async", "sync"):
+    raise ValueError(f"DB_MODE must be 'async' or 'sync', got {DB_MODE!r}")
+
+# Migrate the schema to the latest revision when the app starts. Turn this
+# off when deploys run `alembic upgrade head` before starting the workers
+DB_CREATE_SCHEMA = env_flag("DB_CREATE_SCHEMA", True)
+
+# Connection pool settings, applied per engine and per worker process, so
+# workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) must stay below the server's
+# connection limit
+POOL_SETTINGS = {
+    "pool_size": int(os.getenv("DB_POOL_SIZE", "5")),
+    "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "10")),
+    "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", "30")),
+    # Replace connections older than this many seconds, -1 disables it
+    "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "1800")),
+    # Test connections on checkout so stale ones are replaced after a failover
+    "pool_pre_ping": env_flag("DB_POOL_PRE_PING", True),
+}
+
+# Async drivers used when ASYNC_DATABASE_URL is not set explicitly
+ASYNC_DRIVERS = {"postgresql": "asyncpg", "sqlite": "aiosqlite"}
+
+
+# Derive the async connection URL from DATABASE_URL by swapping the driver
+def to_async_url(url: str) -> str:
+    url = make_url(url)
+    driver = ASYNC_DRIVERS.get(url.get_backend_name())
+    if driver is None:
+        raise ValueError(f"No async driver known for {url.get_backend_name()}")
+    return url.set(drivername=f"{url.get_backend_name()}+{driver}").render_as_string(
+        hide_password=False
+    )
+
+
+engine = create_engine(DATABASE_URL, poolclass=TimedQueuePool, **POOL_SETTINGS)
+
+# The async engine is only built in async mode, so the sync path does not
+# need an async driver installed
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL") or to_async_url(DATABASE_URL)
+async_engine = (
+    create_async_engine(
+        ASYNC_DATABASE_URL, poolclass=TimedAsyncQueuePool, **POOL_SETTINGS
+    )
+    if DB_MODE == "async"
+    else None
+)
+
+
+# SQLite leaves foreign keys unenforced unless each connection turns them on
+def enforce_foreign_keys(engine):
+    if engine.dialect.name != "sqlite":
+        return
+
+    @event.listens_for(engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+
+enforce_foreign_keys(engine)
+if async_engine is not None:
+    enforce_foreign_keys(async_engine.sync_engine)
+
+# Attribute the time and count of statements to the request issuing them
+instrument_engine(engine)
+if async_engine is not None:
+    instrument_engine(async_engine.sync_engine)
+
+
+# Alembic configuration of the migrations shipped with the backend
+def alembic_config(connection=None) -> Config:
+    config = Config(os.path.join(BACKEND_DIR, "alembic.ini"))
+    config.attributes["connection"] = connection
+    return config
+
+
+# Upgrade the database to the latest migration
+def create_schema():
+    with engine.connect() as connection:
+        # Batch migrations copy a SQLite table and drop the original, which
+        # enforced foreign keys would refuse or cascade to the rows pointing
+        # at it. The pragma is ignored inside a transaction
+        sqlite = connection.dialect.name == "sqlite"
+        if sqlite:
+            connection.exec_driver_sql("PRAGMA foreign_keys=OFF")
+            connection.commit()
+        try:
+            with connection.begin():
+                command.upgrade(alembic_config(connection), "head")
+        finally:
+            if sqlite:
+                connection.exec_driver_sql("PRAGMA foreign_keys=ON")
+                connection.commit()
+
+
+# Close every pooled connection, e.g. on shutdown
+async def dispose_engines():
+    if async_engine is not None:
+        await async_engine.dispose()
+    engine.dispose()
+
 
+# Pool metrics of the engine serving requests in the configured DB_MODE
+def pool_status() -> dict:
+    if async_engine is not None:
+        pool = async_engine.sync_engine.pool
+    else:
+        pool = engine.pool
+    return {"mode": DB_MODE, **pool.metrics.snapshot(pool)}
@@ -1,7 +1,9 @@
-from sqlalchemy import Table, Column, Integer, String, ForeignKey, Date, Enum, Text, ARRAY, JSON
+from sqlalchemy import Table, Column, Integer, String, ForeignKey, Date, DateTime, Enum, Text, JSON, DDL, Index, event, func, literal_column
+from sqlalchemy.dialects import postgresql  # registers func.to_tsvector() and friends
 from sqlalchemy.orm import declarative_base, relationship
 import enum
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from typing import Optional
 
 # Possible order status values
 class OrderStatus(enum.Enum):
@@ -11,11 +13,32 @@ class OrderStatus(enum.Enum):
 
 Base = declarative_base()
 
+# Current time for `updated_at`, always in UTC
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+# Row version, raised by one on every UPDATE of the row, including bulk
+# UPDATE statements, which fire `onupdate` for columns they do not set
+def version_column():
+    return Column(Integer, nullable=False, default=1, server_default="1", onupdate=literal_column("version") + 1)
+
+# Time of the row's last UPDATE, maintained like `version`
+def updated_at_column():
+    return Column(DateTime(timezone=True), nullable=False, default=utcnow, onupdate=utcnow)
+
+# Tables with a surrogate key are declared with SQLite's AUTOINCREMENT, so
+# the ID of a deleted row is never handed out again to a new one
+
+# Relationships never load lazily. Every query states how it loads the
+# relationships its caller touches, e.g. `order_lines` in db/CRUD.py, so a
+# missing loader option raises instead of quietly issuing a query per row
+
 user_item_association = Table(
     'user_item_association',
     Base.metadata,
     Column('user_id', Integer, ForeignKey('users.id'), primary_key=True),
-    Column('item_id', Integer, ForeignKey('items.itemId'), primary_key=True)
+    # The primary key leads with user_id, so "which users saved item X" needs its own index
+    Column('item_id', Integer, ForeignKey('items.itemId'), primary_key=True, index=True)
 )
 
 class User(Base):
@@ -24,29 +47,191 @@ class User(Base):
     name = Column(String, nullable=False)
     phoneNumber = Column(String)
     address = Column(String)
-    email = Column(String, nullable=False)
+    email = Column(String, nullable=False, unique=True, index=True)
     password = Column(String, nullable=False)
     rating = Column(Integer)
-    items = relationship("Item", secondary=user_item_association, back_populates="users")
-    orders = relationship("Order", back_populates="users")
+    version = version_column()
+    updated_at = updated_at_column()
+    items = relationship("Item", secondary=user_item_association, back_populates="users", lazy="raise_on_sql")
+    orders = relationship("Order", back_populates="users", lazy="raise_on_sql")
+    __table_args__ = {"sqlite_autoincrement": True}
+
+
+class EmailTaken(Exception):
+    """
+    Raised when a user's email is changed to one another user already has.
+    """
+
+# Postgres full-text document built from an item's name and description
+def to_search_document(item_name, itemDesc):
+    return func.to_tsvector(
+        literal_column("'english'::regconfig"),
+        item_name.op("||")(literal_column("' '")).op("||")(itemDesc),
+    )
+
+# Average of an item's review ratings, None before its first rating
+def average_rating(ratingSum: int, ratingCount: int) -> Optional[float]:
+    return ratingSum / ratingCount if ratingCount else None
+
+# The average rating in whole stars, rounded down, as a SQL expression over
+# rating sum and count columns. NULL before the first rating
+def star_rating(ratingSum, ratingCount):
+    return ratingSum // func.nullif(ratingCount, 0, type_=Integer)
 
 class Item(Base):
     __tablename__ = 'items'
     itemId = Column(Integer, primary_key=True, unique=True, nullable=False)
     item_name = Column(String, nullable=False)
+    # `star_rating` of the columns below, set along with them by every new
+    # review. Search and the rollups read the sum and count themselves
     rating = Column(Integer)
-    category = Column(String, nullable=False)
+    category = Column(String, nullable=False, index=True)
     itemDesc = Column(Text, nullable=False)
     stock = Column(Integer, nullable=False)
     itemPic = Column(String, nullable=False)
-    reviews = Column(ARRAY(String))
-    users = relationship("User", secondary=user_item_association, back_populates="items")
+    # Sum and count of the ratings in the item's reviews, raised by every
+    # new review, so the average never reads the reviews back
+    ratingSum = Column(Integer, nullable=False, default=0, server_default="0")
+    ratingCount = Column(Integer, nullable=False, default=0, server_default="0")
+    version = version_column()
+    updated_at = updated_at_column()
+    users = relationship("User", secondary=user_item_association, back_populates="items", lazy="raise_on_sql")
+    __table_args__ = (
+        Index("ix_items_search", to_search_document(item_name, itemDesc), postgresql_using="gin").ddl_if(dialect="postgresql"),
+        {"sqlite_autoincrement": True},
+    )
+
+    @property
+    def averageRating(self) -> Optional[float]:
+        return average_rating(self.ratingSum, self.ratingCount)
 
 class Order(Base):
     __tablename__ = 'orders'
     orderId = Column(Integer, primary_key=True, unique=True, nullable=False)
     status = Column(Enum(OrderStatus), default=OrderStatus.confirmed)
     deliveryDate = Column(Date, default=datetime.now() + timedelta(days=7))
-    items = Column(JSON, nullable=False)
     userId = Column(Integer, ForeignKey('users.id'), nullable=False)
-    users = relationship("User", back_populates="orders")
+    # Raised whenever the order's lines change too, not only the order row
+    version = version_column()
+    updated_at = updated_at_column()
+    users = relationship("User", back_populates="orders", lazy="raise_on_sql")
+    order_items = relationship("OrderItem", back_populates="order", cascade="all, delete-orphan", lazy="raise_on_sql")
+    # The keysets of the order listings, see db/order_listing.py, after the
+    # equality filters they are used with
+    __table_args__ = (
+        Index("ix_orders_userId_orderId", userId, orderId),
+        Index("ix_orders_status_deliveryDate", status, deliveryDate, orderId),
+        Index("ix_orders_deliveryDate", deliveryDate, orderId),
+        {"sqlite_autoincrement": True},
+    )
+
+# One line of an order. The primary key doubles as the index for reading an
+# order's lines, `ix_order_items_itemId` serves "which orders contain item X"
+class OrderItem(Base):
+    __tablename__ = 'order_items'
+    orderId = Column(Integer, ForeignKey('orders.orderId', ondelete='CASCADE'), primary_key=True)
+    itemId = Column(Integer, ForeignKey('items.itemId'), primary_key=True, index=True)
+    qty = Column(Integer, nullable=False, default=1)
+    order = relationship("Order", back_populates="order_items", lazy="raise_on_sql")
+    item = relationship("Item", lazy="raise_on_sql")
+
+# A review of an item, read newest first a page at a time through
+# `ix_reviews_itemId_reviewId`. Reviews carried over from the old
+# `items.reviews` list have no user or rating
+class Review(Base):
+    __tablename__ = 'reviews'
+    reviewId = Column(Integer, primary_key=True)
+    itemId = Column(Integer, ForeignKey('items.itemId', ondelete='CASCADE'), nullable=False)
+    userId = Column(Integer, ForeignKey('users.id', ondelete='SET NULL'))
+    rating = Column(Integer)
+    text = Column(Text, nullable=False)
+    created_at = Column(DateTime(timezone=True), nullable=False, default=utcnow)
+    __table_args__ = (
+        Index("ix_reviews_itemId_reviewId", itemId, reviewId),
+        {"sqlite_autoincrement": True},
+    )
+
+# Rollups of the catalog per category, kept up to date through
+# `db.stats.StatsDelta` by the item write paths of db/CRUD.py and by the
+# outbox worker for orders, and rebuilt by the periodic refresher. The
+# average rating is `ratingSum / ratingCount`, over every rating of the
+# category's items
+class CategoryStats(Base):
+    __tablename__ = 'category_stats'
+    category = Column(String, primary_key=True)
+    itemCount = Column(Integer, nullable=False, default=0)
+    stockTotal = Column(Integer, nullable=False, default=0)
+    ratingSum = Column(Integer, nullable=False, default=0)
+    ratingCount = Column(Integer, nullable=False, default=0)
+
+# Rollups of the orders per item, maintained like CategoryStats. The index
+# serves the top sellers
+class ItemStats(Base):
+    __tablename__ = 'item_stats'
+    itemId = Column(Integer, ForeignKey('items.itemId', ondelete='CASCADE'), primary_key=True)
+    orderCount = Column(Integer, nullable=False, default=0)
+    unitsOrdered = Column(Integer, nullable=False, default=0)
+    __table_args__ = (
+        Index("ix_item_stats_orderCount", orderCount, itemId),
+    )
+
+# A side effect of a committed change, written in the same transaction as
+# the change and carried out afterwards by the worker in api/v1/orders/outbox.py.
+# `idempotencyKey` names the change, so consumers that see an event twice
+# can tell. The partial index serves the worker's claims of pending events
+class OutboxEvent(Base):
+    __tablename__ = 'outbox_events'
+    eventId = Column(Integer, primary_key=True)
+    kind = Column(String, nullable=False)
+    idempotencyKey = Column(String, nullable=False, unique=True)
+    payload = Column(JSON, nullable=False)
+    created_at = Column(DateTime(timezone=True), nullable=False, default=utcnow)
+    # Not claimed before this time, set by a worker's lease or a retry's backoff
+    available_at = Column(DateTime(timezone=True), nullable=False, default=utcnow)
+    attempts = Column(Integer, nullable=False, default=0)
+    processed_at = Column(DateTime(timezone=True))
+    last_error = Column(Text)
+    __table_args__ = (
+        Index(
+            "ix_outbox_events_pending",
+            available_at,
+            eventId,
+            postgresql_where=processed_at.is_(None),
+            sqlite_where=processed_at.is_(None),
+        ),
+        {"sqlite_autoincrement": True},
+    )
+
+# Full-text search document for an item, used by the GIN index on items.
+# Queries must use this exact expression for Postgres to pick the index
+search_document = to_search_document(Item.item_name, Item.itemDesc)
+
+# SQLite has no tsvector, so an FTS5 index over the same columns stands in
+# for it, kept in sync with `items` by triggers
+SQLITE_FTS_DDL = [
+    """CREATE VIRTUAL TABLE items_fts USING fts5(
+        item_name, itemDesc, content='items', content_rowid='itemId',
+        tokenize='porter unicode61'
+    )""",
+    """CREATE TRIGGER items_fts_insert AFTER INSERT ON items BEGIN
+        INSERT INTO items_fts(rowid, item_name, itemDesc)
+        VALUES (new.itemId, new.item_name, new.itemDesc);
+    END""",
+    """CREATE TRIGGER items_fts_delete AFTER DELETE ON items BEGIN
+        INSERT INTO items_fts(items_fts, rowid, item_name, itemDesc)
+        VALUES ('delete', old.itemId, old.item_name, old.itemDesc);
+    END""",
+    """CREATE TRIGGER items_fts_update AFTER UPDATE OF item_name, itemDesc ON items BEGIN
+        INSERT INTO items_fts(items_fts, rowid, item_name, itemDesc)
+        VALUES ('delete', old.itemId, old.item_name, old.itemDesc);
+        INSERT INTO items_fts(rowid, item_name, itemDesc)
+        VALUES (new.itemId, new.item_name, new.itemDesc);
+    END""",
+]
+for statement in SQLITE_FTS_DDL:
+    event.listen(Item.__table__, "after_create", DDL(statement).execute_if(dialect="sqlite"))
+event.listen(
+    Item.__table__,
+    "after_drop",
+    DDL("DROP TABLE IF EXISTS items_fts").execute_if(dialect="sqlite"),
+)
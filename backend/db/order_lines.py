@@ -0,0 +1,105 @@
+import random
+from sqlalchemy import Insert, Update, case, update
+from db.models import Item, Order, OrderItem, OrderStatus
+from db.upsert import dialect_insert
+
+# Times a writer re-reads an order that another request changed under it
+# before giving up with OrderConflict
+ORDER_UPDATE_ATTEMPTS = 5
+# Base of the exponential backoff between attempts, in seconds
+ORDER_RETRY_DELAY = 0.005
+
+
+class OrderConflict(Exception):
+    """
+    Raised when an order cannot take the change, because it is no longer
+    open or because concurrent writers kept winning every attempt.
+    """
+
+
+# Full-jitter backoff before the next attempt, so writers that lost together
+# do not all retry together
+def retry_delay(attempt: int) -> float:
+    return random.uniform(0, ORDER_RETRY_DELAY * 2**attempt)
+
+
+def claim_order(order: Order) -> Update:
+    """
+    Builds the compare-and-set UPDATE that raises an order's version.
+
+    It matches only while the order still has the version and open status
+    the caller read, so exactly one of several concurrent writers wins and
+    the others see a rowcount of 0. Holding the row lock until commit keeps
+    the rest of the transaction ordered behind any writer that won.
+
+    :param order: The order as read at the start of the attempt.
+    """
+    return (
+        update(Order)
+        .where(
+            Order.orderId == order.orderId,
+            Order.version == order.version,
+            Order.status == OrderStatus.confirmed,
+        )
+        .values(version=Order.version + 1)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def reserve_stock(itemId: int, qty: int = 1) -> Update:
+    """
+    Builds the conditional UPDATE that takes `qty` units of an item's stock.
+
+    It matches only while the item has that much stock left, like the
+    reservation of `create_order`, so a rowcount of 0 means the item is out
+    of stock or gone. It returns the item's category for the rollups.
+
+    :param itemId: The item to reserve.
+    :param qty: The quantity to reserve.
+    """
+    return (
+        update(Item)
+        .where(Item.itemId == itemId, Item.stock >= qty)
+        .values(stock=Item.stock - qty)
+        .returning(Item.category)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def release_stock(quantities: dict[int, int]) -> Update:
+    """
+    Builds the bulk UPDATE that gives the stock of deleted order lines back.
+
+    One statement covers every item of the order, with a CASE on the
+    itemId, like the reservation of `create_order`. It returns each item's
+    ID and category for the rollups.
+
+    :param quantities: The quantity to give back per itemId.
+    """
+    return (
+        update(Item)
+        .where(Item.itemId.in_(quantities))
+        .values(stock=Item.stock + case(quantities, value=Item.itemId))
+        .returning(Item.itemId, Item.category)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def append_line(dialect: str, orderId: int, itemId: int, qty: int = 1) -> Insert:
+    """
+    Builds a single-statement upsert of an order line.
+
+    A new item gets its own line, an item the order already holds has its
+    quantity raised in place, so no read-modify-write of the line happens
+    in Python. It returns the line's new quantity, equal to `qty` for a new line.
+
+    :param dialect: The database dialect name.
+    :param orderId: The order to add to.
+    :param itemId: The item to add.
+    :param qty: The quantity to add.
+    """
+    stmt = dialect_insert(dialect)(OrderItem).values(orderId=orderId, itemId=itemId, qty=qty)
+    return stmt.on_conflict_do_update(
+        index_elements=[OrderItem.orderId, OrderItem.itemId],
+        set_={"qty": OrderItem.qty + stmt.excluded.qty},
+    ).returning(OrderItem.qty)
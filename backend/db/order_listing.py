@@ -0,0 +1,88 @@
+from datetime import date
+from typing import Optional
+from sqlalchemy import Select, select, tuple_
+from db.models import Item, Order, OrderItem, OrderStatus
+
+# Keysets the order listings can be sorted by, as the `sort` query value
+# without its "-" for descending. Each names its columns and their types,
+# the columns being unique together so that pages never overlap. Each is
+# served by an index, alone or after an equality filter
+ORDER_SORTS = {
+    "orderId": {"orderId": int},
+    "deliveryDate": {"deliveryDate": date, "orderId": int},
+}
+# Pattern of the `sort` query parameter
+ORDER_SORT_PATTERN = "^-?(" + "|".join(ORDER_SORTS) + ")$"
+
+# Columns of an order read by the listings, the sort columns included
+LISTING_COLUMNS = (Order.orderId, Order.userId, Order.deliveryDate)
+# Columns of an order line read by the listings, with its item's details
+LINE_COLUMNS = (
+    OrderItem.orderId,
+    OrderItem.qty,
+    Item.itemId,
+    Item.item_name,
+    Item.rating,
+    Item.category,
+    Item.itemDesc,
+    Item.stock,
+    Item.itemPic,
+    Item.ratingSum,
+    Item.ratingCount,
+)
+
+
+def orders_page_statement(
+    limit: int,
+    after: Optional[tuple] = None,
+    sort: str = "orderId",
+    status: Optional[OrderStatus] = None,
+    userId: Optional[int] = None,
+    deliveryFrom: Optional[date] = None,
+    deliveryTo: Optional[date] = None,
+) -> Select:
+    """
+    Builds the query of one page of a filtered, sorted order listing, as
+    rows of LISTING_COLUMNS. Their lines are read by `order_lines_statement`.
+
+    Filtering, sorting and paging all happen in SQL. Pages are keyset
+    pages: `after` is compared with the sort columns as a row value, so a
+    deep page costs the same as the first.
+
+    :param limit: The page size. One more row is fetched, for `next_cursor`.
+    :param after: The sort column values of the last row of the previous page.
+    :param sort: A key of ORDER_SORTS, prefixed with "-" for descending.
+    :param status: Only orders with this status.
+    :param userId: Only orders of this user.
+    :param deliveryFrom: Only orders delivered on or after this date.
+    :param deliveryTo: Only orders delivered on or before this date.
+    """
+    descending = sort.startswith("-")
+    columns = [getattr(Order, name) for name in ORDER_SORTS[sort.lstrip("-")]]
+
+    stmt = select(*LISTING_COLUMNS)
+    if status is not None:
+        stmt = stmt.where(Order.status == status)
+    if userId is not None:
+        stmt = stmt.where(Order.userId == userId)
+    if deliveryFrom is not None:
+        stmt = stmt.where(Order.deliveryDate >= deliveryFrom)
+    if deliveryTo is not None:
+        stmt = stmt.where(Order.deliveryDate <= deliveryTo)
+    if after is not None:
+        key = tuple_(*columns)
+        stmt = stmt.where(key < tuple_(*after) if descending else key > tuple_(*after))
+
+    order = [column.desc() if descending else column for column in columns]
+    return stmt.order_by(*order).limit(limit + 1)
+
+
+# Lines of a page of orders with their items' details, in one indexed join.
+# The listings read them as plain rows, which skips building ORM objects
+def order_lines_statement(orderIds: list[int]) -> Select:
+    return (
+        select(*LINE_COLUMNS)
+        .join(Item, Item.itemId == OrderItem.itemId)
+        .where(OrderItem.orderId.in_(orderIds))
+        .order_by(OrderItem.orderId, OrderItem.itemId)
+    )
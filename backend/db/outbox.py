@@ -0,0 +1,208 @@
+from datetime import datetime, timedelta
+from typing import Container
+from uuid import uuid4
+from sqlalchemy import Delete, Select, Update, delete, select, update
+from db.models import Item, OutboxEvent, utcnow
+from db.stats import StatsDelta
+
+# Kinds of the order events, written by the order write paths of db/CRUD.py
+ORDER_CREATED = "order.created"
+ORDER_ITEM_ADDED = "order.item_added"
+ORDER_DELETED = "order.deleted"
+
+# Longest error message kept on an event that failed
+MAX_ERROR_LENGTH = 1000
+
+
+def outbox_event(kind: str, orderId: int, payload: dict) -> OutboxEvent:
+    """
+    Builds an event for the caller to add to its session before it commits.
+
+    :param kind: One of the kinds above.
+    :param orderId: The order that changed, part of the idempotency key.
+    :param payload: What the consumers need to know, as JSON values.
+    """
+    return OutboxEvent(
+        kind=kind,
+        idempotencyKey=f"{kind}:{orderId}:{uuid4().hex}",
+        payload={"orderId": orderId, **payload},
+    )
+
+
+def event_lines(kind: str, payload: dict) -> list[dict]:
+    """
+    Lists the order lines an event changed, each with the `itemId`, the
+    `qty` taken from stock, negative when given back, the `orders` now
+    holding the item and, unless written before stock moved, the `category`.
+
+    :param kind: The event's kind.
+    :param payload: The event's payload.
+    """
+    if kind == ORDER_CREATED:
+        return [{**line, "orders": 1} for line in payload["lines"]]
+    if kind == ORDER_ITEM_ADDED:
+        # Events written before items added to an order reserved stock
+        # carry no category
+        line = {key: payload[key] for key in ("itemId", "qty", "category") if key in payload}
+        return [{**line, "orders": 1 if payload["newLine"] else 0}]
+    if kind == ORDER_DELETED:
+        # The qty went back to stock. Events written before deletions gave
+        # stock back carry no category
+        return [{**line, "qty": -line["qty"], "orders": -1} for line in payload["lines"]]
+    return []
+
+
+def event_stats(kind: str, payload: dict, items: Container[int]) -> StatsDelta:
+    """
+    Builds the rollup changes of an order event, see db/stats.py.
+
+    Lines of items deleted since are skipped: the item's rollups went with
+    it, and `delete_item_by_id` took its stock out of its category as the
+    rollups counted it, before its unprocessed events.
+
+    :param kind: The event's kind.
+    :param payload: The event's payload.
+    :param items: The IDs of the event's items that still exist, see
+        `existing_items_statement`.
+    """
+    delta = StatsDelta()
+    for line in event_lines(kind, payload):
+        if line["itemId"] not in items:
+            continue
+        if "category" in line:
+            delta.stock_changed(line["category"], -line["qty"])
+        delta.ordered(line["itemId"], line["qty"], orders=line["orders"])
+    return delta
+
+
+# IDs of the items the lines of `events` point at
+def event_items(events) -> set[int]:
+    return {line["itemId"] for event in events for line in event_lines(event.kind, event.payload)}
+
+
+def existing_items_statement(itemIds: set[int], lock: bool = False) -> Select:
+    """
+    Builds the query of which of the given items still exist.
+
+    :param itemIds: The items to look for, e.g. from `event_items`.
+    :param lock: Share-lock the rows, so an item deleted concurrently is
+        either gone already or deleted only once the caller commits.
+    """
+    stmt = select(Item.itemId).where(Item.itemId.in_(itemIds))
+    return stmt.with_for_update(read=True) if lock else stmt
+
+
+def pending_stock(events, itemId: int) -> int:
+    """
+    Sums the stock changes of an item that unprocessed events still owe
+    its category's rollup, negative for stock they will take out.
+
+    :param events: Rows of `unprocessed_statement`.
+    :param itemId: The item.
+    """
+    delta = StatsDelta()
+    for event in events:
+        delta.add(event_stats(event.kind, event.payload, {itemId}))
+    return sum(counters["stockTotal"] for counters in delta.categories.values())
+
+
+# Events not processed yet, whose changes to the rollups are still to come
+def unprocessed_statement() -> Select:
+    return select(OutboxEvent.kind, OutboxEvent.payload).where(OutboxEvent.processed_at.is_(None))
+
+
+def unprocessed_stats(events, items: Container[int]) -> StatsDelta:
+    """
+    Builds the rollup changes that take unprocessed events back out.
+
+    An order's rows commit together with its event, but its rollup changes
+    only apply once the worker processes the event. A rebuild from the
+    base tables counts every committed order, so it subtracts the events
+    still unprocessed, in the same snapshot, and the worker then counts
+    each of them once. Events given up on stay subtracted, as their
+    changes never apply. Lines of deleted items are skipped, as the worker
+    skips them.
+
+    :param events: Rows of `unprocessed_statement`.
+    :param items: The IDs of the events' items that still exist.
+    """
+    delta = StatsDelta()
+    for event in events:
+        delta.add(event_stats(event.kind, event.payload, items), sign=-1)
+    return delta
+
+
+def claim_statement(limit: int, lease: timedelta, max_attempts: int) -> Update:
+    """
+    Builds the UPDATE that leases a batch of pending events to one worker.
+
+    Claimed events are not claimed again until the lease runs out, so an
+    event whose worker died is picked up by another one. Rows locked by a
+    concurrent claim are skipped rather than waited for. Each claim counts
+    as an attempt, and events out of attempts are left for an operator.
+
+    :param limit: The most events to claim.
+    :param lease: How long the worker has to finish the batch.
+    :param max_attempts: Attempts after which an event is given up on.
+    """
+    now = utcnow()
+    pending = (
+        select(OutboxEvent.eventId)
+        .where(
+            OutboxEvent.processed_at.is_(None),
+            OutboxEvent.available_at <= now,
+            OutboxEvent.attempts < max_attempts,
+        )
+        .order_by(OutboxEvent.available_at, OutboxEvent.eventId)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    return (
+        update(OutboxEvent)
+        .where(OutboxEvent.eventId.in_(pending))
+        .values(available_at=now + lease, attempts=OutboxEvent.attempts + 1)
+        .returning(
+            OutboxEvent.eventId,
+            OutboxEvent.kind,
+            OutboxEvent.idempotencyKey,
+            OutboxEvent.payload,
+            OutboxEvent.attempts,
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+
+# Conditions that the caller still holds the claim it made on an event: the
+# event is pending and no other worker claimed it since
+def held(event) -> tuple:
+    return (
+        OutboxEvent.eventId == event.eventId,
+        OutboxEvent.processed_at.is_(None),
+        OutboxEvent.attempts == event.attempts,
+    )
+
+
+# Mark a claimed event processed. Run in the transaction of its effects, a
+# rowcount of 0 means the claim was lost and the effects must roll back
+def finish_statement(event) -> Update:
+    return (
+        update(OutboxEvent)
+        .where(*held(event))
+        .values(processed_at=utcnow(), last_error=None)
+        .execution_options(synchronize_session=False)
+    )
+
+
+# Give a claimed event back to be retried after `delay`
+def retry_statement(event, error: str, delay: timedelta) -> Update:
+    return (
+        update(OutboxEvent)
+        .where(*held(event))
+        .values(available_at=utcnow() + delay, last_error=error[:MAX_ERROR_LENGTH])
+        .execution_options(synchronize_session=False)
+    )
+
+
+# Delete events processed before `before`
+def purge_statement(before: datetime) -> Delete:
+    return delete(OutboxEvent).where(OutboxEvent.processed_at < before)
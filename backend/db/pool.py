@@ -0,0 +1,84 @@
+import time
+from threading import Lock
+from sqlalchemy import exc
+from sqlalchemy.pool import AsyncAdaptedQueuePool, Pool, QueuePool
+
+
+class PoolMetrics:
+    """
+    Counters for connection checkouts from one pool.
+
+    Checkout wait is the time a caller spent inside the pool before it got
+    a connection, which grows once every pooled connection is in use and
+    callers queue for one.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def record_checkout(self, wait: float):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+
+    def record_timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def snapshot(self, pool: Pool) -> dict:
+        """
+        Returns the counters together with the pool's current occupancy.
+
+        :param pool: The pool these metrics were recorded for.
+        :return: A JSON-serializable dictionary.
+        """
+        with self._lock:
+            avg = self.wait_total / self.checkouts if self.checkouts else 0.0
+            return {
+                "size": pool.size(),
+                "in_use": pool.checkedout(),
+                "idle": pool.checkedin(),
+                "overflow": pool.overflow(),
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "wait_avg_ms": round(avg * 1000, 3),
+                "wait_max_ms": round(self.wait_max * 1000, 3),
+            }
+
+
+class TimedCheckout:
+    """
+    Pool mixin that records how long each checkout waited.
+
+    Each pool keeps its own metrics, so engines sharing a pool class do not
+    mix their counts. A pool recreated by `engine.dispose()` starts over.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            self.metrics.record_timeout()
+            raise
+        self.metrics.record_checkout(time.perf_counter() - start)
+        return connection
+
+
+# Queue pool for the sync engine
+class TimedQueuePool(TimedCheckout, QueuePool):
+    pass
+
+
+# Queue pool for the async engine
+class TimedAsyncQueuePool(TimedCheckout, AsyncAdaptedQueuePool):
+    pass
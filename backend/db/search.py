@@ -0,0 +1,123 @@
+import re
+from typing import Optional
+from sqlalchemy import Select, column, func, literal_column, select, table
+from db.models import Item, search_document, star_rating
+
+# The FTS5 table SQLite uses in place of the Postgres GIN index
+items_fts = table("items_fts", column("rowid"))
+
+SEARCH_CONFIG = literal_column("'english'::regconfig")
+
+
+def sqlite_match_query(q: str) -> str:
+    """
+    Turns free text into an FTS5 query that cannot be a syntax error.
+
+    Every word is quoted and prefix-matched, and all words must match.
+
+    :param q: The text typed by the user.
+    :return: An FTS5 MATCH expression, empty if `q` has no words.
+    """
+    words = re.findall(r"\w+", q)
+    return " ".join(f'"{word}"*' for word in words)
+
+
+def text_match(select_stmt: Select, dialect: str, q: str) -> tuple[Select, object]:
+    """
+    Restricts a statement over `items` to rows matching `q`.
+
+    :param select_stmt: A select whose FROM clause includes `items`.
+    :param dialect: The database dialect name.
+    :param q: The full-text query.
+    :return: The filtered statement and a relevance expression where a
+        higher value means a better match.
+    """
+    if dialect == "postgresql":
+        query = func.websearch_to_tsquery(SEARCH_CONFIG, q)
+        rank = func.ts_rank_cd(search_document, query)
+        return select_stmt.where(search_document.op("@@")(query)), rank
+    if dialect == "sqlite":
+        # bm25() is lower for better matches
+        rank = -func.bm25(literal_column("items_fts"))
+        filtered = select_stmt.join(items_fts, items_fts.c.rowid == Item.itemId).where(
+            literal_column("items_fts").op("MATCH")(sqlite_match_query(q))
+        )
+        return filtered, rank
+    raise NotImplementedError(f"Full-text search is not supported on {dialect}")
+
+
+def filter_conditions(
+    category: Optional[str], min_rating: Optional[int], in_stock: Optional[bool]
+) -> dict:
+    """
+    Builds the WHERE condition for each filter the client sent.
+
+    Conditions are keyed by facet name, so each facet can be counted with
+    every filter except its own.
+    """
+    conditions = {}
+    if category is not None:
+        conditions["category"] = Item.category == category
+    if min_rating is not None:
+        # The average rating is at least `min_rating`, without a division
+        conditions["rating"] = (Item.ratingCount > 0) & (Item.ratingSum >= min_rating * Item.ratingCount)
+    if in_stock is not None:
+        conditions["in_stock"] = Item.stock > 0 if in_stock else Item.stock <= 0
+    return conditions
+
+
+def search_statements(
+    dialect: str,
+    q: Optional[str],
+    category: Optional[str],
+    min_rating: Optional[int],
+    in_stock: Optional[bool],
+    limit: int,
+    offset: int,
+) -> tuple[Select, dict[str, Select]]:
+    """
+    Builds the ranked result query and one count query per facet.
+
+    :return: A select of rows whose first column is the Item, best match
+        first, and selects of `(facet value, count)` rows keyed by facet name.
+    """
+    conditions = filter_conditions(category, min_rating, in_stock)
+    facet_columns = {
+        "category": Item.category,
+        "rating": star_rating(Item.ratingSum, Item.ratingCount).label("rating"),
+        "in_stock": (Item.stock > 0).label("in_stock"),
+    }
+
+    # A query without any word characters matches everything
+    has_text = q is not None and re.search(r"\w", q) is not None
+
+    def restrict(stmt: Select, skip: Optional[str] = None):
+        stmt = stmt.where(*(cond for name, cond in conditions.items() if name != skip))
+        if has_text:
+            return text_match(stmt, dialect, q)
+        return stmt, None
+
+    # Without a text query every match is equally relevant
+    results, rank = restrict(select(Item))
+    if rank is not None:
+        results = results.add_columns(rank.label("rank")).order_by(rank.desc())
+    results = results.order_by(Item.itemId).limit(limit).offset(offset)
+
+    facets = {}
+    for name, facet in facet_columns.items():
+        stmt, _ = restrict(select(facet, func.count()).select_from(Item), skip=name)
+        facets[name] = stmt.group_by(facet)
+    return results, facets
+
+
+def search_total(facets: dict, category: Optional[str]) -> int:
+    """
+    Derives the total match count from the category facet.
+
+    The category facet counts every match except for the category filter,
+    so the total is either the selected category's count or the sum over
+    all categories, with no extra COUNT query.
+    """
+    if category is not None:
+        return facets["category"].get(category, 0)
+    return sum(facets["category"].values())
@@ -1,14 +1,50 @@
+from contextlib import asynccontextmanager
 from sqlalchemy.orm import sessionmaker
-from db.init_db import engine
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from starlette.concurrency import run_in_threadpool
+from db.init_db import DB_MODE, async_engine, engine
 
 # Create a session factory
 SessionFactory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Create an async session factory. Objects are not expired on commit, since
+# reloading an expired attribute would need a lazy load the async ORM forbids
+AsyncSessionFactory = (
+    async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
+    if async_engine is not None
+    else None
+)
 
-# Dependency to get the session
-def get_db():
+
+# Dependency to get a blocking session, run on the threadpool by FastAPI
+def get_sync_db():
     db = SessionFactory()
     try:
         yield db
     finally:
         db.close()
+
+
+# Dependency to get an async session
+async def get_async_db():
+    async with AsyncSessionFactory() as db:
+        yield db
+
+
+# Dependency to get the session for the configured DB_MODE
+get_db = get_async_db if DB_MODE == "async" else get_sync_db
+
+
+# Open a session outside of a request dependency, e.g. for a streaming body
+# that outlives the request's own session
+@asynccontextmanager
+async def open_session():
+    if DB_MODE == "async":
+        async with AsyncSessionFactory() as db:
+            yield db
+    else:
+        db = SessionFactory()
+        try:
+            yield db
+        finally:
+            await run_in_threadpool(db.close)
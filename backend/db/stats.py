@@ -0,0 +1,147 @@
+from collections import Counter, defaultdict
+from sqlalchemy import Select, delete, func, select, true
+from db.models import CategoryStats, Item, ItemStats, OrderItem
+from db.upsert import dialect_insert
+
+# Counter columns of each rollup table, added up by the upserts
+CATEGORY_COUNTERS = ("itemCount", "stockTotal", "ratingSum", "ratingCount")
+ITEM_COUNTERS = ("orderCount", "unitsOrdered")
+
+
+class StatsDelta:
+    """
+    Changes one transaction makes to the rollups.
+
+    The write paths record what they change, then execute `statements`
+    before they commit, so the rollups move in the same transaction as the
+    rows they summarize. Each table gets a single upsert, whose rows are
+    sorted by key so concurrent transactions lock them in the same order.
+    """
+
+    def __init__(self):
+        self.categories: defaultdict[str, Counter] = defaultdict(Counter)
+        self.items: defaultdict[int, Counter] = defaultdict(Counter)
+
+    def item_added(
+        self, category: str, stock: int, ratingSum: int = 0, ratingCount: int = 0, sign: int = 1
+    ):
+        counters = self.categories[category]
+        counters["itemCount"] += sign
+        counters["stockTotal"] += sign * (stock or 0)
+        counters["ratingSum"] += sign * ratingSum
+        counters["ratingCount"] += sign * ratingCount
+
+    def item_removed(self, category: str, stock: int, ratingSum: int = 0, ratingCount: int = 0):
+        self.item_added(category, stock, ratingSum, ratingCount, sign=-1)
+
+    def stock_changed(self, category: str, amount: int):
+        self.categories[category]["stockTotal"] += amount
+
+    def rated(self, category: str, rating: int):
+        counters = self.categories[category]
+        counters["ratingSum"] += rating
+        counters["ratingCount"] += 1
+
+    def add(self, other: "StatsDelta", sign: int = 1):
+        """
+        Adds the changes of another delta to this one.
+
+        :param other: The delta to add.
+        :param sign: -1 to subtract it instead.
+        """
+        for mine, theirs in ((self.categories, other.categories), (self.items, other.items)):
+            for key, counters in theirs.items():
+                for name, value in counters.items():
+                    mine[key][name] += sign * value
+
+    def ordered(self, itemId: int, units: int, orders: int = 1):
+        """
+        Records order lines of an item being added or removed.
+
+        :param units: The quantity added, negative when removed.
+        :param orders: Orders that now hold the item, -1 when a line goes.
+        """
+        counters = self.items[itemId]
+        counters["orderCount"] += orders
+        counters["unitsOrdered"] += units
+
+    def statements(self, dialect: str) -> list:
+        insert = dialect_insert(dialect)
+        statements = []
+        for table, key, counters, deltas in (
+            (CategoryStats, "category", CATEGORY_COUNTERS, self.categories),
+            (ItemStats, "itemId", ITEM_COUNTERS, self.items),
+        ):
+            rows = [
+                {key: value, **{name: delta[name] for name in counters}}
+                for value, delta in sorted(deltas.items())
+                if any(delta.values())
+            ]
+            if not rows:
+                continue
+            stmt = insert(table).values(rows)
+            statements.append(stmt.on_conflict_do_update(
+                index_elements=[getattr(table, key)],
+                set_={name: getattr(table, name) + stmt.excluded[name] for name in counters},
+            ))
+        return statements
+
+
+def rebuild_statements(dialect: str) -> list:
+    """
+    Builds the statements that recompute both rollups from the base tables.
+
+    Rows are overwritten in place rather than deleted and inserted again,
+    so a write path committing meanwhile never finds its row missing, and
+    any drift is gone after the next run. Keys with nothing left to
+    summarize are dropped. The base tables already hold the orders whose
+    outbox events are not processed yet, which the caller takes back out
+    with `db.outbox.unprocessed_stats` in the same transaction.
+    """
+    insert = dialect_insert(dialect)
+    categories = insert(CategoryStats).from_select(
+        ["category", *CATEGORY_COUNTERS],
+        # `WHERE true` lets SQLite parse the ON CONFLICT after a SELECT
+        select(
+            Item.category,
+            func.count(),
+            func.coalesce(func.sum(Item.stock), 0),
+            func.coalesce(func.sum(Item.ratingSum), 0),
+            func.coalesce(func.sum(Item.ratingCount), 0),
+        ).where(true()).group_by(Item.category),
+    )
+    items = insert(ItemStats).from_select(
+        ["itemId", *ITEM_COUNTERS],
+        select(OrderItem.itemId, func.count(), func.sum(OrderItem.qty))
+        .where(true())
+        .group_by(OrderItem.itemId),
+    )
+    return [
+        delete(CategoryStats).where(CategoryStats.category.not_in(select(Item.category))),
+        categories.on_conflict_do_update(
+            index_elements=[CategoryStats.category],
+            set_={name: categories.excluded[name] for name in CATEGORY_COUNTERS},
+        ),
+        delete(ItemStats).where(ItemStats.itemId.not_in(select(OrderItem.itemId))),
+        items.on_conflict_do_update(
+            index_elements=[ItemStats.itemId],
+            set_={name: items.excluded[name] for name in ITEM_COUNTERS},
+        ),
+    ]
+
+
+# Every category's rollup, alphabetically
+def category_stats_statement() -> Select:
+    return select(CategoryStats).where(CategoryStats.itemCount > 0).order_by(CategoryStats.category)
+
+
+# The items in the most orders, with their names, served by the index on
+# `item_stats(orderCount, itemId)`, read backwards
+def top_items_statement(limit: int) -> Select:
+    return (
+        select(ItemStats.itemId, Item.item_name, ItemStats.orderCount, ItemStats.unitsOrdered)
+        .join(Item, Item.itemId == ItemStats.itemId)
+        .where(ItemStats.orderCount > 0)
+        .order_by(ItemStats.orderCount.desc(), ItemStats.itemId.desc())
+        .limit(limit)
+    )
@@ -0,0 +1,18 @@
+from typing import Callable
+from sqlalchemy import Insert
+
+
+def dialect_insert(dialect: str) -> Callable[..., Insert]:
+    """
+    Returns the `insert()` of a dialect, whose statements can upsert with
+    `on_conflict_do_update`.
+
+    :param dialect: The database dialect name.
+    """
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        raise NotImplementedError(f"Upserts are not supported on {dialect}")
+    return insert
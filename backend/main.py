@@ -1,19 +1,81 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
+from starlette.concurrency import run_in_threadpool
 from api.v1.auth.route import router as auth_router
 from api.v1.users.route import router as users_router
 from api.v1.items.route import router as items_router
+from api.v1.items.stats import refresher
 from api.v1.orders.route import router as orders_router
+from api.v1.orders.outbox import worker as outbox_worker
+from api.v1.internal.route import router as internal_router
+from db.init_db import DB_CREATE_SCHEMA, create_schema, dispose_engines, pool_status
 from middleware.authRequest import JWTMiddleware
+from middleware.metrics import MetricsMiddleware
+from middleware.rate_limit import RateLimitMiddleware
+from utils.hashing import shutdown_hash_pool
+from utils.images import pipeline
+from utils.metrics import metrics, profiler
+from utils.storage import storage
+
+
+# Migrate the schema on startup unless disabled and start the image
+# workers, the outbox worker, the rollup refresher and the slow request
+# profiler. Release pooled connections, storage clients and hashing
+# workers on shutdown
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if DB_CREATE_SCHEMA:
+        await run_in_threadpool(create_schema)
+    pipeline.start()
+    outbox_worker.start()
+    refresher.start()
+    if profiler is not None:
+        profiler.start()
+    yield
+    if profiler is not None:
+        profiler.stop()
+    await pipeline.stop()
+    await outbox_worker.stop()
+    await refresher.stop()
+    await dispose_engines()
+    await storage.close()
+    shutdown_hash_pool()
+
 
 # Create a FastAPI instance
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+
+# Turn away excess traffic. Added before JWTMiddleware so it runs inside it
+# and can tell clients apart by their token's `sub`
+app.add_middleware(RateLimitMiddleware)
+
+# Decode bearer tokens once per request for `get_current_user`
+app.add_middleware(JWTMiddleware)
+
+# Record request metrics. Added last so it wraps the other middleware too
+app.add_middleware(MetricsMiddleware)
 
 # Import the routes
 app.include_router(auth_router, prefix="/api/v1/auth")
 app.include_router(users_router, prefix="/api/v1/users")
 app.include_router(items_router, prefix="/api/v1/items")
 app.include_router(orders_router, prefix="/api/v1/orders")
+app.include_router(internal_router, prefix="/api/v1/internal")
 
 @app.get("/")  
 def read_root():
-    return {"Hello": "World"}
\ No newline at end of file
+    return {"Hello": "World"}
+
+
+# Expose request and connection pool metrics in the Prometheus text format
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def read_metrics():
+    pool = {
+        f"db_pool_{name}": value
+        for name, value in pool_status().items()
+        if name in ("size", "in_use", "idle", "overflow")
+    }
+    return PlainTextResponse(
+        metrics.render(pool), media_type="text/plain; version=0.0.4"
+    )
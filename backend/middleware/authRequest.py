@@ -1,18 +1,38 @@
-from fastapi import Request, HTTPException
-from starlette.middleware.base import RequestResponseEndpoint, BaseHTTPMiddleware
+from starlette.types import ASGIApp, Receive, Scope, Send
 from utils.jwt_utils import decode_access_token
 
-class JWTMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next: RequestResponseEndpoint):
-        if "Authorization" not in request.headers:
-            raise HTTPException(status_code=403, detail="Authorization header missing")
-        auth = request.headers["Authorization"]
-        token = auth.split(" ")[1]
-        
-        try:
-            decode_access_token(token)
-        except HTTPException as e:
-            raise HTTPException(status_code=e.status_code, detail=e.detail)
 
-        response = await call_next(request)
-        return response
+class JWTMiddleware:
+    """
+    Pure ASGI middleware that decodes the bearer token once per request.
+
+    The token and its claims (or the decode error) are stored in
+    `request.state.jwt_token` / `request.state.jwt_claims`, where
+    `get_current_user` picks them up instead of decoding again. Requests
+    without a token pass through, routes that need one reject them through
+    their `get_current_user` dependency. Being plain ASGI, the middleware
+    adds no task per request and never buffers streaming bodies.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] == "http":
+            token = bearer_token(scope)
+            if token is not None:
+                state = scope.setdefault("state", {})
+                state["jwt_token"] = token
+                state["jwt_claims"] = decode_access_token(token)
+        await self.app(scope, receive, send)
+
+
+# Read the token from an `Authorization: Bearer <token>` header
+def bearer_token(scope: Scope) -> str | None:
+    for name, value in scope["headers"]:
+        if name == b"authorization":
+            scheme, _, token = value.decode("latin-1").partition(" ")
+            if scheme.lower() == "bearer" and token:
+                return token.strip()
+            return None
+    return None
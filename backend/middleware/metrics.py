@@ -0,0 +1,77 @@
+import time
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from utils.metrics import RequestStats, current_request, metrics, profiler
+
+
+class MetricsMiddleware:
+    """
+    Pure ASGI middleware that records the metrics of every HTTP request.
+
+    Latency runs until the last body chunk is sent, so streamed responses
+    count in full. The database work of the request is collected through
+    `current_request` by the engine events of `instrument_engine`. Requests
+    are labelled with their route template rather than their path, so the
+    number of series stays bounded.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+        stats = RequestStats()
+        token = current_request.set(stats)
+        start = time.perf_counter()
+        metrics.in_flight += 1
+        if profiler is not None:
+            profiler.begin(id(stats), start)
+
+        async def send_with_status(message: Message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            duration = time.perf_counter() - start
+            metrics.in_flight -= 1
+            current_request.reset(token)
+            method, route = scope["method"], route_template(scope)
+            metrics.record(method, route, status, duration, stats)
+            if profiler is not None:
+                profiler.end(id(stats), method, route, duration)
+
+
+def route_template(scope: Scope) -> str:
+    """
+    Returns the template of the route that served a request.
+
+    The router records the route it matched in the scope, whose
+    `path_format` is the declared path, e.g. `/{itemId}`, and the prefix it
+    was included under is put back in front: `/api/v1/items/{itemId}` for
+    `/api/v1/items/7`. Requests that matched no route share one label, so
+    scanners cannot create a series per path.
+    """
+    route = scope.get("route")
+    path_format = getattr(route, "path_format", None)
+    if path_format is None:
+        return "unmatched"
+    return include_prefix(scope["path"], route) + path_format
+
+
+# Part of the path in front of what the route itself matched. FastAPI keeps
+# a route included with a prefix under its own path, so the route matches
+# a tail of the request path and the prefix is what comes before it
+def include_prefix(path: str, route) -> str:
+    start = path.rfind("/")
+    while start > 0:
+        if route.path_regex.match(path[start:]):
+            return path[:start]
+        start = path.rfind("/", 0, start)
+    return ""
@@ -0,0 +1,112 @@
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
+from utils.api_key_utils import API_KEY_NAME, verifyAPIKey
+from utils.metrics import metrics
+from utils.rate_limit import (
+    MAX_IN_FLIGHT,
+    RATE_LIMIT_AUTH_COST,
+    RATE_LIMIT_TRUST_PROXY,
+    fingerprint,
+    limiter,
+    retry_after,
+)
+
+# Requests that hash a password, by method and path without trailing slash
+AUTH_REQUESTS = {("POST", "/api/v1/auth"), ("POST", "/api/v1/users")}
+# Paths that are never limited, so monitoring keeps working under load
+EXEMPT_PATHS = {"/metrics"}
+
+
+class RateLimitMiddleware:
+    """
+    Pure ASGI middleware that turns excess traffic away before it reaches
+    the routes.
+
+    Admission control comes first: once MAX_IN_FLIGHT requests are being
+    served, new ones get 503 at once instead of queueing for the threadpool
+    and the database pool. Then each client takes a token from its bucket,
+    found by its JWT `sub`, else its API key, else its IP address, and gets
+    429 when the bucket is empty. Both carry Retry-After. Added inside
+    JWTMiddleware, so the claims it decoded are already in the scope.
+    """
+
+    def __init__(self, app: ASGIApp, max_in_flight: int = MAX_IN_FLIGHT):
+        self.app = app
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or scope["path"] in EXEMPT_PATHS:
+            await self.app(scope, receive, send)
+            return
+
+        if self.max_in_flight and self.in_flight >= self.max_in_flight:
+            metrics.rejected.inc(("overloaded",))
+            response = JSONResponse(
+                {"detail": "Server is busy, try again later"},
+                status_code=503,
+                headers={"Retry-After": "1"},
+            )
+            await response(scope, receive, send)
+            return
+
+        # Counted before the bucket is checked, which may await a shared
+        # backend, so concurrent arrivals cannot all slip under the limit
+        self.in_flight += 1
+        try:
+            if limiter is not None:
+                kind, client = client_identity(scope)
+                cost = RATE_LIMIT_AUTH_COST if request_key(scope) in AUTH_REQUESTS else 1
+                wait = await limiter.take(kind, client, cost)
+                if wait > 0:
+                    metrics.rejected.inc(("rate_limited",))
+                    response = JSONResponse(
+                        {"detail": "Too many requests"},
+                        status_code=429,
+                        headers={"Retry-After": retry_after(wait)},
+                    )
+                    await response(scope, receive, send)
+                    return
+            await self.app(scope, receive, send)
+        finally:
+            self.in_flight -= 1
+
+
+# Method and path of a request, the way AUTH_REQUESTS lists them
+def request_key(scope: Scope) -> tuple[str, str]:
+    return scope["method"], scope["path"].rstrip("/")
+
+
+def client_identity(scope: Scope) -> tuple[str, str]:
+    """
+    Finds the bucket a request takes from, as a RATE_LIMITS kind and an ID.
+
+    Only verified credentials count, otherwise a client could pick a fresh
+    bucket for every request by sending made-up tokens or keys.
+    """
+    claims = scope.get("state", {}).get("jwt_claims")
+    if claims and "error" not in claims and "sub" in claims:
+        return "user", str(claims["sub"])
+    api_key = header(scope, API_KEY_NAME.lower().encode("latin-1")) if API_KEY_NAME else None
+    if api_key and verifyAPIKey(api_key):
+        return "api_key", fingerprint(api_key)
+    return "ip", client_ip(scope)
+
+
+# The client's address. Behind a trusted proxy that is the last entry of
+# X-Forwarded-For, the one the proxy appended, as clients can forge the rest
+def client_ip(scope: Scope) -> str:
+    if RATE_LIMIT_TRUST_PROXY:
+        forwarded = header(scope, b"x-forwarded-for")
+        if forwarded:
+            return forwarded.rsplit(",", 1)[-1].strip()
+    client = scope.get("client")
+    return client[0] if client else "unknown"
+
+
+# First value of a request header, by its lowercase name
+def header(scope: Scope, name: bytes) -> str | None:
+    for key, value in scope["headers"]:
+        if key == name:
+            return value.decode("latin-1")
+    return None
@@ -0,0 +1,77 @@
+import os
+from logging.config import fileConfig
+from alembic import context
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, pool, text
+from db.models import Base
+
+load_dotenv()
+
+config = context.config
+
+# The app passes its own connection when it migrates on startup, and its
+# logging is already configured by then
+connection = config.attributes.get("connection")
+if connection is None and config.config_file_name is not None:
+    fileConfig(config.config_file_name)
+
+# Compared against the database by `alembic revision --autogenerate`
+target_metadata = Base.metadata
+
+# The SQLite search index is a virtual table with shadow tables of its own,
+# created by DDL rather than declared on the models
+SEARCH_TABLE_PREFIX = "items_fts"
+
+
+# Leave the search index out of `alembic revision --autogenerate`, which would
+# otherwise drop it
+def include_object(object, name, type_, reflected, compare_to):
+    return not (type_ == "table" and reflected and name.startswith(SEARCH_TABLE_PREFIX))
+
+
+# Key of the Postgres advisory lock held while migrating, so workers that
+# boot at the same time upgrade the schema one after another
+MIGRATION_LOCK_ID = 7201
+
+
+# Emit the migration SQL instead of running it, for `alembic upgrade --sql`
+def run_migrations_offline():
+    context.configure(
+        url=os.getenv("DATABASE_URL"),
+        target_metadata=target_metadata,
+        include_object=include_object,
+        literal_binds=True,
+        dialect_opts={"paramstyle": "named"},
+    )
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+# Run the migrations over `connection`
+def run_migrations(connection):
+    context.configure(
+        connection=connection,
+        target_metadata=target_metadata,
+        include_object=include_object,
+        # SQLite cannot alter columns in place, batch mode copies the table
+        render_as_batch=connection.dialect.name == "sqlite",
+    )
+    with context.begin_transaction():
+        if connection.dialect.name == "postgresql":
+            connection.execute(text(f"SELECT pg_advisory_xact_lock({MIGRATION_LOCK_ID})"))
+        context.run_migrations()
+
+
+def run_migrations_online():
+    if connection is not None:
+        run_migrations(connection)
+        return
+    engine = create_engine(os.getenv("DATABASE_URL"), poolclass=pool.NullPool)
+    with engine.connect() as conn:
+        run_migrations(conn)
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
@@ -0,0 +1,78 @@
+"""Initial schema
+
+The tables as the app created them with `Base.metadata.create_all`, before
+migrations were introduced. Databases created that way are brought under
+Alembic with `alembic stamp`:
+
+* orders still have the `items` JSON column: `alembic stamp 0001`
+* `order_items` exists and items are searchable: `alembic stamp 0003`
+
+followed by `alembic upgrade head`.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18 09:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0001"
+down_revision: Union[str, Sequence[str], None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        "users",
+        sa.Column("id", sa.Integer(), primary_key=True, unique=True, nullable=False),
+        sa.Column("name", sa.String(), nullable=False),
+        sa.Column("phoneNumber", sa.String()),
+        sa.Column("address", sa.String()),
+        sa.Column("email", sa.String(), nullable=False),
+        sa.Column("password", sa.String(), nullable=False),
+        sa.Column("rating", sa.Integer()),
+    )
+    op.create_table(
+        "items",
+        sa.Column("itemId", sa.Integer(), primary_key=True, unique=True, nullable=False),
+        sa.Column("item_name", sa.String(), nullable=False),
+        sa.Column("rating", sa.Integer()),
+        sa.Column("category", sa.String(), nullable=False),
+        sa.Column("itemDesc", sa.Text(), nullable=False),
+        sa.Column("stock", sa.Integer(), nullable=False),
+        sa.Column("itemPic", sa.String(), nullable=False),
+        # SQLite has no arrays, where the lists are stored as JSON
+        sa.Column("reviews", sa.ARRAY(sa.String()).with_variant(sa.JSON(), "sqlite")),
+    )
+    op.create_table(
+        "orders",
+        sa.Column("orderId", sa.Integer(), primary_key=True, unique=True, nullable=False),
+        sa.Column(
+            "status",
+            sa.Enum("cancelled", "delivered", "confirmed", name="orderstatus"),
+        ),
+        sa.Column("deliveryDate", sa.Date()),
+        sa.Column("items", sa.JSON(), nullable=False),
+        sa.Column("userId", sa.Integer(), sa.ForeignKey("users.id"), nullable=False),
+    )
+    op.create_table(
+        "user_item_association",
+        sa.Column("user_id", sa.Integer(), sa.ForeignKey("users.id"), primary_key=True),
+        sa.Column("item_id", sa.Integer(), sa.ForeignKey("items.itemId"), primary_key=True),
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table("user_item_association")
+    op.drop_table("orders")
+    op.drop_table("items")
+    op.drop_table("users")
+    sa.Enum(name="orderstatus").drop(op.get_bind(), checkfirst=True)
@@ -0,0 +1,134 @@
+"""Move order lines into order_items
+
+Order lines move out of the `orders.items` JSON column into the
+`order_items` table. Existing orders are copied over in keyset batches of
+BATCH_SIZE orders, so memory stays flat however many orders there are.
+Lines that point at items which no longer exist are skipped.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 09:10:00
+
+"""
+import json
+from collections import Counter
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0002"
+down_revision: Union[str, Sequence[str], None] = "0001"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Orders copied per round trip
+BATCH_SIZE = 1000
+
+# Lightweight views of the tables as they are at this revision
+legacy_orders = sa.table("orders", sa.column("orderId"), sa.column("items", sa.JSON()))
+# `.c.items` is shadowed by ColumnCollection.items()
+legacy_items = legacy_orders.c["items"]
+items = sa.table("items", sa.column("itemId"))
+order_items = sa.table(
+    "order_items", sa.column("orderId"), sa.column("itemId"), sa.column("qty")
+)
+
+
+def parse_lines(raw) -> Counter:
+    """
+    Parses the JSON stored for one order into item quantities.
+
+    Rows written by the old `create_order` hold a JSON-encoded string
+    inside the JSON column, so the value may need decoding twice.
+
+    :param raw: The value of the `orders.items` column.
+    :return: A Counter mapping itemId to quantity.
+    """
+    lines = json.loads(raw) if isinstance(raw, str) else raw
+    if isinstance(lines, str):
+        lines = json.loads(lines)
+    quantities = Counter()
+    for line in lines or []:
+        if line.get("itemId") is not None:
+            quantities[line["itemId"]] += line.get("qty", 1)
+    return quantities
+
+
+def backfill(conn):
+    lastId = 0
+    while True:
+        rows = conn.execute(
+            sa.select(legacy_orders.c.orderId, legacy_items)
+            .where(legacy_orders.c.orderId > lastId)
+            .order_by(legacy_orders.c.orderId)
+            .limit(BATCH_SIZE)
+        ).all()
+        if not rows:
+            return
+        lastId = rows[-1][0]
+
+        lines = {orderId: parse_lines(raw) for orderId, raw in rows}
+        itemIds = {itemId for qty in lines.values() for itemId in qty}
+        existing = set(
+            conn.execute(
+                sa.select(items.c.itemId).where(items.c.itemId.in_(itemIds))
+            ).scalars()
+        )
+        values = [
+            {"orderId": orderId, "itemId": itemId, "qty": qty}
+            for orderId, quantities in lines.items()
+            for itemId, qty in quantities.items()
+            if itemId in existing
+        ]
+        if values:
+            conn.execute(sa.insert(order_items), values)
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        "order_items",
+        sa.Column(
+            "orderId",
+            sa.Integer(),
+            sa.ForeignKey("orders.orderId", ondelete="CASCADE"),
+            primary_key=True,
+        ),
+        sa.Column("itemId", sa.Integer(), sa.ForeignKey("items.itemId"), primary_key=True),
+        sa.Column("qty", sa.Integer(), nullable=False),
+    )
+    op.create_index("ix_order_items_itemId", "order_items", ["itemId"])
+    # Offline SQL scripts only hold the DDL, there are no rows to copy
+    if not op.get_context().as_sql:
+        backfill(op.get_bind())
+    with op.batch_alter_table("orders") as batch:
+        batch.drop_column("items")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    conn = op.get_bind()
+    with op.batch_alter_table("orders") as batch:
+        batch.add_column(sa.Column("items", sa.JSON()))
+
+    # Restore each order's lines as `{"itemId", "qty"}` objects
+    lines = {}
+    for orderId, itemId, qty in conn.execute(
+        sa.select(order_items.c.orderId, order_items.c.itemId, order_items.c.qty)
+    ):
+        lines.setdefault(orderId, []).append({"itemId": itemId, "qty": qty})
+    conn.execute(sa.update(legacy_orders).values(items=[]))
+    for orderId, order_lines in lines.items():
+        conn.execute(
+            sa.update(legacy_orders)
+            .where(legacy_orders.c.orderId == orderId)
+            .values(items=order_lines)
+        )
+
+    with op.batch_alter_table("orders") as batch:
+        batch.alter_column("items", existing_type=sa.JSON(), nullable=False)
+    op.drop_index("ix_order_items_itemId", table_name="order_items")
+    op.drop_table("order_items")
@@ -0,0 +1,74 @@
+"""Full-text search over items
+
+Postgres gets a GIN index over the items' tsvector document. SQLite gets
+an FTS5 table over the same columns, kept in sync by triggers and filled
+from the existing items.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 09:20:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0003"
+down_revision: Union[str, Sequence[str], None] = "0002"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Must match `to_search_document` in db/models.py for queries to use it
+SEARCH_DOCUMENT = """to_tsvector('english'::regconfig, "item_name" || ' ' || "itemDesc")"""
+
+SQLITE_FTS_DDL = [
+    """CREATE VIRTUAL TABLE items_fts USING fts5(
+        item_name, itemDesc, content='items', content_rowid='itemId',
+        tokenize='porter unicode61'
+    )""",
+    """CREATE TRIGGER items_fts_insert AFTER INSERT ON items BEGIN
+        INSERT INTO items_fts(rowid, item_name, itemDesc)
+        VALUES (new.itemId, new.item_name, new.itemDesc);
+    END""",
+    """CREATE TRIGGER items_fts_delete AFTER DELETE ON items BEGIN
+        INSERT INTO items_fts(items_fts, rowid, item_name, itemDesc)
+        VALUES ('delete', old.itemId, old.item_name, old.itemDesc);
+    END""",
+    """CREATE TRIGGER items_fts_update AFTER UPDATE OF item_name, itemDesc ON items BEGIN
+        INSERT INTO items_fts(items_fts, rowid, item_name, itemDesc)
+        VALUES ('delete', old.itemId, old.item_name, old.itemDesc);
+        INSERT INTO items_fts(rowid, item_name, itemDesc)
+        VALUES (new.itemId, new.item_name, new.itemDesc);
+    END""",
+    # Index the rows that were there before the triggers
+    "INSERT INTO items_fts(items_fts) VALUES ('rebuild')",
+]
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    dialect = op.get_bind().dialect.name
+    if dialect == "postgresql":
+        op.create_index(
+            "ix_items_search",
+            "items",
+            [sa.text(SEARCH_DOCUMENT)],
+            postgresql_using="gin",
+        )
+    elif dialect == "sqlite":
+        for statement in SQLITE_FTS_DDL:
+            op.execute(statement)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    dialect = op.get_bind().dialect.name
+    if dialect == "postgresql":
+        op.drop_index("ix_items_search", table_name="items")
+    elif dialect == "sqlite":
+        for trigger in ("items_fts_insert", "items_fts_delete", "items_fts_update"):
+            op.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+        op.execute("DROP TABLE IF EXISTS items_fts")
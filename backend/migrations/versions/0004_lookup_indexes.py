@@ -0,0 +1,45 @@
+"""Index hot lookup columns and make user emails unique
+
+* `users.email`: login and signup look users up by email, and the unique
+  index settles concurrent signups with the same address
+* `items.category`: the items-by-category listing
+* `orders.userId`: a user's orders
+* `user_item_association.item_id`: the primary key leads with `user_id`,
+  so lookups by item need their own index
+
+Creating the unique index fails if two users already share an email;
+resolve those accounts first.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18 09:30:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0004"
+down_revision: Union[str, Sequence[str], None] = "0003"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_index("ix_users_email", "users", ["email"], unique=True)
+    op.create_index("ix_items_category", "items", ["category"])
+    op.create_index("ix_orders_userId", "orders", ["userId"])
+    op.create_index(
+        "ix_user_item_association_item_id", "user_item_association", ["item_id"]
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index("ix_user_item_association_item_id", table_name="user_item_association")
+    op.drop_index("ix_orders_userId", table_name="orders")
+    op.drop_index("ix_items_category", table_name="items")
+    op.drop_index("ix_users_email", table_name="users")
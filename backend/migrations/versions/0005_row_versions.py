@@ -0,0 +1,68 @@
+"""Version and last update time of users, items and orders
+
+Both columns back the ETag and Last-Modified headers of the read
+endpoints. `version` starts at 1 and the app raises it on every update,
+`updated_at` starts at the time of the migration for existing rows.
+
+SQLite cannot add a column whose default is CURRENT_TIMESTAMP, so there
+`updated_at` is added with a constant default and then set.
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18 10:30:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0005"
+down_revision: Union[str, Sequence[str], None] = "0004"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+VERSIONED_TABLES = ["users", "items", "orders"]
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    sqlite = op.get_bind().dialect.name == "sqlite"
+    for table in VERSIONED_TABLES:
+        op.add_column(
+            table, sa.Column("version", sa.Integer(), nullable=False, server_default="1")
+        )
+        if sqlite:
+            op.add_column(
+                table,
+                sa.Column(
+                    "updated_at",
+                    sa.DateTime(timezone=True),
+                    nullable=False,
+                    server_default="1970-01-01 00:00:00",
+                ),
+            )
+            op.execute(f"UPDATE {table} SET updated_at = CURRENT_TIMESTAMP")
+        else:
+            # The default only fills existing rows, the app sets new ones
+            op.add_column(
+                table,
+                sa.Column(
+                    "updated_at",
+                    sa.DateTime(timezone=True),
+                    nullable=False,
+                    server_default=sa.func.now(),
+                ),
+            )
+            op.alter_column(table, "updated_at", server_default=None)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    # Plain DROP COLUMN, which SQLite has since 3.35. Batch mode would copy
+    # items into a new table and lose its search triggers
+    for table in reversed(VERSIONED_TABLES):
+        op.drop_column(table, "updated_at")
+        op.drop_column(table, "version")
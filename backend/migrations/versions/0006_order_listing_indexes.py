@@ -0,0 +1,42 @@
+"""Index the order listings' filters and sort orders
+
+* `orders (userId, orderId)`: a user's order history, newest first, in
+  place of the index on `userId` alone
+* `orders (status, deliveryDate, orderId)`: orders by status, optionally
+  within a delivery date range
+* `orders (deliveryDate, orderId)`: orders by delivery date range, and
+  listings sorted by delivery date
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18 12:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0006"
+down_revision: Union[str, Sequence[str], None] = "0005"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_index("ix_orders_userId_orderId", "orders", ["userId", "orderId"])
+    op.drop_index("ix_orders_userId", table_name="orders")
+    op.create_index(
+        "ix_orders_status_deliveryDate", "orders", ["status", "deliveryDate", "orderId"]
+    )
+    op.create_index("ix_orders_deliveryDate", "orders", ["deliveryDate", "orderId"])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index("ix_orders_deliveryDate", table_name="orders")
+    op.drop_index("ix_orders_status_deliveryDate", table_name="orders")
+    op.create_index("ix_orders_userId", "orders", ["userId"])
+    op.drop_index("ix_orders_userId_orderId", table_name="orders")
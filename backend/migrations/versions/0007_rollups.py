@@ -0,0 +1,80 @@
+"""Add the item rollups served by /items/stats
+
+* `category_stats`: item count, stock total and rating sum per category
+* `item_stats`: orders and units ordered per item, indexed by order count
+  for the top sellers
+* Both are filled from the existing rows; from then on the write paths and
+  the periodic refresher keep them current
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-18 14:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0007"
+down_revision: Union[str, Sequence[str], None] = "0006"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Lightweight views of the tables as they are at this revision
+items = sa.table(
+    "items", sa.column("itemId"), sa.column("category"), sa.column("stock"), sa.column("rating")
+)
+order_items = sa.table("order_items", sa.column("itemId"), sa.column("qty"))
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    category_stats = op.create_table(
+        "category_stats",
+        sa.Column("category", sa.String(), nullable=False),
+        sa.Column("itemCount", sa.Integer(), nullable=False),
+        sa.Column("stockTotal", sa.Integer(), nullable=False),
+        sa.Column("ratingSum", sa.Integer(), nullable=False),
+        sa.Column("ratedItems", sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint("category"),
+    )
+    item_stats = op.create_table(
+        "item_stats",
+        sa.Column("itemId", sa.Integer(), nullable=False),
+        sa.Column("orderCount", sa.Integer(), nullable=False),
+        sa.Column("unitsOrdered", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(["itemId"], ["items.itemId"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("itemId"),
+    )
+    op.create_index("ix_item_stats_orderCount", "item_stats", ["orderCount", "itemId"])
+
+    op.execute(
+        category_stats.insert().from_select(
+            ["category", "itemCount", "stockTotal", "ratingSum", "ratedItems"],
+            sa.select(
+                items.c.category,
+                sa.func.count(),
+                sa.func.coalesce(sa.func.sum(items.c.stock), 0),
+                sa.func.coalesce(sa.func.sum(items.c.rating), 0),
+                sa.func.count(items.c.rating),
+            ).group_by(items.c.category),
+        )
+    )
+    op.execute(
+        item_stats.insert().from_select(
+            ["itemId", "orderCount", "unitsOrdered"],
+            sa.select(
+                order_items.c.itemId, sa.func.count(), sa.func.sum(order_items.c.qty)
+            ).group_by(order_items.c.itemId),
+        )
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index("ix_item_stats_orderCount", table_name="item_stats")
+    op.drop_table("item_stats")
+    op.drop_table("category_stats")
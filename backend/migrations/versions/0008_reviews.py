@@ -0,0 +1,125 @@
+"""Move item reviews into the reviews table
+
+* `reviews`: one row per review, read a page at a time through
+  `(itemId, reviewId)`
+* `items.ratingSum` and `items.ratingCount`: the ratings of an item's
+  reviews, from which its average is computed
+* The strings of `items.reviews` are copied over in keyset batches of
+  BATCH_SIZE items, as reviews with no user or rating, and the column is
+  dropped
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-18 15:00:00
+
+"""
+from datetime import datetime, timezone
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0008"
+down_revision: Union[str, Sequence[str], None] = "0007"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Items copied per round trip
+BATCH_SIZE = 1000
+
+# The old column, stored as JSON where there are no arrays
+REVIEWS_TYPE = sa.ARRAY(sa.String()).with_variant(sa.JSON(), "sqlite")
+
+# Lightweight views of the tables as they are at this revision
+legacy_items = sa.table("items", sa.column("itemId"), sa.column("reviews", REVIEWS_TYPE))
+reviews = sa.table(
+    "reviews",
+    sa.column("reviewId"),
+    sa.column("itemId"),
+    sa.column("text"),
+    sa.column("created_at"),
+)
+
+
+def backfill(conn):
+    # The old reviews have no dates, so they all date from the migration
+    now = datetime.now(timezone.utc)
+    lastId = 0
+    while True:
+        rows = conn.execute(
+            sa.select(legacy_items.c.itemId, legacy_items.c.reviews)
+            .where(legacy_items.c.itemId > lastId, legacy_items.c.reviews.is_not(None))
+            .order_by(legacy_items.c.itemId)
+            .limit(BATCH_SIZE)
+        ).all()
+        if not rows:
+            return
+        lastId = rows[-1][0]
+
+        # Kept in list order, so the newest review gets the highest reviewId
+        values = [
+            {"itemId": itemId, "text": text, "created_at": now}
+            for itemId, texts in rows
+            for text in texts
+            if text
+        ]
+        if values:
+            conn.execute(sa.insert(reviews), values)
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        "reviews",
+        sa.Column("reviewId", sa.Integer(), primary_key=True),
+        sa.Column(
+            "itemId",
+            sa.Integer(),
+            sa.ForeignKey("items.itemId", ondelete="CASCADE"),
+            nullable=False,
+        ),
+        sa.Column("userId", sa.Integer(), sa.ForeignKey("users.id", ondelete="SET NULL")),
+        sa.Column("rating", sa.Integer()),
+        sa.Column("text", sa.Text(), nullable=False),
+        sa.Column("created_at", sa.DateTime(timezone=True), nullable=False),
+    )
+    op.create_index("ix_reviews_itemId_reviewId", "reviews", ["itemId", "reviewId"])
+    op.add_column(
+        "items", sa.Column("ratingSum", sa.Integer(), nullable=False, server_default="0")
+    )
+    op.add_column(
+        "items", sa.Column("ratingCount", sa.Integer(), nullable=False, server_default="0")
+    )
+    # Offline SQL scripts only hold the DDL, there are no rows to copy
+    if not op.get_context().as_sql:
+        backfill(op.get_bind())
+    # Plain DROP COLUMN, which SQLite has since 3.35. Batch mode would copy
+    # items into a new table and lose its search triggers
+    op.drop_column("items", "reviews")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    conn = op.get_bind()
+    op.add_column("items", sa.Column("reviews", REVIEWS_TYPE))
+
+    # Restore each item's review texts, oldest first. Ratings and authors
+    # have nowhere to go and are lost
+    texts = {}
+    for itemId, text in conn.execute(
+        sa.select(reviews.c.itemId, reviews.c.text).order_by(reviews.c.reviewId)
+    ):
+        texts.setdefault(itemId, []).append(text)
+    for itemId, item_reviews in texts.items():
+        conn.execute(
+            sa.update(legacy_items)
+            .where(legacy_items.c.itemId == itemId)
+            .values(reviews=item_reviews)
+        )
+
+    op.drop_column("items", "ratingCount")
+    op.drop_column("items", "ratingSum")
+    op.drop_index("ix_reviews_itemId_reviewId", table_name="reviews")
+    op.drop_table("reviews")
@@ -0,0 +1,52 @@
+"""Add the outbox of order events
+
+* `outbox_events`: side effects of order changes, written in the same
+  transaction as the change and carried out by the outbox worker
+* `ix_outbox_events_pending`: the worker's claims, over pending events only
+
+Revision ID: 0009
+Revises: 0008
+Create Date: 2026-10-18 16:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0009"
+down_revision: Union[str, Sequence[str], None] = "0008"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        "outbox_events",
+        sa.Column("eventId", sa.Integer(), primary_key=True),
+        sa.Column("kind", sa.String(), nullable=False),
+        sa.Column("idempotencyKey", sa.String(), nullable=False, unique=True),
+        sa.Column("payload", sa.JSON(), nullable=False),
+        sa.Column("created_at", sa.DateTime(timezone=True), nullable=False),
+        sa.Column("available_at", sa.DateTime(timezone=True), nullable=False),
+        sa.Column("attempts", sa.Integer(), nullable=False),
+        sa.Column("processed_at", sa.DateTime(timezone=True)),
+        sa.Column("last_error", sa.Text()),
+    )
+    pending = sa.text('"processed_at" IS NULL')
+    op.create_index(
+        "ix_outbox_events_pending",
+        "outbox_events",
+        ["available_at", "eventId"],
+        postgresql_where=pending,
+        sqlite_where=pending,
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index("ix_outbox_events_pending", table_name="outbox_events")
+    op.drop_table("outbox_events")
@@ -0,0 +1,65 @@
+"""Stop SQLite from reusing the IDs of deleted rows
+
+Without AUTOINCREMENT, SQLite hands the ID of the newest row out again once
+that row is deleted, so a new item could take over the ID a deleted item
+still has in caches and in pending outbox events. The tables with a
+surrogate key are copied into tables declared with AUTOINCREMENT. Postgres
+sequences never reuse values, so nothing changes there.
+
+Revision ID: 0010
+Revises: 0009
+Create Date: 2026-10-18 17:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0010"
+down_revision: Union[str, Sequence[str], None] = "0009"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+TABLES = ["users", "items", "orders", "reviews", "outbox_events"]
+
+# Dropping the old `items` table drops the triggers of its search index
+SQLITE_FTS_TRIGGERS = [
+    """CREATE TRIGGER items_fts_insert AFTER INSERT ON items BEGIN
+        INSERT INTO items_fts(rowid, item_name, itemDesc)
+        VALUES (new.itemId, new.item_name, new.itemDesc);
+    END""",
+    """CREATE TRIGGER items_fts_delete AFTER DELETE ON items BEGIN
+        INSERT INTO items_fts(items_fts, rowid, item_name, itemDesc)
+        VALUES ('delete', old.itemId, old.item_name, old.itemDesc);
+    END""",
+    """CREATE TRIGGER items_fts_update AFTER UPDATE OF item_name, itemDesc ON items BEGIN
+        INSERT INTO items_fts(items_fts, rowid, item_name, itemDesc)
+        VALUES ('delete', old.itemId, old.item_name, old.itemDesc);
+        INSERT INTO items_fts(rowid, item_name, itemDesc)
+        VALUES (new.itemId, new.item_name, new.itemDesc);
+    END""",
+]
+
+
+def recreate_tables(autoincrement: bool) -> None:
+    for table in TABLES:
+        with op.batch_alter_table(
+            table, recreate="always", table_kwargs={"sqlite_autoincrement": autoincrement}
+        ):
+            pass
+    for statement in SQLITE_FTS_TRIGGERS:
+        op.execute(statement)
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    if op.get_bind().dialect.name == "sqlite":
+        recreate_tables(autoincrement=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    if op.get_bind().dialect.name == "sqlite":
+        recreate_tables(autoincrement=False)
@@ -0,0 +1,78 @@
+"""Rate items and categories from their reviews only
+
+* `items.rating`: set to the average of the item's review ratings in whole
+  stars, rounded down, and NULL for items without one. New reviews keep it
+  in step from now on
+* `category_stats.ratedItems` becomes `ratingCount`, and the category's
+  rating sum and count are recomputed from the ratings of its items'
+  reviews instead of the legacy `items.rating`
+
+Revision ID: 0011
+Revises: 0010
+Create Date: 2026-10-18 17:30:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0011"
+down_revision: Union[str, Sequence[str], None] = "0010"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Lightweight views of the tables as they are at this revision
+items = sa.table(
+    "items",
+    sa.column("category"),
+    sa.column("rating", sa.Integer()),
+    sa.column("ratingSum", sa.Integer()),
+    sa.column("ratingCount", sa.Integer()),
+)
+
+
+# Set each category's rating sum and count to aggregates over its items
+def recompute_categories(counter: str, ratingSum, ratingCount) -> None:
+    category_stats = sa.table(
+        "category_stats", sa.column("category"), sa.column("ratingSum"), sa.column(counter)
+    )
+    of_category = sa.select().where(items.c.category == category_stats.c.category)
+    op.execute(
+        category_stats.update().values(
+            {
+                "ratingSum": of_category.add_columns(ratingSum).scalar_subquery(),
+                counter: of_category.add_columns(ratingCount).scalar_subquery(),
+            }
+        )
+    )
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    with op.batch_alter_table("category_stats") as batch_op:
+        batch_op.alter_column("ratedItems", new_column_name="ratingCount")
+    op.execute(
+        items.update().values(
+            rating=items.c.ratingSum // sa.func.nullif(items.c.ratingCount, 0, type_=sa.Integer())
+        )
+    )
+    recompute_categories(
+        "ratingCount",
+        sa.func.coalesce(sa.func.sum(items.c.ratingSum), 0),
+        sa.func.coalesce(sa.func.sum(items.c.ratingCount), 0),
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.batch_alter_table("category_stats") as batch_op:
+        batch_op.alter_column("ratingCount", new_column_name="ratedItems")
+    # The legacy rollup summed the items' own ratings, one per rated item
+    recompute_categories(
+        "ratedItems",
+        sa.func.coalesce(sa.func.sum(items.c.rating), 0),
+        sa.func.count(items.c.rating),
+    )
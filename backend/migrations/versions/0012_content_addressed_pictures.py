@@ -0,0 +1,101 @@
+"""Move legacy item pictures into the content-addressed layout
+
+Items created before pictures were stored by content hash have an itemPic
+of `uploads/<filename>`, a path relative to the app's working directory.
+Read as a storage key it resolves to `uploads/uploads/<filename>` under
+STORAGE_DIR, so those pictures were not found. Each legacy file is stored
+under its content key in the configured storage, as new uploads are, and
+the item's itemPic is set to that key, in keyset batches of BATCH_SIZE
+items. Items whose file is gone keep their value.
+
+Revision ID: 0012
+Revises: 0011
+Create Date: 2026-10-18 18:00:00
+
+"""
+import os
+from typing import Optional, Sequence, Union
+
+import anyio
+from alembic import op
+import sqlalchemy as sa
+
+from utils.storage import STORAGE_DIR, build_storage, save_file
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0012"
+down_revision: Union[str, Sequence[str], None] = "0011"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Items moved per round trip
+BATCH_SIZE = 1000
+
+# Directory the old upload routes saved pictures to, and the start of the
+# itemPic they saved
+LEGACY_PREFIX = "uploads/"
+
+# Lightweight view of the table as it is at this revision
+items = sa.table("items", sa.column("itemId"), sa.column("itemPic"))
+
+
+def legacy_file(itemPic: str) -> Optional[str]:
+    """
+    Finds the file of a legacy itemPic, relative to the working directory
+    as the old routes saved it, or in STORAGE_DIR if the files were moved
+    there.
+
+    :param itemPic: The item's `uploads/<filename>` value.
+    :return: The path of the file, or None if it is gone.
+    """
+    name = itemPic[len(LEGACY_PREFIX):]
+    for path in (itemPic, os.path.join(STORAGE_DIR, name)):
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+async def store_files(paths: dict[int, str]) -> dict[int, str]:
+    target = build_storage()
+    try:
+        return {itemId: await save_file(path, target) for itemId, path in paths.items()}
+    finally:
+        await target.close()
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    conn = op.get_bind()
+    lastId = 0
+    while True:
+        rows = conn.execute(
+            sa.select(items.c.itemId, items.c.itemPic)
+            .where(items.c.itemId > lastId, items.c.itemPic.like(f"{LEGACY_PREFIX}%"))
+            .order_by(items.c.itemId)
+            .limit(BATCH_SIZE)
+        ).all()
+        if not rows:
+            return
+        lastId = rows[-1][0]
+
+        paths = {itemId: legacy_file(itemPic) for itemId, itemPic in rows}
+        paths = {itemId: path for itemId, path in paths.items() if path}
+        if not paths:
+            continue
+        # Files are written before the rows point at them, and an unused
+        # file left by a failed run is picked up again by the next one
+        keys = anyio.run(store_files, paths)
+        conn.execute(
+            items.update()
+            .where(items.c.itemId == sa.bindparam("id"))
+            .values(itemPic=sa.bindparam("key")),
+            [{"id": itemId, "key": key} for itemId, key in keys.items()],
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    # The legacy files are left in place, but which item had which file
+    # name is not kept, so the items keep their content keys
+    pass
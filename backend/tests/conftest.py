@@ -0,0 +1,118 @@
+"""
+Settings for the test suite. The app reads them when its modules are
+imported, so they are set here before any test imports it. Run from the
+backend directory:
+
+    python -m pytest tests
+
+Tests run in DB_MODE=async unless DB_MODE is set, against a scratch SQLite
+database migrated once per session.
+"""
+import io
+import os
+import sys
+import tempfile
+import uuid
+from pathlib import Path
+import pytest
+
+# Directory holding the app, imported as top-level packages like the app does
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BACKEND_DIR))
+
+# Scratch directory of this run, for its databases and stored files
+SCRATCH_DIR = Path(tempfile.mkdtemp(prefix="backend-tests-"))
+
+os.environ["DATABASE_URL"] = f"sqlite:///{SCRATCH_DIR / 'app.db'}"
+os.environ["STORAGE_DIR"] = str(SCRATCH_DIR / "uploads")
+os.environ["SECRET_KEY"] = "test-secret-key"
+os.environ["API_KEY"] = "test-api-key"
+os.environ["API_KEY_NAME"] = "X-API-Key"
+# Tests drive the outbox worker themselves, see tests/test_outbox.py
+os.environ["OUTBOX_WORKER"] = "off"
+# Requests are not rate limited, the limiter is tested on its own
+os.environ["RATE_LIMIT_BACKEND"] = "off"
+os.environ["STATS_REFRESH_SECONDS"] = "0"
+os.environ["BCRYPT_ROUNDS"] = "4"
+
+# Headers of a request made with the admin API key
+ADMIN = {"X-API-Key": "test-api-key"}
+
+
+@pytest.fixture(scope="session")
+def database():
+    from db.init_db import create_schema
+
+    create_schema()
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+# Client of the app, started once per session. Its requests carry the
+# bearer token of a user it signs up
+@pytest.fixture(scope="session")
+def client(database):
+    from fastapi.testclient import TestClient
+    from main import app
+    from utils.jwt_utils import create_access_token
+
+    with TestClient(app) as client:
+        client.headers["Authorization"] = f"Bearer {create_access_token({'sub': new_user(client)})}"
+        yield client
+
+
+# Create a user through the API and return its ID
+def new_user(client) -> int:
+    from utils.jwt_utils import decode_access_token
+
+    body = {
+        "name": "Tester",
+        "email": f"{uuid.uuid4().hex[:12]}@example.com",
+        "phoneNumber": "5550100",
+        "address": "Street 1",
+        "password": "secret",
+    }
+    response = client.post("/api/v1/users/", json=body)
+    assert response.status_code == 200, response.text
+    return int(decode_access_token(response.json()["data"]["token"])["sub"])
+
+
+# A small PNG of a random color, so items rarely share a stored file
+def picture() -> bytes:
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new("RGB", (4, 4), tuple(os.urandom(3))).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+# Create an item through the API and return it as served by GET /items/{itemId}
+def new_item(client, stock: int = 10, category: str = None, item_name: str = None) -> dict:
+    suffix = uuid.uuid4().hex[:12]
+    form = {
+        "category": category or f"category-{suffix}",
+        "item_name": item_name or f"Item {suffix}",
+        "itemDesc": "An item",
+        "stock": str(stock),
+    }
+    files = {"itemPic": (f"{suffix}.png", picture(), "image/png")}
+    response = client.post("/api/v1/items/", data=form, files=files)
+    assert response.status_code == 200, response.text
+    itemId = int(response.json()["data"].split()[1])
+    return client.get(f"/api/v1/items/{itemId}").json()["data"]["item"]
+
+
+# The rollup of a category, as served by GET /items/stats
+def category_stats(client, category: str) -> dict:
+    categories = client.get("/api/v1/items/stats").json()["data"]["categories"]
+    return next(row for row in categories if row["category"] == category)
+
+
+# Let the outbox worker apply every pending event, on the app's event loop
+def drain(client):
+    from api.v1.orders.outbox import worker
+
+    client.portal.call(worker.drain)
@@ -0,0 +1,166 @@
+"""
+Tests of the item endpoints, through the app's client.
+"""
+import json
+import uuid
+from conftest import ADMIN, category_stats, new_item, new_user, picture
+from test_orders import place_order
+
+
+def test_item_in_an_order_is_not_deleted(client):
+    item = new_item(client, stock=5)
+    orderId = place_order(client, new_user(client), [(item, 1)])
+
+    # The order's line still points at the item
+    assert client.delete(f"/api/v1/items/{item['itemId']}").status_code == 400
+    assert client.get(f"/api/v1/items/{item['itemId']}").status_code == 200
+    assert client.get(f"/api/v1/orders/{orderId}").json()["data"]["orders"]["items"][0]["itemId"] == item["itemId"]
+
+    assert client.delete(f"/api/v1/orders/{orderId}").status_code == 200
+    assert client.delete(f"/api/v1/items/{item['itemId']}").status_code == 200
+    assert client.get(f"/api/v1/items/{item['itemId']}").status_code == 404
+
+
+def test_deleted_item_id_is_not_reused(client):
+    item = new_item(client)
+    assert client.delete(f"/api/v1/items/{item['itemId']}").status_code == 200
+    assert new_item(client)["itemId"] > item["itemId"]
+
+
+# Update an item through the API, with a new picture
+def update_item(client, item: dict, **changes):
+    form = {key: str(item[key]) for key in ("category", "item_name", "itemDesc", "stock")}
+    form.update({key: str(value) for key, value in changes.items()})
+    files = {"itemPic": ("new.png", picture(), "image/png")}
+    response = client.put(f"/api/v1/items/{item['itemId']}", data=form, files=files)
+    assert response.status_code == 200, response.text
+
+
+def test_writes_invalidate_cached_items_and_lists(client):
+    item = new_item(client, stock=5)
+    url = f"/api/v1/items/{item['itemId']}"
+    category = f"/api/v1/items/category/{item['category']}"
+    etag = client.get(url).headers["etag"]
+    assert [row["itemId"] for row in client.get(category).json()["data"]["items"]] == [item["itemId"]]
+
+    update_item(client, item, item_name="Renamed")
+    response = client.get(url)
+    assert response.json()["data"]["item"]["item_name"] == "Renamed"
+    assert response.headers["etag"] != etag
+
+    # A new item of the category retires the cached list
+    other = new_item(client, category=item["category"])
+    assert [row["itemId"] for row in client.get(category).json()["data"]["items"]] == [
+        item["itemId"],
+        other["itemId"],
+    ]
+
+    # So does an order, which changes the stock the payloads carry
+    place_order(client, new_user(client), [(item, 2)])
+    assert client.get(url).json()["data"]["item"]["stock"] == 3
+    assert client.get(category).json()["data"]["items"][0]["stock"] == 3
+
+
+def test_conditional_requests_get_304_until_the_item_changes(client):
+    item = new_item(client)
+    url = f"/api/v1/items/{item['itemId']}"
+    response = client.get(url)
+    etag = response.headers["etag"]
+    assert response.headers["cache-control"] == "public, no-cache"
+
+    response = client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+    assert client.get(url, headers={"If-None-Match": f'"other", W/{etag}'}).status_code == 304
+
+    update_item(client, item, stock=7)
+    response = client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json()["data"]["item"]["stock"] == 7
+
+    # Lists are validated by a hash of their payload
+    page = client.get("/api/v1/items/", params={"ids": str(item["itemId"])})
+    headers = {"If-None-Match": page.headers["etag"]}
+    assert client.get("/api/v1/items/", params={"ids": str(item["itemId"])}, headers=headers).status_code == 304
+
+
+def test_pages_and_stream_list_every_item_once(client):
+    created = [new_item(client)["itemId"] for _ in range(3)]
+
+    paged, after = [], None
+    while True:
+        params = {"limit": 2, **({"after": after} if after else {})}
+        page = client.get("/api/v1/items/", params=params).json()["data"]
+        assert len(page["items"]) <= 2
+        paged += [item["itemId"] for item in page["items"]]
+        after = page["next_cursor"]
+        if after is None:
+            break
+    assert paged == sorted(set(paged))
+    assert set(created) <= set(paged)
+
+    response = client.get("/api/v1/items/", params={"stream": "true"})
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    streamed = [json.loads(line)["itemId"] for line in response.text.splitlines()]
+    assert streamed == paged
+
+    assert client.get("/api/v1/items/", params={"after": "not a cursor"}).status_code == 400
+
+
+def test_search_ranks_filters_and_counts_facets(client):
+    category = f"lighting-{uuid.uuid4().hex[:8]}"
+    word = uuid.uuid4().hex[:10]
+    lamp = new_item(client, stock=3, category=category, item_name=f"Desk lamp {word}")
+    new_item(client, stock=3, category=category, item_name=f"Floor lamps {word}")
+    out = new_item(client, stock=1, category=category, item_name=f"Ceiling light {word}")
+    place_order(client, new_user(client), [(out, 1)])
+
+    def search(**params):
+        return client.get("/api/v1/items/search", params={"category": category, **params}).json()["data"]
+
+    # Words are stemmed, so "lamp" also finds "lamps"
+    result = search(q=f"lamp {word}")
+    assert result["total"] == 2
+    assert {item["item_name"] for item in result["items"]} == {f"Desk lamp {word}", f"Floor lamps {word}"}
+
+    result = search(q=word, in_stock="false")
+    assert [item["itemId"] for item in result["items"]] == [out["itemId"]]
+    # Each facet is counted with every filter but its own
+    assert result["facets"]["in_stock"] == {"true": 2, "false": 1}
+    assert result["facets"]["category"] == {category: 1}
+
+    result = search(q=word, limit=1, offset=1)
+    assert (result["total"], len(result["items"])) == (3, 1)
+    assert search(q="nothing-matches-this")["total"] == 0
+    assert lamp["itemId"] in [item["itemId"] for item in search()["items"]]
+
+
+def test_bulk_import_inserts_valid_rows_and_reports_the_rest(client):
+    category = f"imported-{uuid.uuid4().hex[:8]}"
+    csv = "\n".join(
+        [
+            "item_name,category,itemDesc,stock,itemPic",
+            f"Chair,{category},A chair,4,chair.png",
+            f"Table,{category},A table,not a number,table.png",
+            f",{category},No name,1,none.png",
+            f"Stool,{category},A stool,2,stool.png",
+        ]
+    )
+    files = {"file": ("items.csv", csv.encode(), "text/csv")}
+    response = client.post("/api/v1/items/bulk", files=files, headers=ADMIN)
+    assert response.status_code == 200, response.text
+    report = response.json()["data"]
+    assert (report["inserted"], report["failed"]) == (2, 2)
+    assert [error["line"] for error in report["errors"]] == [3, 4]
+
+    items = client.get(f"/api/v1/items/category/{category}").json()["data"]["items"]
+    assert [(item["item_name"], item["stock"]) for item in items] == [("Chair", 4), ("Stool", 2)]
+    assert category_stats(client, category)["stockTotal"] == 6
+
+    ndjson = json.dumps({"item_name": "Bench", "category": category, "itemDesc": "A bench", "stock": 1, "itemPic": "b.png"})
+    files = {"file": ("items.ndjson", f"{ndjson}\n{{broken\n".encode(), "application/x-ndjson")}
+    report = client.post("/api/v1/items/bulk", files=files, headers=ADMIN).json()["data"]
+    assert (report["inserted"], report["failed"]) == (1, 1)
+
+    # Without the admin key nothing is imported
+    assert client.post("/api/v1/items/bulk", files=files).status_code in (401, 403)
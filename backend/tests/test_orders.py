@@ -0,0 +1,98 @@
+"""
+Tests of the order endpoints, through the app's client.
+"""
+import uuid
+from datetime import date
+import anyio
+import pytest
+from sqlalchemy import update
+from conftest import category_stats, drain, new_item, new_user
+from db import dal
+from db.init_db import engine
+from db.models import Order, OrderStatus
+from db.session import open_session
+
+
+# Place an order through the API and return its ID
+def place_order(client, userId: int, lines: list[tuple[dict, int]]) -> int:
+    body = {"userId": userId, "items": [{**item, "qty": qty} for item, qty in lines]}
+    response = client.post("/api/v1/orders/", json=body)
+    assert response.status_code == 200, response.text
+    return int(response.json()["data"].split()[1])
+
+
+# The stock of an item as served by GET /items/{itemId}
+def stock(client, item: dict) -> int:
+    return client.get(f"/api/v1/items/{item['itemId']}").json()["data"]["item"]["stock"]
+
+
+def test_deleted_order_gives_its_stock_back(client):
+    userId = new_user(client)
+    item = new_item(client, stock=5)
+    other = new_item(client, stock=5, category=item["category"])
+    orderId = place_order(client, userId, [(item, 3), (other, 1)])
+    drain(client)
+    assert (stock(client, item), stock(client, other)) == (2, 4)
+    assert category_stats(client, item["category"])["stockTotal"] == 6
+
+    assert client.delete(f"/api/v1/orders/{orderId}").status_code == 200
+    assert (stock(client, item), stock(client, other)) == (5, 5)
+    assert client.get(f"/api/v1/orders/{orderId}").status_code == 404
+
+    drain(client)
+    assert category_stats(client, item["category"])["stockTotal"] == 10
+
+
+@pytest.mark.anyio
+async def test_concurrent_orders_never_oversell(database):
+    suffix = uuid.uuid4().hex[:12]
+    async with open_session() as session:
+        user = await dal.create_user(session, "Tester", f"{suffix}@example.com", "5550100", "Street 1", "secret")
+    async with open_session() as session:
+        item = await dal.create_item(session, f"Item {suffix}", f"category-{suffix}", "An item", 3, "item.png")
+
+    placed = []
+
+    async def order():
+        async with open_session() as session:
+            placed.append(await dal.create_order(session, user.id, [{"itemId": item.itemId, "qty": 1}]))
+
+    async with anyio.create_task_group() as tasks:
+        for _ in range(10):
+            tasks.start_soon(order)
+
+    # Only as many orders as there are units go through, the rest get None
+    assert sum(order is not None for order in placed) == 3
+    async with open_session() as session:
+        assert (await dal.read_item_by_id(session, item.itemId)).stock == 0
+
+
+def test_orders_are_filtered_and_sorted(client):
+    userId = new_user(client)
+    item = new_item(client)
+    orderIds = [place_order(client, userId, [(item, 1)]) for _ in range(3)]
+    dates = [date(2030, 1, 3), date(2030, 1, 1), date(2030, 1, 2)]
+    with engine.begin() as connection:
+        for orderId, deliveryDate in zip(orderIds, dates):
+            connection.execute(update(Order).where(Order.orderId == orderId).values(deliveryDate=deliveryDate))
+        connection.execute(
+            update(Order).where(Order.orderId == orderIds[0]).values(status=OrderStatus.delivered)
+        )
+
+    def listed(**params):
+        response = client.get("/api/v1/orders/", params={"userId": userId, **params})
+        assert response.status_code == 200, response.text
+        return [order["orderId"] for order in response.json()["data"]["orders"]]
+
+    assert listed() == orderIds
+    assert listed(status="delivered") == [orderIds[0]]
+    assert listed(status="confirmed") == orderIds[1:]
+    assert listed(deliveryFrom="2030-01-02", deliveryTo="2030-01-02") == [orderIds[2]]
+    assert listed(sort="deliveryDate") == [orderIds[1], orderIds[2], orderIds[0]]
+    assert listed(sort="-deliveryDate") == [orderIds[0], orderIds[2], orderIds[1]]
+
+    # Pages of a sorted listing follow on from each other
+    first = client.get("/api/v1/orders/", params={"userId": userId, "sort": "-deliveryDate", "limit": 2}).json()
+    after = first["data"]["next_cursor"]
+    assert listed(sort="-deliveryDate", after=after) == [orderIds[1]]
+    assert client.get("/api/v1/orders/", params={"status": "lost"}).status_code == 422
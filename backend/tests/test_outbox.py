@@ -0,0 +1,262 @@
+"""
+Tests of the order events of the outbox, see db/outbox.py, and of the rollups
+the worker keeps from them. The app's own worker is off, so each test drains
+the outbox itself with `worker.drain()`.
+"""
+import uuid
+from datetime import timedelta
+import pytest
+from sqlalchemy import func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from api.v1.orders import outbox
+from api.v1.orders.outbox import subscribers, worker
+from db import CRUD, async_CRUD, dal
+from db.models import CategoryStats, ItemStats, OutboxEvent, utcnow
+from db.order_lines import OrderConflict
+from db.outbox import ORDER_CREATED, finish_statement
+from db.session import open_session
+
+pytestmark = [pytest.mark.anyio, pytest.mark.usefixtures("database")]
+
+
+# Call a data access function with a session of its own
+async def run(fn, *args, **kwargs):
+    async with open_session() as session:
+        return await fn(session, *args, **kwargs)
+
+
+# A user and an item of a category no other test uses
+async def user_and_item(stock: int = 10):
+    suffix = uuid.uuid4().hex[:12]
+    user = await run(dal.create_user, "Tester", f"{suffix}@example.com", "5550100", "Street 1", "secret")
+    item = await run(dal.create_item, f"Item {suffix}", f"category-{suffix}", "An item", stock, "item.png")
+    return user, item
+
+
+# Run a blocking query function on a session of either DB_MODE
+async def read(fn):
+    async with open_session() as session:
+        if isinstance(session, AsyncSession):
+            return await session.run_sync(fn)
+        return fn(session)
+
+
+# The rollups of an item and its category, as (orderCount, unitsOrdered, stockTotal)
+async def rollups(item) -> tuple:
+    def query(session):
+        itemStats = session.get(ItemStats, item.itemId)
+        categoryStats = session.get(CategoryStats, item.category)
+        if itemStats is None:
+            return 0, 0, categoryStats.stockTotal
+        return itemStats.orderCount, itemStats.unitsOrdered, categoryStats.stockTotal
+
+    return await read(query)
+
+
+# Events of an order not processed yet
+async def pending(orderId: int) -> list[OutboxEvent]:
+    def query(session):
+        return session.scalars(
+            select(OutboxEvent)
+            .where(
+                OutboxEvent.idempotencyKey.like(f"%:{orderId}:%"),
+                OutboxEvent.processed_at.is_(None),
+            )
+            .order_by(OutboxEvent.eventId)
+        ).all()
+
+    return await read(query)
+
+
+# Let the lease or backoff of an order's events run out
+async def make_available(orderId: int):
+    def query(session):
+        session.execute(
+            update(OutboxEvent)
+            .where(OutboxEvent.idempotencyKey.like(f"%:{orderId}:%"))
+            .values(available_at=utcnow())
+        )
+        session.commit()
+
+    await read(query)
+
+
+# Number of events written so far
+async def event_count() -> int:
+    return await read(lambda session: session.scalar(select(func.count()).select_from(OutboxEvent)))
+
+
+class Crash(BaseException):
+    """Stands for the worker's process dying, which no handler catches."""
+
+
+async def test_order_publishes_its_event_in_its_transaction():
+    user, item = await user_and_item(stock=2)
+    order = await run(dal.create_order, user.id, [{"itemId": item.itemId, "qty": 2}])
+
+    # The event committed with the order, its changes wait for the worker
+    [event] = await pending(order.orderId)
+    assert event.kind == ORDER_CREATED
+    assert event.payload["lines"] == [{"itemId": item.itemId, "qty": 2, "category": item.category}]
+    assert await rollups(item) == (0, 0, 2)
+
+    # A write that rolls back leaves no event behind
+    count = await event_count()
+    assert await run(dal.create_order, user.id, [{"itemId": item.itemId, "qty": 1}]) is None
+    with pytest.raises(OrderConflict):
+        await run(dal.add_item_to_order, order.orderId, item.itemId)
+    assert await event_count() == count
+
+    await worker.drain()
+    assert await pending(order.orderId) == []
+    assert await rollups(item) == (1, 2, 0)
+
+
+async def test_failed_event_is_retried_after_a_backoff(monkeypatch):
+    calls = []
+
+    async def flaky(event):
+        calls.append(event.idempotencyKey)
+        if len(calls) == 1:
+            raise RuntimeError("subscriber is down")
+
+    monkeypatch.setitem(subscribers, ORDER_CREATED, [flaky])
+    user, item = await user_and_item()
+    order = await run(dal.create_order, user.id, [{"itemId": item.itemId, "qty": 2}])
+
+    await worker.drain()
+    [event] = await pending(order.orderId)
+    assert event.attempts == 1
+    assert "subscriber is down" in event.last_error
+    assert await rollups(item) == (0, 0, 10)
+
+    # Nothing is claimed again before the backoff runs out
+    await worker.drain()
+    assert [event.attempts for event in await pending(order.orderId)] == [1]
+    await make_available(order.orderId)
+    await worker.drain()
+    assert calls == [event.idempotencyKey] * 2
+    assert await pending(order.orderId) == []
+    assert await rollups(item) == (1, 2, 8)
+
+
+async def test_event_is_given_up_after_its_last_attempt(monkeypatch):
+    async def broken(event):
+        raise RuntimeError("subscriber is down")
+
+    monkeypatch.setitem(subscribers, ORDER_CREATED, [broken])
+    monkeypatch.setattr(outbox, "OUTBOX_MAX_ATTEMPTS", 2)
+    user, item = await user_and_item()
+    order = await run(dal.create_order, user.id, [{"itemId": item.itemId, "qty": 2}])
+
+    for _ in range(3):
+        await worker.drain()
+        await make_available(order.orderId)
+    [event] = await pending(order.orderId)
+    assert event.attempts == 2
+    assert await rollups(item) == (0, 0, 10)
+
+
+async def test_crash_before_the_event_is_marked_done_applies_it_once(monkeypatch):
+    user, item = await user_and_item()
+    order = await run(dal.create_order, user.id, [{"itemId": item.itemId, "qty": 2}])
+
+    [event] = await pending(order.orderId)
+
+    # The worker dies after applying the event's changes, before marking it
+    # processed, so its transaction never commits
+    def crash(claimed):
+        if claimed.eventId == event.eventId:
+            raise Crash()
+        return finish_statement(claimed)
+
+    for module in (CRUD, async_CRUD):
+        monkeypatch.setattr(module, "finish_statement", crash)
+    with pytest.raises(Crash):
+        await worker.drain()
+    monkeypatch.undo()
+    assert await rollups(item) == (0, 0, 10)
+
+    # Another worker takes the event over once the lease runs out
+    await worker.drain()
+    assert [event.attempts for event in await pending(order.orderId)] == [1]
+    await make_available(order.orderId)
+    await worker.drain()
+    assert await pending(order.orderId) == []
+    assert await rollups(item) == (1, 2, 8)
+
+
+async def test_worker_that_lost_its_claim_applies_nothing():
+    user, item = await user_and_item()
+    order = await run(dal.create_order, user.id, [{"itemId": item.itemId, "qty": 2}])
+    [event] = await pending(order.orderId)
+
+    # The first worker's lease runs out and a second worker claims the event
+    def claim():
+        return run(dal.claim_outbox_events, 100, timedelta(0), outbox.OUTBOX_MAX_ATTEMPTS)
+
+    [first] = [claimed for claimed in await claim() if claimed.eventId == event.eventId]
+    [second] = [claimed for claimed in await claim() if claimed.eventId == event.eventId]
+
+    assert await run(dal.process_outbox_event, second)
+    assert not await run(dal.process_outbox_event, first)
+    assert await pending(order.orderId) == []
+    assert await rollups(item) == (1, 2, 8)
+
+
+async def test_rebuild_leaves_pending_events_to_the_worker():
+    user, item = await user_and_item()
+    order = await run(dal.create_order, user.id, [{"itemId": item.itemId, "qty": 2}])
+    await run(dal.add_item_to_order, order.orderId, item.itemId)
+    assert len(await pending(order.orderId)) == 2
+
+    # The rebuild sees the order's lines, but not their events' changes yet
+    await run(dal.refresh_stats)
+    assert await rollups(item) == (0, 0, 10)
+
+    await worker.drain()
+    assert await rollups(item) == (1, 3, 7)
+
+    # Once processed, the rebuild and the worker agree
+    await run(dal.refresh_stats)
+    assert await rollups(item) == (1, 3, 7)
+
+
+async def test_rebuild_leaves_a_pending_deletion_to_the_worker():
+    user, item = await user_and_item()
+    order = await run(dal.create_order, user.id, [{"itemId": item.itemId, "qty": 2}])
+    await worker.drain()
+    await run(dal.delete_order_by_id, order.orderId)
+
+    # The order's lines are gone and its stock is back, its deletion is
+    # still to be counted
+    await run(dal.refresh_stats)
+    assert await rollups(item) == (1, 2, 8)
+
+    await worker.drain()
+    assert await rollups(item) == (0, 0, 10)
+    await run(dal.refresh_stats)
+    assert await rollups(item) == (0, 0, 10)
+
+
+async def test_events_of_a_deleted_item_are_skipped():
+    user, item = await user_and_item(stock=5)
+    order = await run(dal.create_order, user.id, [{"itemId": item.itemId, "qty": 1}])
+    # The order's line holds on to the item until the order goes
+    assert await run(dal.delete_item_by_id, item.itemId) is None
+    await run(dal.delete_order_by_id, order.orderId)
+    assert await run(dal.delete_item_by_id, item.itemId)
+    other = await run(dal.create_item, "Other", item.category, "An item", 5, "item.png")
+
+    # Both events of the order are still pending, and only the new item's
+    # stock is left in the category
+    assert len(await pending(order.orderId)) == 2
+    await run(dal.refresh_stats)
+    assert await rollups(other) == (0, 0, 5)
+
+    await worker.drain()
+    assert await pending(order.orderId) == []
+    assert await rollups(item) == (0, 0, 5)
+    await run(dal.refresh_stats)
+    assert await rollups(other) == (0, 0, 5)
+
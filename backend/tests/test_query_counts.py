@@ -0,0 +1,29 @@
+"""
+Runs the statement budgets of benchmarks/query_counts.py in both DB_MODEs,
+so an endpoint that goes over its budget fails the suite.
+"""
+import os
+import subprocess
+import sys
+import pytest
+from conftest import BACKEND_DIR
+
+
+# DB_MODE is read when the app is imported, so each mode gets its own process
+@pytest.mark.parametrize("db_mode", ["async", "sync"])
+def test_query_budgets(db_mode, tmp_path):
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "benchmarks.query_counts",
+            "--url",
+            f"sqlite:///{tmp_path / 'budgets.db'}",
+        ],
+        cwd=BACKEND_DIR,
+        env={**os.environ, "DB_MODE": db_mode},
+        capture_output=True,
+        text=True,
+        timeout=300,
+    )
+    assert result.returncode == 0, result.stdout + result.stderr
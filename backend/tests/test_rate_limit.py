@@ -0,0 +1,101 @@
+"""
+Tests of the token buckets of utils/rate_limit.py and of the middleware
+that applies them. The app's limiter is off, tests that go through the app
+swap in one of their own.
+"""
+import logging
+from types import SimpleNamespace
+import pytest
+from middleware import rate_limit as middleware
+from utils import rate_limit
+from utils.rate_limit import MemoryBuckets, RateLimiter
+
+pytestmark = pytest.mark.anyio
+
+
+# A clock tests move by hand, in place of time.monotonic for the buckets
+# only, the event loop keeps the real one
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rate_limit, "time", SimpleNamespace(monotonic=clock))
+    return clock
+
+
+class DownBackend:
+    """Stands for a shared backend whose server cannot be reached."""
+
+    def __init__(self):
+        self.calls = 0
+
+    async def take(self, key: str, rate: float, burst: float, cost: float) -> float:
+        self.calls += 1
+        raise ConnectionError("server is down")
+
+
+async def test_bucket_allows_its_burst_then_refills_at_its_rate(clock):
+    buckets = MemoryBuckets()
+    assert [await buckets.take("a", 2, 3, 1) for _ in range(3)] == [0, 0, 0]
+    assert await buckets.take("a", 2, 3, 1) == 0.5
+    # Other clients have buckets of their own
+    assert await buckets.take("b", 2, 3, 1) == 0
+
+    clock.now += 0.5
+    assert await buckets.take("a", 2, 3, 1) == 0
+    assert await buckets.take("a", 2, 3, 1) == 0.5
+
+    # A bucket left alone refills up to its burst, no further
+    clock.now += 60
+    assert [await buckets.take("a", 2, 3, 1) for _ in range(4)] == [0, 0, 0, 0.5]
+
+
+async def test_least_recently_used_buckets_are_dropped(clock):
+    buckets = MemoryBuckets(maxsize=2)
+    for key in ("a", "b", "a", "c"):
+        await buckets.take(key, 1, 1, 1)
+    assert list(buckets._buckets) == ["a", "c"]
+    # A dropped client starts again with a full bucket
+    assert await buckets.take("b", 1, 1, 1) == 0
+
+
+async def test_limiter_caps_the_cost_and_falls_back_when_its_backend_fails(clock, caplog):
+    caplog.set_level(logging.INFO, logger=rate_limit.__name__)
+    backend = DownBackend()
+    limiter = RateLimiter(backend, {"user": (1, 5)})
+    # A request costing more than the burst can still go through once full
+    assert await limiter.take("user", "1", cost=50) == 0
+    assert await limiter.take("user", "1") == 1
+    assert backend.calls == 2
+
+    # The local buckets take over until the backend answers again, and the
+    # outage is logged once
+    limiter.backend = MemoryBuckets()
+    assert await limiter.take("user", "1") == 0
+    assert [record.getMessage() for record in caplog.records] == [
+        "Rate limit backend failed, using local buckets",
+        "Rate limit backend is back",
+    ]
+
+
+def test_client_over_its_limit_gets_429_with_retry_after(client, clock, monkeypatch):
+    limits = {"user": (0.5, 2), "api_key": (1, 1), "ip": (1, 1)}
+    monkeypatch.setattr(middleware, "limiter", RateLimiter(MemoryBuckets(), limits))
+    statuses = [client.get("/api/v1/items/stats").status_code for _ in range(3)]
+    assert statuses == [200, 200, 429]
+    response = client.get("/api/v1/items/stats")
+    assert response.headers["retry-after"] == "2"
+    assert response.json() == {"detail": "Too many requests"}
+
+    # Monitoring is never limited
+    assert client.get("/metrics").status_code == 200
+
+    clock.now += 2
+    assert client.get("/api/v1/items/stats").status_code == 200
@@ -0,0 +1,66 @@
+"""
+Tests of item reviews and of the ratings computed from them.
+"""
+from conftest import category_stats, new_item
+
+
+# Post a review of an item as the client's user
+def review(client, item: dict, rating: int, text: str = "Fine"):
+    response = client.post(f"/api/v1/items/{item['itemId']}/reviews", json={"rating": rating, "text": text})
+    assert response.status_code == 201, response.text
+    return response.json()["data"]["review"]
+
+
+# An item as served by GET /items/{itemId}
+def read_item(client, item: dict) -> dict:
+    return client.get(f"/api/v1/items/{item['itemId']}").json()["data"]["item"]
+
+
+def test_reviews_rate_the_item_search_and_category(client):
+    good = new_item(client)
+    fair = new_item(client, category=good["category"])
+    new_item(client, category=good["category"])
+    for rating in (5, 4):
+        review(client, good, rating)
+    for rating in (4, 2, 3):
+        review(client, fair, rating)
+
+    assert (read_item(client, good)["averageRating"], read_item(client, good)["rating"]) == (4.5, 4)
+    assert (read_item(client, fair)["ratingCount"], read_item(client, fair)["rating"]) == (3, 3)
+
+    # The unrated item is in no rating bucket and passes no rating filter
+    search = client.get("/api/v1/items/search", params={"category": good["category"]}).json()["data"]
+    assert search["facets"]["rating"] == {"4": 1, "3": 1, "null": 1}
+    search = client.get(
+        "/api/v1/items/search", params={"category": good["category"], "min_rating": 4}
+    ).json()["data"]
+    assert [item["itemId"] for item in search["items"]] == [good["itemId"]]
+
+    # The category's average is over all five ratings
+    assert category_stats(client, good["category"])["averageRating"] == 18 / 5
+
+
+def test_reviews_are_paged_newest_first(client):
+    item = new_item(client)
+    posted = [review(client, item, 3, f"Review {n}")["reviewId"] for n in range(5)]
+    url = f"/api/v1/items/{item['itemId']}/reviews"
+
+    paged, after = [], None
+    while True:
+        response = client.get(url, params={"limit": 2, **({"after": after} if after else {})})
+        assert response.status_code == 200, response.text
+        page = response.json()["data"]
+        assert len(page["reviews"]) <= 2
+        paged += [review["reviewId"] for review in page["reviews"]]
+        after = page["next_cursor"]
+        if after is None:
+            break
+    assert paged == posted[::-1]
+
+    assert client.get(url, params={"after": "not a cursor"}).status_code == 400
+    assert client.get("/api/v1/items/999999999/reviews").status_code == 404
+    # An item nobody reviewed has an empty first page
+    assert client.get(f"/api/v1/items/{new_item(client)['itemId']}/reviews").json()["data"] == {
+        "reviews": [],
+        "next_cursor": None,
+    }
@@ -0,0 +1,44 @@
+"""
+Tests of stored item pictures.
+"""
+from alembic import command
+from sqlalchemy import create_engine, insert, select
+from conftest import new_item, picture
+from db.init_db import alembic_config
+from db.models import Item
+from utils.storage import storage
+
+
+def test_legacy_pictures_move_to_content_keys(tmp_path, monkeypatch):
+    # The old routes saved pictures under uploads/ in the working directory
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "uploads").mkdir()
+    (tmp_path / "uploads" / "lamp.png").write_bytes(picture())
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    with engine.begin() as connection:
+        command.upgrade(alembic_config(connection), "0011")
+        connection.execute(
+            insert(Item.__table__).values(
+                [
+                    {"item_name": name, "category": "lamps", "itemDesc": name, "stock": 1, "itemPic": pic}
+                    for name, pic in (("Lamp", "uploads/lamp.png"), ("Gone", "uploads/gone.png"))
+                ]
+            )
+        )
+        command.upgrade(alembic_config(connection), "0012")
+        lamp, gone = connection.scalars(select(Item.itemPic).order_by(Item.itemId)).all()
+    engine.dispose()
+
+    assert lamp.endswith(".png") and not lamp.startswith("uploads/")
+    assert (tmp_path / "uploads" / "lamp.png").read_bytes() == open(storage.path(lamp), "rb").read()
+    assert gone == "uploads/gone.png"
+
+
+def test_item_image_is_served(client):
+    item = new_item(client)
+    response = client.get(f"/api/v1/items/{item['itemId']}/image")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/png"
+    headers = {"If-None-Match": response.headers["etag"]}
+    assert client.get(f"/api/v1/items/{item['itemId']}/image", headers=headers).status_code == 304
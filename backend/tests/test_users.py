@@ -0,0 +1,25 @@
+"""
+Tests of the user endpoints, through the app's client.
+"""
+from conftest import ADMIN, new_user
+
+
+# A user as served by GET /users/{id}
+def read_user(client, id: int) -> dict:
+    return client.get(f"/api/v1/users/{id}", headers=ADMIN).json()["data"]["user"]
+
+
+def test_update_to_a_taken_email_conflicts(client):
+    taken = read_user(client, new_user(client))
+    id = new_user(client)
+    user = read_user(client, id)
+    body = {key: user[key] for key in ("name", "phoneNumber", "address")}
+
+    response = client.put(f"/api/v1/users/{id}", json={**body, "email": taken["email"]})
+    assert response.status_code == 409
+    assert read_user(client, id)["email"] == user["email"]
+
+    # The session is usable again after the rollback
+    response = client.put(f"/api/v1/users/{id}", json={**body, "name": "Renamed", "email": user["email"]})
+    assert response.status_code == 200
+    assert read_user(client, id)["name"] == "Renamed"
@@ -0,0 +1,44 @@
+from typing import Callable, Iterable, TypeVar
+
+# Most IDs a batch request may ask for, which bounds the IN list
+MAX_BATCH_IDS = 100
+
+T = TypeVar("T")
+
+
+def parse_ids(value: str) -> list[int]:
+    """
+    Parses the comma-separated `ids` query parameter of a batch GET.
+
+    :param value: E.g. "3,1,2".
+    :return: The IDs in request order, each once.
+    :raises ValueError: If an ID is not an integer, or there are none or
+        more than MAX_BATCH_IDS.
+    """
+    try:
+        ids = unique_ids(int(part) for part in value.split(",") if part.strip())
+    except ValueError:
+        raise ValueError("ids must be comma-separated integers") from None
+    if not 1 <= len(ids) <= MAX_BATCH_IDS:
+        raise ValueError(f"ids must hold between 1 and {MAX_BATCH_IDS} IDs")
+    return ids
+
+
+# Drop repeated IDs, keeping the position of the first of each
+def unique_ids(ids: Iterable[int]) -> list[int]:
+    return list(dict.fromkeys(ids))
+
+
+def in_request_order(
+    ids: list[int], rows: Iterable[T], key: Callable[[T], int]
+) -> tuple[list[T], list[int]]:
+    """
+    Puts the rows an IN query returned back in the order they were asked for.
+
+    :param ids: The requested IDs, without repeats.
+    :param rows: The rows found, in any order.
+    :param key: Returns the ID of a row.
+    :return: The rows in request order, and the IDs no row was found for.
+    """
+    found = {key(row): row for row in rows}
+    return [found[id] for id in ids if id in found], [id for id in ids if id not in found]
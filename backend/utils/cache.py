@@ -0,0 +1,221 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# "memory" keeps entries in this process, "redis" shares them between
+# workers through a Redis-compatible server at REDIS_URL
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory")
+CACHE_TTL = int(os.getenv("CACHE_TTL", "60"))
+CACHE_MAXSIZE = int(os.getenv("CACHE_MAXSIZE", "10000"))
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+
+class MemoryCache:
+    """
+    In-process cache with a TTL per entry and LRU eviction.
+
+    Version counters live apart from the cached entries so that evicting
+    entries can never reset a counter.
+    """
+
+    def __init__(self, maxsize: int = CACHE_MAXSIZE):
+        self.maxsize = maxsize
+        self._entries: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self._counters: dict[str, int] = {}
+
+    async def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    async def get_many(self, keys: list[str]) -> list[Optional[str]]:
+        return [await self.get(key) for key in keys]
+
+    async def set(self, key: str, value: str, ttl: int):
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    async def delete(self, *keys: str):
+        for key in keys:
+            self._entries.pop(key, None)
+
+    async def counter(self, key: str) -> int:
+        return self._counters.get(key, 0)
+
+    async def incr(self, key: str) -> int:
+        self._counters[key] = self._counters.get(key, 0) + 1
+        return self._counters[key]
+
+
+class RedisCache:
+    """
+    Cache stored in a Redis-compatible server.
+
+    Any client exposing the async `get`, `mget`, `set`, `delete` and `incr`
+    commands of `redis.asyncio.Redis` works, including an in-memory fake.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    async def get(self, key: str) -> Optional[str]:
+        value = await self.client.get(key)
+        if isinstance(value, bytes):
+            value = value.decode("utf-8")
+        return value
+
+    async def get_many(self, keys: list[str]) -> list[Optional[str]]:
+        values = await self.client.mget(keys)
+        return [value.decode("utf-8") if isinstance(value, bytes) else value for value in values]
+
+    async def set(self, key: str, value: str, ttl: int):
+        await self.client.set(key, value, ex=ttl)
+
+    async def delete(self, *keys: str):
+        if keys:
+            await self.client.delete(*keys)
+
+    async def counter(self, key: str) -> int:
+        value = await self.client.get(key)
+        return int(value) if value is not None else 0
+
+    async def incr(self, key: str) -> int:
+        return await self.client.incr(key)
+
+
+class ReadThroughCache:
+    """
+    Read-through cache of serialized payloads in front of a backend.
+
+    Concurrent misses on the same key in this process share a single load,
+    so a hot key that expires costs one database query instead of one per
+    waiting request. A load that races with an invalidation of its key is
+    returned to the caller but not stored.
+    """
+
+    def __init__(self, backend, ttl: int = CACHE_TTL):
+        self.backend = backend
+        self.ttl = ttl
+        self._locks: dict[str, list] = {}
+        self._epochs: dict[str, int] = {}
+
+    async def get_or_load(
+        self, key: str, loader: Callable[[], Awaitable[Optional[str]]]
+    ) -> Optional[str]:
+        """
+        Returns the cached payload for `key`, loading it on a miss.
+
+        :param key: The cache key.
+        :param loader: Coroutine function returning the serialized payload,
+            or None when there is nothing to cache.
+        :return: The payload, or None if the loader found nothing.
+        """
+        value = await self.backend.get(key)
+        if value is not None:
+            return value
+
+        entry = self._acquire(key)
+        try:
+            async with entry[0]:
+                # Another request may have loaded the key while we waited
+                value = await self.backend.get(key)
+                if value is not None:
+                    return value
+                epoch = self._epochs.get(key, 0)
+                value = await loader()
+                if value is not None and self._epochs.get(key, 0) == epoch:
+                    await self.backend.set(key, value, self.ttl)
+                return value
+        finally:
+            self._release(key)
+
+    async def get_many_or_load(
+        self,
+        keys: list[str],
+        loader: Callable[[list[str]], Awaitable[dict[str, str]]],
+    ) -> list[Optional[str]]:
+        """
+        Returns the cached payloads for `keys`, loading all misses at once.
+
+        Misses are not deduplicated against concurrent loads of the same
+        keys, since waiting on every key's lock would serialize batches, but
+        a load racing with an invalidation is still not stored.
+
+        :param keys: The cache keys.
+        :param loader: Coroutine function taking the missed keys and
+            returning the payloads it found, by key.
+        :return: The payloads in the order of `keys`, None where the
+            loader found nothing.
+        """
+        values = await self.backend.get_many(keys)
+        missing = [key for key, value in zip(keys, values) if value is None]
+        if not missing:
+            return values
+
+        for key in missing:
+            self._acquire(key)
+        try:
+            epochs = {key: self._epochs.get(key, 0) for key in missing}
+            loaded = await loader(missing)
+            for key, value in loaded.items():
+                if self._epochs.get(key, 0) == epochs[key]:
+                    await self.backend.set(key, value, self.ttl)
+        finally:
+            for key in missing:
+                self._release(key)
+        return [loaded.get(key) if value is None else value for key, value in zip(keys, values)]
+
+    # Register interest in a key, so invalidations of it are counted
+    def _acquire(self, key: str) -> list:
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        return entry
+
+    def _release(self, key: str):
+        entry = self._locks[key]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self._locks[key]
+            self._epochs.pop(key, None)
+
+    async def invalidate(self, *keys: str):
+        for key in keys:
+            if key in self._locks:
+                self._epochs[key] = self._epochs.get(key, 0) + 1
+        await self.backend.delete(*keys)
+
+    async def version(self, key: str) -> int:
+        return await self.backend.counter(key)
+
+    async def bump(self, key: str) -> int:
+        return await self.backend.incr(key)
+
+
+# Build the backend selected by CACHE_BACKEND
+def build_backend():
+    if CACHE_BACKEND == "memory":
+        return MemoryCache()
+    if CACHE_BACKEND == "redis":
+        try:
+            from redis import asyncio as redis
+        except ImportError as e:
+            raise RuntimeError("CACHE_BACKEND=redis requires the redis package") from e
+        return RedisCache(redis.from_url(REDIS_URL))
+    raise ValueError(f"CACHE_BACKEND must be 'memory' or 'redis', got {CACHE_BACKEND!r}")
+
+
+# Shared cache instance, tests can swap `cache.backend` for a fake
+cache = ReadThroughCache(build_backend())
@@ -1,4 +1,25 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
 import bcrypt
+from dotenv import load_dotenv
+from fastapi import HTTPException
+
+load_dotenv()
+
+# bcrypt cost factor for new hashes. Changing it makes `needs_rehash` true
+# for existing hashes, which are then upgraded on the user's next login
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+# Processes dedicated to hashing, so a login burst cannot starve the
+# workers serving other endpoints
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", max(1, (os.cpu_count() or 2) // 2)))
+# Hash operations allowed to run or wait at once before new ones are shed
+HASH_QUEUE_LIMIT = int(os.getenv("HASH_QUEUE_LIMIT", HASH_WORKERS * 8))
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pending = 0
 
 
 def hash_password(password: str) -> str:
@@ -9,7 +30,7 @@ def hash_password(password: str) -> str:
     :return: The hashed password as a string.
     """
     # Generate a salt
-    salt = bcrypt.gensalt()
+    salt = bcrypt.gensalt(rounds=BCRYPT_ROUNDS)
     # Hash the password
     hashed_password = bcrypt.hashpw(password.encode("utf-8"), salt)
     # Return the hashed password as a string
@@ -28,3 +49,83 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
     return bcrypt.checkpw(
         plain_password.encode("utf-8"), hashed_password.encode("utf-8")
     )
+
+
+def needs_rehash(hashed_password: str) -> bool:
+    """
+    Checks whether a hash was made with a different cost factor.
+
+    :param hashed_password: A bcrypt hash such as `$2b$12$...`.
+    :return: True if the hash should be replaced with a new one.
+    """
+    try:
+        rounds = int(hashed_password.split("$")[2])
+    except (IndexError, ValueError):
+        return True
+    return rounds != BCRYPT_ROUNDS
+
+
+def get_hash_pool() -> ProcessPoolExecutor:
+    """
+    Returns the process pool used for hashing, starting it on first use.
+
+    Workers are spawned rather than forked, so they do not inherit the
+    event loop or open database connections of the server process.
+    """
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(
+            max_workers=HASH_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _pool
+
+
+def shutdown_hash_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+async def run_in_hash_pool(fn, *args):
+    """
+    Runs a hashing function on the process pool.
+
+    :raises HTTPException: 503 with Retry-After when HASH_QUEUE_LIMIT
+        operations are already running or queued.
+    """
+    global _pending
+    if _pending >= HASH_QUEUE_LIMIT:
+        raise HTTPException(
+            status_code=503,
+            detail="Too many authentication requests, please retry shortly",
+            headers={"Retry-After": "1"},
+        )
+    _pending += 1
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(get_hash_pool(), fn, *args)
+    finally:
+        _pending -= 1
+
+
+async def hash_password_async(password: str) -> str:
+    """
+    Hashes a password on the hashing process pool.
+
+    :param password: The password to hash.
+    :return: The hashed password as a string.
+    """
+    return await run_in_hash_pool(hash_password, password)
+
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    """
+    Verifies a password on the hashing process pool.
+
+    :param plain_password: The plain text password to verify.
+    :param hashed_password: The hashed password to compare against.
+    :return: True if the password matches, False otherwise.
+    """
+    return await run_in_hash_pool(verify_password, plain_password, hashed_password)
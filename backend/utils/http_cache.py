@@ -0,0 +1,83 @@
+import hashlib
+import os
+from datetime import datetime, timezone
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Optional
+from dotenv import load_dotenv
+from fastapi import Request
+from fastapi.responses import Response
+
+load_dotenv()
+
+# Cache-Control of the cacheable read routes, by name. Each one can be
+# overridden with CACHE_CONTROL_<NAME>, e.g. to let a CDN keep item pages
+# for a minute: CACHE_CONTROL_ITEM_LIST="public, s-maxage=60". `no-cache`
+# makes clients revalidate with the ETag every time, which costs a 304
+CACHE_POLICIES = {
+    name: os.getenv(f"CACHE_CONTROL_{name.upper()}", default)
+    for name, default in {
+        "item": "public, no-cache",
+        "item_list": "public, no-cache",
+        "order": "private, no-cache",
+        "user": "private, no-cache",
+    }.items()
+}
+
+
+def make_etag(*parts) -> str:
+    """
+    Builds a strong ETag from the values that identify a representation.
+
+    :param parts: E.g. a row's version and update time, or a whole payload.
+    """
+    digest = hashlib.blake2b(digest_size=12)
+    for part in parts:
+        digest.update(str(part).encode("utf-8"))
+        digest.update(b"\x00")
+    return f'"{digest.hexdigest()}"'
+
+
+# Seconds since the epoch of a column value. SQLite hands back naive
+# datetimes, which the app always writes in UTC
+def timestamp(value: datetime) -> float:
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+def not_modified(request: Request, etag: str, mtime: Optional[float]) -> bool:
+    """
+    Checks the request's validators against the current representation.
+
+    If-None-Match takes precedence over If-Modified-Since, as in RFC 9110.
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is None or mtime is None:
+        return False
+    try:
+        return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+    except (TypeError, ValueError):
+        return False
+
+
+def cache_headers(policy: str, etag: str, mtime: Optional[float] = None) -> dict:
+    """
+    Builds the validator and caching headers of a response.
+
+    :param policy: A name from CACHE_POLICIES.
+    :param etag: The ETag of the representation.
+    :param mtime: Its last modification time, if known.
+    """
+    headers = {"etag": etag, "cache-control": CACHE_POLICIES[policy]}
+    if mtime is not None:
+        headers["last-modified"] = formatdate(mtime, usegmt=True)
+    return headers
+
+
+# 304 Not Modified carries the same validators as the 200 it stands for
+def not_modified_response(headers: dict) -> Response:
+    return Response(status_code=304, headers=headers)
@@ -0,0 +1,152 @@
+import asyncio
+import io
+import logging
+import os
+from typing import Optional
+import anyio
+from dotenv import load_dotenv
+from utils.storage import IMAGE_TYPES, storage
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Variants generated for every uploaded image, by name. Each one fits in a
+# square of this many pixels and keeps the original's aspect ratio
+IMAGE_SIZES = {"thumb": 128, "small": 320, "medium": 640}
+WEBP_QUALITY = int(os.getenv("WEBP_QUALITY", "80"))
+# Variants rendered at once. Pillow releases the GIL while resizing, so
+# these run on threads without holding up the event loop
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+# Images waiting for variants before new ones are dropped. A dropped image
+# is queued again the first time one of its variants is requested
+IMAGE_QUEUE_LIMIT = int(os.getenv("IMAGE_QUEUE_LIMIT", "1000"))
+
+
+def variant_key(key: str, size: str) -> str:
+    """
+    Builds the storage key of a resized variant of a stored image.
+
+    Variant keys derive from the original's content-addressed key, so a
+    variant never needs invalidating.
+
+    :param key: The storage key of the original image.
+    :param size: A name from IMAGE_SIZES.
+    """
+    stem = os.path.splitext(key)[0]
+    return f"variants/{stem}_{size}.webp"
+
+
+def render_variant(data: bytes, box: int) -> bytes:
+    """
+    Resizes an image to fit in a `box` x `box` square and encodes it as WebP.
+
+    Blocking and CPU-bound, so callers run it on a worker thread.
+
+    :param data: The original image.
+    :param box: The largest width and height of the variant.
+    :return: The encoded WebP image.
+    """
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(data)) as image:
+        # Apply the camera's orientation before the EXIF data is dropped
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((box, box))
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+        output = io.BytesIO()
+        image.save(output, format="WEBP", quality=WEBP_QUALITY, method=4)
+        return output.getvalue()
+
+
+class VariantPipeline:
+    """
+    Background workers that render the IMAGE_SIZES variants of uploads.
+
+    Uploads only enqueue their key, so the request never waits for the
+    resizing. Without Pillow installed no variants are rendered and the
+    originals are served instead.
+    """
+
+    def __init__(self, workers: int = IMAGE_WORKERS, limit: int = IMAGE_QUEUE_LIMIT):
+        self.workers = workers
+        self.limit = limit
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: list[asyncio.Task] = []
+        self._queued: set[str] = set()
+
+    @property
+    def enabled(self) -> bool:
+        try:
+            import PIL  # noqa: F401
+        except ImportError:
+            return False
+        return True
+
+    def start(self):
+        if not self.enabled:
+            logger.warning("Pillow is not installed, image variants are disabled")
+            return
+        self._queue = asyncio.Queue(maxsize=self.limit)
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+        self._queued.clear()
+
+    def submit(self, key: str) -> bool:
+        """
+        Queues the variants of a stored image for rendering.
+
+        :param key: The storage key of the original image.
+        :return: False if the image was not queued, because it is not a
+            supported image, the pipeline is not running or it is full.
+        """
+        if self._queue is None or os.path.splitext(key)[1] not in IMAGE_TYPES:
+            return False
+        if key in self._queued:
+            return True
+        try:
+            self._queue.put_nowait(key)
+        except asyncio.QueueFull:
+            return False
+        self._queued.add(key)
+        return True
+
+    async def _work(self):
+        while True:
+            key = await self._queue.get()
+            try:
+                await self.render(key)
+            except Exception:
+                logger.exception("Rendering variants of %s failed", key)
+            finally:
+                self._queued.discard(key)
+                self._queue.task_done()
+
+    async def render(self, key: str):
+        missing = [
+            (size, box)
+            for size, box in IMAGE_SIZES.items()
+            if not await storage.exists(variant_key(key, size))
+        ]
+        if not missing:
+            return
+        # Uploads are capped at MAX_UPLOAD_SIZE, so the original fits in memory
+        data = b"".join([chunk async for chunk in storage.read(key)])
+        for size, box in missing:
+            variant = await anyio.to_thread.run_sync(render_variant, data, box)
+            await storage.write(variant_key(key, size), single_chunk(variant), "image/webp")
+
+
+async def single_chunk(data: bytes):
+    yield data
+
+
+# Shared pipeline, started and stopped with the app
+pipeline = VariantPipeline()
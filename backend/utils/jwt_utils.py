@@ -1,8 +1,10 @@
-from fastapi import Security
-from fastapi import security
+from collections import OrderedDict
+from threading import Lock
+from fastapi import HTTPException, Request, Security
 from fastapi.security import HTTPAuthorizationCredentials
 from fastapi.security import HTTPBearer
 import jwt
+import time
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 import os
@@ -11,10 +13,54 @@ load_dotenv()
 
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = "HS256"
+# Number of verified tokens remembered by `token_cache`
+JWT_CACHE_SIZE = int(os.getenv("JWT_CACHE_SIZE", "1024"))
+
+
+class TokenCache:
+    """
+    LRU of tokens whose signature has already been verified.
+
+    Entries are keyed by the whole token, never by the signature alone,
+    so a cached result cannot be replayed for a different payload. Each
+    entry is dropped once the token's `exp` has passed.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._entries: OrderedDict[str, dict] = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, token: str) -> dict | None:
+        with self._lock:
+            payload = self._entries.get(token)
+            if payload is None:
+                return None
+            if payload["exp"] <= time.time():
+                del self._entries[token]
+                return None
+            self._entries.move_to_end(token)
+            return payload
+
+    def put(self, token: str, payload: dict):
+        # Tokens without an expiry are never cached
+        if not isinstance(payload.get("exp"), (int, float)):
+            return
+        with self._lock:
+            self._entries[token] = payload
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+token_cache = TokenCache(JWT_CACHE_SIZE)
 
 
 def create_access_token(data: dict, expires_delta: timedelta = timedelta(days=1)):
     to_encode = data.copy()
+    # The JWT spec requires `sub` to be a string
+    if "sub" in to_encode:
+        to_encode["sub"] = str(to_encode["sub"])
     expire = datetime.now() + expires_delta
     to_encode.update({"exp": expire})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
@@ -22,13 +68,29 @@ def create_access_token(data: dict, expires_delta: timedelta = timedelta(days=1)
 
 
 def decode_access_token(token: str):
+    payload = token_cache.get(token)
+    if payload is not None:
+        return payload
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        return payload
     except jwt.ExpiredSignatureError:
         return {"error": "Token has expired", "status": 401}
     except jwt.PyJWTError:
         return {"error": "Invalid token", "status": 401}
+    token_cache.put(token, payload)
+    return payload
+
 
-def get_current_user(credentials: HTTPAuthorizationCredentials = Security(HTTPBearer())):
-    return decode_access_token(credentials.credentials)
\ No newline at end of file
+# Reuse the claims JWTMiddleware decoded for this request, if any
+async def get_current_user(
+    request: Request,
+    credentials: HTTPAuthorizationCredentials = Security(HTTPBearer()),
+):
+    token = credentials.credentials
+    if getattr(request.state, "jwt_token", None) == token:
+        payload = request.state.jwt_claims
+    else:
+        payload = decode_access_token(token)
+    if "error" in payload:
+        raise HTTPException(status_code=payload["status"], detail=payload["error"])
+    return payload
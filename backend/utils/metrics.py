@@ -0,0 +1,270 @@
+import bisect
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextvars import ContextVar
+from typing import Optional
+from dotenv import load_dotenv
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+load_dotenv()
+
+# Requests at least this slow are profiled by sampling the event loop's
+# stack. Unset (the default) leaves the profiler off
+PROFILE_SLOW_MS = os.getenv("PROFILE_SLOW_MS")
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+# Profiles of the most recent slow requests that are kept
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "20"))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class Histogram:
+    """
+    Cumulative histogram per label set, rendered in the Prometheus format.
+
+    Only updated from the event loop thread, so it needs no lock.
+    """
+
+    def __init__(self, name: str, help: str, buckets: tuple):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self._series: dict[tuple, list] = {}
+
+    def observe(self, labels: tuple, value: float):
+        series = self._series.get(labels)
+        if series is None:
+            # One count per bucket plus +Inf, then the sum
+            series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self, label_names: tuple) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, series in self._series.items():
+            base = format_labels(label_names, labels)
+            total = 0
+            for bound, count in zip((*self.buckets, "+Inf"), series):
+                total += count
+                lines.append(f"{self.name}_bucket{{{base}le=\"{bound}\"}} {total}")
+            lines.append(f"{self.name}_sum{{{base.rstrip(',')}}} {series[-1]}")
+            lines.append(f"{self.name}_count{{{base.rstrip(',')}}} {total}")
+        return lines
+
+
+class MetricCounter:
+    """Monotonic counter per label set, updated from the event loop thread."""
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values: Counter = Counter()
+
+    def inc(self, labels: tuple, amount: float = 1):
+        self._values[labels] += amount
+
+    def render(self, label_names: tuple) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in self._values.items():
+            lines.append(f"{self.name}{{{format_labels(label_names, labels).rstrip(',')}}} {value}")
+        return lines
+
+
+def format_labels(names: tuple, values: tuple) -> str:
+    escaped = (
+        str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        for value in values
+    )
+    return "".join(f'{name}="{value}",' for name, value in zip(names, escaped))
+
+
+class RequestStats:
+    """Database work done on behalf of one request."""
+
+    __slots__ = ("queries", "db_time")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+
+
+# Stats of the request being served. Context variables follow the request
+# onto the threadpool and into SQLAlchemy's async greenlets
+current_request: ContextVar[Optional[RequestStats]] = ContextVar("current_request", default=None)
+
+
+def instrument_engine(engine: Engine):
+    """
+    Attributes every statement run on `engine` to the current request.
+
+    For an async engine pass its `sync_engine`.
+    """
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context._metrics_start = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        stats = current_request.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.db_time += time.perf_counter() - context._metrics_start
+
+
+class Metrics:
+    """The app's request metrics."""
+
+    REQUEST_LABELS = ("method", "route")
+    STATUS_LABELS = ("method", "route", "status")
+
+    def __init__(self):
+        self.in_flight = 0
+        self.requests = MetricCounter(
+            "http_requests_total", "Requests served, by route and status code."
+        )
+        self.rejected = MetricCounter(
+            "http_requests_rejected_total",
+            "Requests turned away before routing, by reason.",
+        )
+        self.outbox = MetricCounter(
+            "outbox_events_total",
+            "Outbox events handled by this process, by kind and outcome.",
+        )
+        self.latency = Histogram(
+            "http_request_duration_seconds",
+            "Time from receiving a request to sending the end of its response.",
+            LATENCY_BUCKETS,
+        )
+        self.db_time = Histogram(
+            "http_request_db_seconds",
+            "Time spent executing SQL statements per request.",
+            LATENCY_BUCKETS,
+        )
+        self.db_queries = Histogram(
+            "http_request_db_queries",
+            "SQL statements executed per request.",
+            QUERY_COUNT_BUCKETS,
+        )
+
+    def record(self, method: str, route: str, status: int, duration: float, stats: RequestStats):
+        labels = (method, route)
+        self.requests.inc((method, route, status))
+        self.latency.observe(labels, duration)
+        self.db_time.observe(labels, stats.db_time)
+        self.db_queries.observe(labels, stats.queries)
+
+    def render(self, extra: Optional[dict] = None) -> str:
+        """
+        Renders every metric in the Prometheus text format.
+
+        :param extra: Gauges to include, by metric name.
+        """
+        lines = [
+            "# HELP http_requests_in_flight Requests currently being served.",
+            "# TYPE http_requests_in_flight gauge",
+            f"http_requests_in_flight {self.in_flight}",
+        ]
+        lines += self.requests.render(self.STATUS_LABELS)
+        lines += self.rejected.render(("reason",))
+        lines += self.outbox.render(("kind", "outcome"))
+        for histogram in (self.latency, self.db_time, self.db_queries):
+            lines += histogram.render(self.REQUEST_LABELS)
+        for name, value in (extra or {}).items():
+            lines += [f"# TYPE {name} gauge", f"{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+
+class SlowRequestProfiler:
+    """
+    Sampling profiler for slow requests.
+
+    A background thread samples the event loop thread's stack every
+    `interval` seconds. Each sample counts towards every in-flight request
+    that has been running for longer than `threshold` seconds. When such a
+    request finishes, its most frequent stacks are kept in `profiles`.
+    Stacks are only collected while a request is over the threshold, so
+    fast traffic costs one dictionary scan per interval.
+
+    With DB_MODE=sync the queries run on the threadpool, so their time
+    shows up as awaiting a thread rather than as the query's own stack.
+    """
+
+    def __init__(self, threshold: float, interval: float, keep: int = PROFILE_KEEP):
+        self.threshold = threshold
+        self.interval = interval
+        self.profiles: deque = deque(maxlen=keep)
+        self._active: dict[int, tuple[float, Counter]] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._target: Optional[int] = None
+
+    def start(self):
+        self._target = threading.get_ident()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, name="slow-request-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def begin(self, token: int, start: float):
+        with self._lock:
+            self._active[token] = (start, Counter())
+
+    def end(self, token: int, method: str, route: str, duration: float):
+        with self._lock:
+            _, stacks = self._active.pop(token, (None, None))
+        if duration >= self.threshold and stacks:
+            self.profiles.append(
+                {
+                    "method": method,
+                    "route": route,
+                    "duration_ms": round(duration * 1000, 1),
+                    "samples": sum(stacks.values()),
+                    "stacks": dict(stacks.most_common(20)),
+                }
+            )
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            now = time.perf_counter()
+            with self._lock:
+                slow = [stacks for start, stacks in self._active.values() if now - start >= self.threshold]
+            if not slow:
+                continue
+            frame = sys._current_frames().get(self._target)
+            if frame is None:
+                continue
+            stack = collapse_stack(frame)
+            with self._lock:
+                for stacks in slow:
+                    stacks[stack] += 1
+
+
+def collapse_stack(frame, limit: int = 40) -> str:
+    """Formats a stack outermost frame first, as `file:function:line;...`."""
+    frames = []
+    while frame is not None and len(frames) < limit:
+        code = frame.f_code
+        frames.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+        frame = frame.f_back
+    return ";".join(reversed(frames))
+
+
+# Shared metrics and, when PROFILE_SLOW_MS is set, the slow request profiler
+metrics = Metrics()
+profiler = (
+    SlowRequestProfiler(float(PROFILE_SLOW_MS) / 1000, PROFILE_INTERVAL_MS / 1000)
+    if PROFILE_SLOW_MS
+    else None
+)
@@ -0,0 +1,123 @@
+import base64
+import json
+from datetime import date
+from typing import AsyncIterable, AsyncIterator
+from pydantic import BaseModel
+
+# Page size used when the client does not send a `limit`
+DEFAULT_PAGE_SIZE = 100
+# Largest page a client may ask for
+MAX_PAGE_SIZE = 1000
+# Rows fetched per round trip when streaming a whole table
+STREAM_BATCH_SIZE = 1000
+
+
+def encode_cursor(key: dict) -> str:
+    """
+    Encodes a keyset position into an opaque cursor string.
+
+    :param key: The column values of the last row on the page.
+    :return: A URL-safe cursor string.
+    """
+    raw = json.dumps(key, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("utf-8").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> dict:
+    """
+    Decodes a cursor produced by `encode_cursor`.
+
+    :param cursor: The cursor string sent by the client.
+    :return: The keyset position stored in the cursor.
+    :raises ValueError: If the cursor is malformed.
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        key = json.loads(base64.urlsafe_b64decode(padded.encode("utf-8")))
+    except (ValueError, TypeError) as e:
+        raise ValueError("Invalid cursor") from e
+    if not isinstance(key, dict):
+        raise ValueError("Invalid cursor")
+    return key
+
+
+def cursor_position(cursor: str | None, key_name: str) -> int | None:
+    """
+    Reads the keyset column value out of an optional cursor.
+
+    :param cursor: The cursor string sent by the client, if any.
+    :param key_name: The name of the keyset column.
+    :return: The last seen key, or None when there is no cursor.
+    :raises ValueError: If the cursor is malformed or for another column.
+    """
+    if cursor is None:
+        return None
+    position = decode_cursor(cursor).get(key_name)
+    if not isinstance(position, int):
+        raise ValueError("Invalid cursor")
+    return position
+
+
+def cursor_keyset(cursor: str | None, columns: dict[str, type]) -> tuple | None:
+    """
+    Reads a keyset position of several columns out of an optional cursor.
+
+    :param cursor: The cursor string sent by the client, if any.
+    :param columns: The keyset columns in sort order, with their type,
+        `int` or `date`.
+    :return: The last seen values in column order, or None when there is
+        no cursor.
+    :raises ValueError: If the cursor is malformed or for other columns.
+    """
+    if cursor is None:
+        return None
+    key = decode_cursor(cursor)
+    if set(key) != set(columns):
+        raise ValueError("Invalid cursor")
+    values = []
+    for name, kind in columns.items():
+        value = key[name]
+        if kind is date:
+            try:
+                value = date.fromisoformat(value)
+            except (TypeError, ValueError):
+                raise ValueError("Invalid cursor") from None
+        elif not isinstance(value, int):
+            raise ValueError("Invalid cursor")
+        values.append(value)
+    return tuple(values)
+
+
+def next_cursor(rows: list, limit: int, *key_names: str) -> str | None:
+    """
+    Builds the cursor for the page after `rows`.
+
+    The CRUD page readers fetch `limit + 1` rows, so an extra row means
+    there is another page. The extra row is dropped from `rows` in place.
+
+    :param rows: The rows returned by a page reader.
+    :param limit: The page size requested by the client.
+    :param key_names: The names of the keyset columns.
+    :return: The next cursor, or None on the last page.
+    """
+    if len(rows) <= limit:
+        return None
+    del rows[limit:]
+    key = {name: getattr(rows[-1], name) for name in key_names}
+    # Dates travel as ISO strings, `cursor_keyset` parses them back
+    return encode_cursor({
+        name: value.isoformat() if isinstance(value, date) else value
+        for name, value in key.items()
+    })
+
+
+async def ndjson_lines(bodies: AsyncIterable[BaseModel]) -> AsyncIterator[str]:
+    """
+    Serializes models one at a time as newline-delimited JSON.
+
+    :param bodies: An async iterable of pydantic models, typically built
+        lazily from a streaming query.
+    :return: An async iterator of JSON lines.
+    """
+    async for body in bodies:
+        yield body.model_dump_json() + "\n"
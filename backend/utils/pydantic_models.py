@@ -1,5 +1,10 @@
-from pydantic import BaseModel
-from typing import Optional
+from datetime import datetime
+from pydantic import BaseModel, Field
+from typing import Generic, Optional, TypeVar
+from utils.batch import MAX_BATCH_IDS
+
+# Longest review text accepted, in characters
+MAX_REVIEW_LENGTH = 5000
 
 # This model is used to validate the request body for the /customers endpoint
 class UserBody(BaseModel):
@@ -22,26 +27,134 @@ class ItemBody(BaseModel):
     itemDesc: str
     stock: int
     itemPic: str
-    reviews: Optional[list] = None
+    # Computed from the item's reviews, which are served separately by
+    # /items/{itemId}/reviews so item payloads stay small
+    ratingCount: int = 0
+    averageRating: Optional[float] = None
+
+    class Config:
+        from_attributes = True
+
+# This model is used to validate the request body for posting a review
+class NewReviewBody(BaseModel):
+    rating: int = Field(ge=1, le=5)
+    text: str = Field(min_length=1, max_length=MAX_REVIEW_LENGTH)
+
+# This model is used for a review in the /items/{itemId}/reviews responses
+class ReviewBody(BaseModel):
+    reviewId: int
+    itemId: int
+    userId: Optional[int] = None
+    rating: Optional[int] = None
+    text: str
+    created_at: datetime
 
     class Config:
         from_attributes = True
 
+# This model is used for a category's rollup, the average rating is over
+# every rating of the category's items
+class CategoryRollup(BaseModel):
+    category: str
+    itemCount: int
+    stockTotal: int
+    averageRating: Optional[float] = None
+
+# This model is used for an item's rollup of the orders holding it
+class ItemRollup(BaseModel):
+    itemId: int
+    item_name: str
+    orderCount: int
+    unitsOrdered: int
+
+    class Config:
+        from_attributes = True
+
+# This model is used for a single line of an order, an item and its quantity
+class OrderLineBody(ItemBody):
+    qty: int = Field(default=1, ge=1)
+
 # This model is used to validate the request body for the /orders endpoint
 class OrderBody(BaseModel):
     orderId: Optional[int] = None
     userId: Optional[int] = None
-    items: list[ItemBody]
+    items: list[OrderLineBody]
 
     class Config:
         from_attributes = True
+# This model is used to validate the request body for the batch-get endpoints
+class BatchGetBody(BaseModel):
+    ids: list[int] = Field(min_length=1, max_length=MAX_BATCH_IDS)
+
 # This model is used to validate the request body for the /auth endpoint
 class AuthRequest(BaseModel):
     email: str
     password: str
 
-# This model is used to validate the response body for all endpoints
-# `data` can be a string, dictionary, or list
-class Response(BaseModel):
+T = TypeVar("T")
+
+# This model documents the response body of every endpoint. Routes build
+# the body with `utils.responses.respond`, which serializes it directly
+# instead of validating it against this model first
+class Envelope(BaseModel, Generic[T]):
     status: int
-    data: str | dict | list 
+    data: T
+
+# These models are the `data` of the responses
+class ItemData(BaseModel):
+    item: ItemBody
+
+class ItemList(BaseModel):
+    items: list[ItemBody]
+
+class ItemsPage(ItemList):
+    next_cursor: Optional[str] = None
+
+class ItemBatch(ItemList):
+    missing: list[int]
+
+class ItemSearchResult(ItemList):
+    facets: dict[str, dict[str, int]]
+    total: int
+
+class ReviewData(BaseModel):
+    review: ReviewBody
+
+class ReviewsPage(BaseModel):
+    reviews: list[ReviewBody]
+    next_cursor: Optional[str] = None
+
+class ItemStatsData(BaseModel):
+    categories: list[CategoryRollup]
+    topItems: list[ItemRollup]
+
+class ImportResult(BaseModel):
+    inserted: int
+    failed: int
+    errors: list[dict]
+    errors_truncated: bool
+
+class UserData(BaseModel):
+    user: UserBody
+
+class UsersPage(BaseModel):
+    users: list[UserBody]
+    next_cursor: Optional[str] = None
+
+class Token(BaseModel):
+    token: str
+
+class SignupResult(Token):
+    message: str
+
+class OrderData(BaseModel):
+    orders: OrderBody
+
+class OrderList(BaseModel):
+    orders: list[OrderBody]
+
+class OrderBatch(OrderList):
+    missing: list[int]
+
+class OrdersPage(OrderList):
+    next_cursor: Optional[str] = None 
@@ -0,0 +1,175 @@
+import hashlib
+import logging
+import math
+import os
+import time
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# "memory" keeps the buckets in this process, "redis" shares them between
+# workers through a Redis-compatible server at RATE_LIMIT_REDIS_URL, "off"
+# disables rate limiting. Admission control applies either way
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+RATE_LIMIT_REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL", os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+# Buckets kept by the memory backend, the least recently used are dropped
+RATE_LIMIT_MAXSIZE = int(os.getenv("RATE_LIMIT_MAXSIZE", "100000"))
+# Requests per second and burst size of each kind of client. Each one can be
+# overridden with RATE_LIMIT_<KIND>_RATE and RATE_LIMIT_<KIND>_BURST
+RATE_LIMITS = {
+    kind: (
+        float(os.getenv(f"RATE_LIMIT_{kind.upper()}_RATE", rate)),
+        float(os.getenv(f"RATE_LIMIT_{kind.upper()}_BURST", burst)),
+    )
+    for kind, (rate, burst) in {
+        "user": (20, 40),
+        "api_key": (100, 200),
+        "ip": (10, 20),
+    }.items()
+}
+# Tokens taken by requests that hash a password, instead of one
+RATE_LIMIT_AUTH_COST = float(os.getenv("RATE_LIMIT_AUTH_COST", "5"))
+# Requests served at once before new ones are turned away with 503, 0 for
+# no limit. Keep it near what the database pool and threadpool can serve
+MAX_IN_FLIGHT = int(os.getenv("MAX_IN_FLIGHT", "100"))
+# Only with a proxy in front that appends the client to X-Forwarded-For
+RATE_LIMIT_TRUST_PROXY = os.getenv("RATE_LIMIT_TRUST_PROXY", "false").lower() == "true"
+
+
+class MemoryBuckets:
+    """
+    Token buckets kept in this process, with LRU eviction.
+
+    Only touched from the event loop, and `take` never awaits, so it needs
+    no lock.
+    """
+
+    def __init__(self, maxsize: int = RATE_LIMIT_MAXSIZE):
+        self.maxsize = maxsize
+        self._buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+
+    async def take(self, key: str, rate: float, burst: float, cost: float) -> float:
+        now = time.monotonic()
+        tokens, at = self._buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - at) * rate)
+        wait = 0.0
+        if tokens >= cost:
+            tokens -= cost
+        else:
+            wait = (cost - tokens) / rate
+        self._buckets[key] = (tokens, now)
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.maxsize:
+            self._buckets.popitem(last=False)
+        return wait
+
+
+# Refills and takes from a bucket in one atomic step, on the server's clock
+# so workers with skewed clocks agree. Returns the wait as a string, since
+# Lua numbers are truncated to integers on the way out
+TAKE_SCRIPT = """
+local rate, burst, cost = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'at')
+local tokens = tonumber(bucket[1]) or burst
+local at = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - at) * rate)
+local wait = 0
+if tokens >= cost then
+    tokens = tokens - cost
+else
+    wait = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'at', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+
+class RedisBuckets:
+    """
+    Token buckets shared by every worker through a Redis-compatible server.
+
+    Any client exposing the async `eval` command of `redis.asyncio.Redis`
+    works, including an in-memory fake with Lua support.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    async def take(self, key: str, rate: float, burst: float, cost: float) -> float:
+        wait = await self.client.eval(TAKE_SCRIPT, 1, key, rate, burst, cost)
+        return float(wait.decode("utf-8") if isinstance(wait, bytes) else wait)
+
+
+class RateLimiter:
+    """
+    Per-client token buckets in front of a backend.
+
+    A shared backend that fails is replaced by buckets in this process for
+    that request, so an outage of the server never takes the API down. The
+    outage is logged when it starts and when it ends, not per request.
+    """
+
+    def __init__(self, backend, limits: dict = RATE_LIMITS):
+        self.backend = backend
+        self.limits = limits
+        self._fallback = MemoryBuckets()
+        self._failing = False
+
+    async def take(self, kind: str, client: str, cost: float = 1) -> float:
+        """
+        Takes `cost` tokens from a client's bucket.
+
+        :param kind: A key of RATE_LIMITS, e.g. "user".
+        :param client: The client's ID within its kind.
+        :param cost: Tokens the request takes, at most the bucket's burst.
+        :return: 0 if the request may proceed, else the seconds until it would.
+        """
+        rate, burst = self.limits[kind]
+        key = f"ratelimit:{kind}:{client}"
+        cost = min(cost, burst)
+        try:
+            wait = await self.backend.take(key, rate, burst, cost)
+        except Exception:
+            if not self._failing:
+                self._failing = True
+                logger.warning("Rate limit backend failed, using local buckets", exc_info=True)
+            return await self._fallback.take(key, rate, burst, cost)
+        if self._failing:
+            self._failing = False
+            logger.info("Rate limit backend is back")
+        return wait
+
+
+# Whole seconds for a Retry-After header, at least one
+def retry_after(wait: float) -> str:
+    return str(max(1, math.ceil(wait)))
+
+
+# Short stable ID of a secret, so API keys are never kept as bucket names
+def fingerprint(secret: str) -> str:
+    return hashlib.sha256(secret.encode("utf-8")).hexdigest()[:16]
+
+
+# Build the limiter selected by RATE_LIMIT_BACKEND, None when it is off
+def build_limiter():
+    if RATE_LIMIT_BACKEND == "off":
+        return None
+    if RATE_LIMIT_BACKEND == "memory":
+        return RateLimiter(MemoryBuckets())
+    if RATE_LIMIT_BACKEND == "redis":
+        try:
+            from redis import asyncio as redis
+        except ImportError as e:
+            raise RuntimeError("RATE_LIMIT_BACKEND=redis requires the redis package") from e
+        return RateLimiter(RedisBuckets(redis.from_url(RATE_LIMIT_REDIS_URL)))
+    raise ValueError(f"RATE_LIMIT_BACKEND must be 'off', 'memory' or 'redis', got {RATE_LIMIT_BACKEND!r}")
+
+
+# Shared limiter, tests can swap `limiter.backend` for a fake
+limiter = build_limiter()
@@ -0,0 +1,55 @@
+from typing import Any, Optional
+from pydantic_core import to_json
+from starlette.responses import Response
+
+
+class FastJSONResponse(Response):
+    """
+    JSON response serialized by pydantic-core in a single pass.
+
+    Models, lists and dicts go straight to UTF-8 bytes in Rust, without
+    FastAPI's `jsonable_encoder` first rebuilding them as plain Python.
+    """
+
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return to_json(content)
+
+
+def respond(
+    data: Any,
+    status: int = 200,
+    headers: Optional[dict] = None,
+    status_code: int = 200,
+) -> FastJSONResponse:
+    """
+    Builds the `{"status": ..., "data": ...}` body every endpoint returns.
+
+    Returning a response object skips FastAPI's validation against the
+    route's `response_model`, which then only documents the body. `data`
+    must already hold validated models, e.g. from `ItemBody.model_validate`.
+
+    :param data: The payload, of the type the route's Envelope declares.
+    :param status: The status echoed in the body.
+    :param headers: Extra response headers, e.g. from `cache_headers`.
+    :param status_code: The HTTP status, e.g. 201 along with `status` for a
+        created resource.
+    """
+    return FastJSONResponse(
+        {"status": status, "data": data}, status_code=status_code, headers=headers
+    )
+
+
+def respond_json(data: str, status: int = 200, headers: Optional[dict] = None) -> Response:
+    """
+    Like `respond` for a payload that is already JSON, e.g. from the cache.
+
+    The payload is spliced into the body as is, so it is never parsed.
+
+    :param data: The payload as a JSON document.
+    :param status: The status echoed in the body.
+    :param headers: Extra response headers.
+    """
+    body = b'{"status":%d,"data":%s}' % (status, data.encode("utf-8"))
+    return Response(body, media_type="application/json", headers=headers)
@@ -0,0 +1,258 @@
+import hashlib
+import os
+import uuid
+from contextlib import AsyncExitStack
+from typing import AsyncIterable, AsyncIterator, Callable, Optional
+import anyio
+from dotenv import load_dotenv
+from fastapi import HTTPException, UploadFile
+
+load_dotenv()
+
+# "local" keeps files under STORAGE_DIR, "s3" stores them in S3_BUCKET on
+# any S3-compatible service, e.g. MinIO via S3_ENDPOINT_URL
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "local")
+STORAGE_DIR = os.getenv("STORAGE_DIR", "uploads")
+S3_BUCKET = os.getenv("S3_BUCKET")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")
+# Uploads are read and written in chunks of this many bytes
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", 1024 * 1024))
+# Larger uploads are rejected with 413
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", 10 * 1024 * 1024))
+
+# Image formats recognized from their first bytes, by file extension
+IMAGE_TYPES = {
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".gif": "image/gif",
+    ".webp": "image/webp",
+}
+
+
+def sniff_extension(head: bytes) -> Optional[str]:
+    """
+    Recognizes an image format from the first bytes of a file.
+
+    :param head: At least the first 12 bytes of the file.
+    :return: The extension of the format, or None if it is not an image.
+    """
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return ".png"
+    if head.startswith(b"\xff\xd8\xff"):
+        return ".jpg"
+    if head.startswith((b"GIF87a", b"GIF89a")):
+        return ".gif"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return ".webp"
+    return None
+
+
+def content_key(digest: str, extension: str) -> str:
+    """
+    Builds the storage key of a file from its SHA-256 digest.
+
+    Files are spread over 256 directories by the first byte of the digest,
+    so no single directory grows too large.
+    """
+    return f"{digest[:2]}/{digest}{extension}"
+
+
+# Read an upload from the start in chunks, without blocking the event loop
+async def upload_chunks(upload: UploadFile) -> AsyncIterator[bytes]:
+    await upload.seek(0)
+    while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+        yield chunk
+
+
+# Read a local file in chunks, without blocking the event loop
+async def file_chunks(path: str) -> AsyncIterator[bytes]:
+    async with await anyio.open_file(path, "rb") as file:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            yield chunk
+
+
+class LocalStorage:
+    """
+    Files on the local disk under `root`.
+
+    Files are written to a temporary name and renamed into place, so a
+    reader never sees a partial file and concurrent writers of the same
+    key cannot corrupt it.
+    """
+
+    def __init__(self, root: str = STORAGE_DIR):
+        self.root = root
+
+    def path(self, key: str) -> str:
+        # Keys can come from imported data, so never resolve one outside root
+        root = os.path.abspath(self.root)
+        path = os.path.abspath(os.path.join(root, key))
+        if not path.startswith(root + os.sep):
+            raise ValueError(f"Storage key {key!r} points outside {self.root}")
+        return path
+
+    async def exists(self, key: str) -> bool:
+        return await anyio.Path(self.path(key)).is_file()
+
+    async def write(self, key: str, chunks: AsyncIterable[bytes], content_type: str):
+        path = anyio.Path(self.path(key))
+        await path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+        try:
+            async with await anyio.open_file(tmp, "wb") as file:
+                async for chunk in chunks:
+                    await file.write(chunk)
+            await tmp.replace(path)
+        except BaseException:
+            await tmp.unlink(missing_ok=True)
+            raise
+
+    async def read(self, key: str) -> AsyncIterator[bytes]:
+        async for chunk in file_chunks(self.path(key)):
+            yield chunk
+
+    async def close(self):
+        pass
+
+
+class S3Storage:
+    """
+    Objects in a bucket of an S3-compatible service.
+
+    Any client exposing the async `head_object`, `put_object`,
+    `get_object` calls of an aiobotocore S3 client works. The client is
+    created on first use unless one is passed in.
+    """
+
+    def __init__(self, bucket: str, client=None, endpoint_url: Optional[str] = S3_ENDPOINT_URL):
+        self.bucket = bucket
+        self.endpoint_url = endpoint_url
+        self._client = client
+        self._stack = AsyncExitStack()
+
+    async def client(self):
+        if self._client is None:
+            try:
+                from aiobotocore.session import get_session
+            except ImportError as e:
+                raise RuntimeError("STORAGE_BACKEND=s3 requires the aiobotocore package") from e
+            self._client = await self._stack.enter_async_context(
+                get_session().create_client("s3", endpoint_url=self.endpoint_url)
+            )
+        return self._client
+
+    async def exists(self, key: str) -> bool:
+        client = await self.client()
+        try:
+            await client.head_object(Bucket=self.bucket, Key=key)
+        except Exception as e:
+            code = getattr(e, "response", {}).get("Error", {}).get("Code")
+            if code in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+        return True
+
+    async def write(self, key: str, chunks: AsyncIterable[bytes], content_type: str):
+        # Uploads are capped at MAX_UPLOAD_SIZE, so one PUT of the whole
+        # body is bounded and avoids the bookkeeping of a multipart upload
+        body = b"".join([chunk async for chunk in chunks])
+        client = await self.client()
+        await client.put_object(
+            Bucket=self.bucket, Key=key, Body=body, ContentType=content_type
+        )
+
+    async def read(self, key: str) -> AsyncIterator[bytes]:
+        client = await self.client()
+        response = await client.get_object(Bucket=self.bucket, Key=key)
+        async with response["Body"] as body:
+            while chunk := await body.read(UPLOAD_CHUNK_SIZE):
+                yield chunk
+
+    async def close(self):
+        await self._stack.aclose()
+        self._client = None
+
+
+async def save_upload(upload: UploadFile) -> str:
+    """
+    Stores an uploaded file under a key derived from its content.
+
+    The upload is hashed in a first pass and only written in a second pass
+    if no file with the same content is stored yet, so re-uploading an
+    image costs no writes and different images can never collide. Every
+    read and write happens in chunks off the event loop.
+
+    :param upload: The uploaded file.
+    :return: The storage key of the file, to be saved on the item.
+    """
+    return await save_chunks(lambda: upload_chunks(upload), upload.filename)
+
+
+async def save_file(path: str, target=None) -> str:
+    """
+    Stores a local file under a key derived from its content, like
+    `save_upload`, e.g. a picture saved before keys were content hashes.
+
+    :param path: The file to store.
+    :param target: The storage to write to, `storage` by default.
+    :return: The storage key of the file.
+    """
+    # The file is already stored, so it is not held to MAX_UPLOAD_SIZE
+    return await save_chunks(lambda: file_chunks(path), os.path.basename(path), target, max_size=None)
+
+
+async def save_chunks(
+    chunks: Callable[[], AsyncIterator[bytes]],
+    filename: Optional[str],
+    target=None,
+    max_size: Optional[int] = MAX_UPLOAD_SIZE,
+) -> str:
+    """
+    Hashes a file and stores it under its content key unless it already is.
+
+    :param chunks: Starts a new pass over the file's chunks.
+    :param filename: The client's name of the file, for its extension.
+    :param target: The storage to write to, `storage` by default.
+    :param max_size: Larger files are rejected with 413, None for no limit.
+    :return: The storage key of the file.
+    """
+    target = target or storage
+    digest = hashlib.sha256()
+    head = b""
+    size = 0
+    async for chunk in chunks():
+        if len(head) < 12:
+            head += chunk[:12]
+        size += len(chunk)
+        if max_size is not None and size > max_size:
+            raise HTTPException(status_code=413, detail="Uploaded file is too large")
+        digest.update(chunk)
+
+    # Images are named by their sniffed format so identical bytes always
+    # map to one key. Anything else keeps the client's extension
+    extension = sniff_extension(head)
+    if extension is None:
+        extension = os.path.splitext(filename or "")[1].lower()
+        if not extension[1:].isalnum() or len(extension) > 10:
+            extension = ""
+    content_type = IMAGE_TYPES.get(extension, "application/octet-stream")
+
+    key = content_key(digest.hexdigest(), extension)
+    if not await target.exists(key):
+        await target.write(key, chunks(), content_type)
+    return key
+
+
+# Build the backend selected by STORAGE_BACKEND
+def build_storage():
+    if STORAGE_BACKEND == "local":
+        return LocalStorage()
+    if STORAGE_BACKEND == "s3":
+        if not S3_BUCKET:
+            raise ValueError("STORAGE_BACKEND=s3 requires S3_BUCKET")
+        return S3Storage(S3_BUCKET)
+    raise ValueError(f"STORAGE_BACKEND must be 'local' or 's3', got {STORAGE_BACKEND!r}")
+
+
+# Shared storage instance used by the routes
+storage = build_storage()